@@ -0,0 +1,242 @@
+"""
+Control de admisión para el trabajo que llega a los modelos (vLLM, Ollama, Whisper, TTS)
+Cada backend tiene un número fijo de plazas por worker; las peticiones que no caben esperan en
+una cola con prioridad (el chat interactivo antes que el trabajo por lotes) y, si la espera
+estimada supera el máximo, se rechazan enseguida con Retry-After en lugar de empezar todas y
+ralentizarse juntas hasta que los timeouts se encadenan.
+
+- CHATBOT_ADMISSION_<BACKEND>_SLOTS: plazas simultáneas por worker (0 = sin límite)
+- CHATBOT_ADMISSION_MAX_WAIT / CHATBOT_ADMISSION_BATCH_MAX_WAIT: espera máxima en cola (segundos)
+- CHATBOT_ADMISSION_MAX_QUEUE: peticiones en cola por backend
+- La espera estimada es (posición en la cola / plazas) * tiempo de servicio medio (EWMA)
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+# Plazas por defecto de cada backend (por worker de uvicorn)
+DEFAULT_SLOTS = {"vllm": 16, "ollama": 2, "whisper": 1, "tts": 1}
+ADMISSION_MAX_WAIT = {
+    PRIORITY_INTERACTIVE: float(os.getenv("CHATBOT_ADMISSION_MAX_WAIT", "20")),
+    PRIORITY_BATCH: float(os.getenv("CHATBOT_ADMISSION_BATCH_MAX_WAIT", "120")),
+}
+ADMISSION_MAX_QUEUE = int(os.getenv("CHATBOT_ADMISSION_MAX_QUEUE", "100"))
+ADMISSION_EWMA_ALPHA = 0.2
+WAIT_WINDOW = 500  # esperas recientes para los percentiles
+
+
+class AdmissionRejected(Exception):
+    """No hay plaza y la espera estimada supera el máximo (responder 429 con Retry-After)"""
+
+    def __init__(self, backend: str, retry_after: int, reason: str):
+        super().__init__(f"{backend}: {reason}")
+        self.backend = backend
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _Backend:
+    """Plazas, cola con prioridad y tiempos de un backend"""
+
+    def __init__(self, name: str, slots: int):
+        self.name = name
+        self.slots = max(0, slots)
+        self.in_use = 0
+        # (prioridad, orden de llegada, future); los futures cancelados se descartan al sacarlos
+        self.waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.queued: Dict[int, int] = {p: 0 for p in PRIORITY_NAMES}
+        self.service_ewma: Optional[float] = None  # segundos que se ocupa una plaza
+        self.waits: deque = deque(maxlen=WAIT_WINDOW)
+        self.counters = {"admitted": 0, "waited": 0, "rejected": 0, "timed_out": 0}
+
+    @property
+    def unlimited(self) -> bool:
+        return self.slots == 0
+
+    def estimate_wait(self, priority: int) -> float:
+        """Segundos estimados hasta obtener plaza (0 si hay una libre)"""
+        ahead = sum(count for p, count in self.queued.items() if p <= priority)
+        if self.unlimited or (self.in_use < self.slots and not ahead):
+            return 0.0
+        if self.service_ewma is None:
+            return 0.0
+        return (ahead + 1) / self.slots * self.service_ewma
+
+
+class Ticket:
+    """Plaza concedida; release() la devuelve (idempotente)"""
+
+    __slots__ = ("_controller", "backend", "priority", "granted_at", "_released")
+
+    def __init__(self, controller: "AdmissionController", backend: _Backend, priority: int):
+        self._controller = controller
+        self.backend = backend
+        self.priority = priority
+        self.granted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self)
+
+
+class AdmissionController:
+    """Plazas por backend con cola de prioridad (un controlador por worker, en el event loop)"""
+
+    def __init__(
+        self,
+        slots: Optional[Dict[str, int]] = None,
+        max_wait: Optional[Dict[int, float]] = None,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+    ):
+        if slots is None:
+            slots = {
+                name: int(os.getenv(f"CHATBOT_ADMISSION_{name.upper()}_SLOTS", str(default)))
+                for name, default in DEFAULT_SLOTS.items()
+            }
+        self.backends: Dict[str, _Backend] = {name: _Backend(name, n) for name, n in slots.items()}
+        self.max_wait = dict(max_wait or ADMISSION_MAX_WAIT)
+        self.max_queue = max(0, max_queue)
+        self._seq = itertools.count()
+
+    def _backend(self, name: str) -> _Backend:
+        backend = self.backends.get(name)
+        if backend is None:
+            raise ValueError(f"Backend de admisión desconocido: {name}")
+        return backend
+
+    def _reject(self, backend: _Backend, priority: int, reason: str) -> AdmissionRejected:
+        backend.counters["rejected"] += 1
+        estimate = backend.estimate_wait(priority) or backend.service_ewma or 1.0
+        retry_after = max(1, math.ceil(estimate))
+        logger.warning(f"⚠️ Admisión rechazada en {backend.name} ({PRIORITY_NAMES[priority]}): {reason}; Retry-After {retry_after}s")
+        return AdmissionRejected(backend.name, retry_after, reason)
+
+    def check(self, name: str, priority: int = PRIORITY_INTERACTIVE):
+        """Rechazar ya (AdmissionRejected) si la petición no obtendría plaza a tiempo
+
+        Para respuestas en streaming: permite contestar 429 antes de enviar las cabeceras
+        y esperar la plaza con slot() dentro del generador.
+        """
+        backend = self._backend(name)
+        if backend.unlimited or backend.in_use < backend.slots:
+            return
+        if sum(backend.queued.values()) >= self.max_queue:
+            raise self._reject(backend, priority, "cola llena")
+        estimate = backend.estimate_wait(priority)
+        if estimate > self.max_wait[priority]:
+            raise self._reject(backend, priority, f"espera estimada {estimate:.1f}s")
+
+    async def acquire(self, name: str, priority: int = PRIORITY_INTERACTIVE) -> Ticket:
+        """Obtener una plaza, esperando en la cola si hace falta (AdmissionRejected si no llega a tiempo)"""
+        backend = self._backend(name)
+        if backend.unlimited or (backend.in_use < backend.slots and not any(backend.queued.values())):
+            backend.in_use += 1
+            backend.counters["admitted"] += 1
+            backend.waits.append(0.0)
+            return Ticket(self, backend, priority)
+        self.check(name, priority)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(backend.waiters, (priority, next(self._seq), future))
+        backend.queued[priority] += 1
+        backend.counters["waited"] += 1
+        started = time.monotonic()
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self.max_wait[priority])
+        except BaseException:
+            # Cancelada mientras esperaba: si la plaza ya se había concedido, devolverla
+            if future.done() and not future.cancelled():
+                future.result().release()
+            else:
+                self._leave_queue(backend, priority, future)
+            raise
+        if not done:
+            self._leave_queue(backend, priority, future)
+            backend.counters["timed_out"] += 1
+            raise self._reject(backend, priority, f"sin plaza en {self.max_wait[priority]:.0f}s")
+        backend.waits.append(time.monotonic() - started)
+        return future.result()
+
+    def _leave_queue(self, backend: _Backend, priority: int, future: asyncio.Future):
+        future.cancel()
+        backend.queued[priority] -= 1
+
+    def _release(self, ticket: Ticket):
+        backend = ticket.backend
+        held = time.monotonic() - ticket.granted_at
+        backend.service_ewma = held if backend.service_ewma is None else (
+            ADMISSION_EWMA_ALPHA * held + (1 - ADMISSION_EWMA_ALPHA) * backend.service_ewma
+        )
+        if backend.unlimited:
+            backend.in_use -= 1
+            return
+        # La plaza pasa directamente al siguiente en la cola (por prioridad y orden de llegada)
+        while backend.waiters:
+            priority, _, future = heapq.heappop(backend.waiters)
+            if future.done():
+                continue
+            backend.queued[priority] -= 1
+            backend.counters["admitted"] += 1
+            future.set_result(Ticket(self, backend, priority))
+            return
+        backend.in_use -= 1
+
+    @asynccontextmanager
+    async def slot(self, name: str, priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[Ticket]:
+        """async with controller.slot("vllm"): ... (la plaza se devuelve al salir)"""
+        ticket = await self.acquire(name, priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {}
+        for name, backend in self.backends.items():
+            waits = sorted(backend.waits)
+            stats[name] = {
+                "slots": backend.slots or None,
+                "in_use": backend.in_use,
+                "queued": {PRIORITY_NAMES[p]: n for p, n in backend.queued.items()},
+                **backend.counters,
+                "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else None,
+                "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+                "service_ewma_ms": round(backend.service_ewma * 1000, 1) if backend.service_ewma is not None else None,
+                "estimated_wait_ms": round(backend.estimate_wait(PRIORITY_INTERACTIVE) * 1000, 1),
+            }
+        return stats
+
+
+# Instancia global
+_admission: Optional[AdmissionController] = None
+_admission_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    """Obtener el controlador de admisión del worker"""
+    global _admission
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                _admission = AdmissionController()
+                limits = ", ".join(f"{b.name}={b.slots or '∞'}" for b in _admission.backends.values())
+                logger.info(f"✅ Control de admisión: {limits} plazas por worker")
+    return _admission
@@ -2,7 +2,6 @@
 Sistema de autenticación y gestión de usuarios
 """
 
-import sqlite3
 import hashlib
 import secrets
 import logging
@@ -11,6 +10,8 @@ from typing import Optional, Dict, Any
 from jose import jwt
 import os
 
+from db_router import get_router
+
 logger = logging.getLogger(__name__)
 
 # Secret key para JWT (en producción debe estar en variables de entorno)
@@ -24,40 +25,10 @@ class AuthManager:
     
     def __init__(self, db_path: str = "chatbot.db"):
         self.db_path = db_path
-        self._init_db()
-    
-    def _init_db(self):
-        """Inicializar tablas de autenticación"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Tabla de usuarios
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                name TEXT,
-                created_at INTEGER NOT NULL,
-                updated_at INTEGER NOT NULL,
-                is_active INTEGER DEFAULT 1
-            )
-        """)
-        
-        # Tabla de sesiones (tokens)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                token TEXT UNIQUE NOT NULL,
-                expires_at INTEGER NOT NULL,
-                created_at INTEGER NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+        # Pool del archivo de autenticación (el mismo que MemoryManager en modo "single");
+        # el enrutador aplica las migraciones compartidas al crearse
+        self.router = get_router(db_path)
+        self.pool = self.router.auth_pool
     
     def _hash_password(self, password: str) -> str:
         """Hashear contraseña usando SHA-256 con salt"""
@@ -78,27 +49,23 @@ class AuthManager:
     def register_user(self, email: str, password: str, name: Optional[str] = None) -> Dict[str, Any]:
         """Registrar nuevo usuario"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Verificar si el email ya existe
-            cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
-            if cursor.fetchone():
-                conn.close()
-                return {"success": False, "error": "El email ya está registrado"}
-            
-            # Crear usuario
-            user_id = secrets.token_urlsafe(32)
-            password_hash = self._hash_password(password)
-            now = int(datetime.now().timestamp())
-            
-            cursor.execute("""
-                INSERT INTO users (id, email, password_hash, name, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, email, password_hash, name or "", now, now))
-            
-            conn.commit()
-            conn.close()
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                
+                # Verificar si el email ya existe
+                cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
+                if cursor.fetchone():
+                    return {"success": False, "error": "El email ya está registrado"}
+                
+                # Crear usuario
+                user_id = secrets.token_urlsafe(32)
+                password_hash = self._hash_password(password)
+                now = int(datetime.now().timestamp())
+                
+                cursor.execute("""
+                    INSERT INTO users (id, email, password_hash, name, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (user_id, email, password_hash, name or "", now, now))
             
             logger.info(f"Usuario registrado: {email}")
             return {"success": True, "user_id": user_id}
@@ -110,30 +77,23 @@ class AuthManager:
     def login_user(self, email: str, password: str) -> Dict[str, Any]:
         """Iniciar sesión y generar token"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Buscar usuario
-            cursor.execute("""
+            user = self.pool.fetchone("""
                 SELECT id, password_hash, name, is_active
                 FROM users
                 WHERE email = ?
             """, (email,))
             
-            user = cursor.fetchone()
             if not user:
-                conn.close()
                 return {"success": False, "error": "Credenciales inválidas"}
             
             user_id, password_hash, name, is_active = user
             
             if not is_active:
-                conn.close()
                 return {"success": False, "error": "Usuario inactivo"}
             
             # Verificar contraseña
             if not self._verify_password(password, password_hash):
-                conn.close()
                 return {"success": False, "error": "Credenciales inválidas"}
             
             # Generar token JWT usando jose.jwt
@@ -150,14 +110,11 @@ class AuthManager:
             now = int(datetime.now().timestamp())
             expires_at_ts = int(expires_at.timestamp())
             
-            cursor.execute("""
+            self.pool.execute("""
                 INSERT INTO user_sessions (id, user_id, token, expires_at, created_at)
                 VALUES (?, ?, ?, ?, ?)
             """, (session_id, user_id, token, expires_at_ts, now))
             
-            conn.commit()
-            conn.close()
-            
             logger.info(f"Usuario autenticado: {email}")
             return {
                 "success": True,
@@ -181,24 +138,19 @@ class AuthManager:
             user_id = payload.get("user_id")
             
             # Verificar que la sesión existe en BD
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT u.id, u.email, u.name, u.is_active
+            user = self.pool.fetchone("""
+                SELECT u.id, u.email, u.name, u.is_active, u.response_cache
                 FROM users u
                 JOIN user_sessions s ON u.id = s.user_id
                 WHERE s.token = ? AND s.expires_at > ? AND u.is_active = 1
             """, (token, int(datetime.now().timestamp())))
             
-            user = cursor.fetchone()
-            conn.close()
-            
             if user:
                 return {
                     "user_id": user[0],
                     "email": user[1],
-                    "name": user[2]
+                    "name": user[2],
+                    "response_cache": bool(user[4])
                 }
             
             return None
@@ -213,13 +165,7 @@ class AuthManager:
     def logout_user(self, token: str) -> bool:
         """Cerrar sesión (eliminar token)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("DELETE FROM user_sessions WHERE token = ?", (token,))
-            
-            conn.commit()
-            conn.close()
+            self.pool.execute("DELETE FROM user_sessions WHERE token = ?", (token,))
             
             return True
         except Exception as e:
@@ -229,18 +175,12 @@ class AuthManager:
     def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Obtener información de usuario por ID"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
+            user = self.pool.fetchone("""
                 SELECT id, email, name, created_at, is_active
                 FROM users
                 WHERE id = ?
             """, (user_id,))
             
-            user = cursor.fetchone()
-            conn.close()
-            
             if user:
                 return {
                     "id": user[0],
@@ -254,6 +194,38 @@ class AuthManager:
         except Exception as e:
             logger.error(f"Error obteniendo usuario: {e}")
             return None
+    
+    def set_response_cache(self, user_id: str, enabled: bool) -> bool:
+        """Activar o desactivar el cache de respuestas del LLM para un usuario"""
+        try:
+            updated = self.pool.execute(
+                "UPDATE users SET response_cache = ?, updated_at = ? WHERE id = ?",
+                (1 if enabled else 0, int(datetime.now().timestamp()), user_id),
+            )
+            return updated > 0
+        except Exception as e:
+            logger.error(f"Error actualizando preferencia de cache: {e}")
+            return False
+    
+    # --- API asíncrona: misma lógica ejecutada en el executor del pool ---
+    
+    async def register_user_async(self, email: str, password: str, name: Optional[str] = None) -> Dict[str, Any]:
+        return await self.pool.run(self.register_user, email, password, name)
+    
+    async def login_user_async(self, email: str, password: str) -> Dict[str, Any]:
+        return await self.pool.run(self.login_user, email, password)
+    
+    async def verify_token_async(self, token: str) -> Optional[Dict[str, Any]]:
+        return await self.pool.run(self.verify_token, token)
+    
+    async def logout_user_async(self, token: str) -> bool:
+        return await self.pool.run(self.logout_user, token)
+    
+    async def get_user_by_id_async(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self.pool.run(self.get_user_by_id, user_id)
+    
+    async def set_response_cache_async(self, user_id: str, enabled: bool) -> bool:
+        return await self.pool.run(self.set_response_cache, user_id, enabled)
 
 
 # Instancia global
@@ -0,0 +1,107 @@
+"""
+Compactación única de mensajes duplicados en chatbot.db
+
+Versiones anteriores de SQLiteChatMessageHistory volvían a insertar todo el historial
+de la sesión cada vez que se cargaba, con metadata '{}' y un timestamp nuevo.
+Esta herramienta elimina esas copias: una fila se considera duplicada si existe otra
+anterior (id menor) de la misma sesión con el mismo rol y contenido, y la fila
+duplicada no tiene metadata propia ni message_uid.
+
+Uso:
+    python compact_messages.py --dry-run          # solo contar duplicados
+    python compact_messages.py                    # eliminar duplicados en chatbot.db
+    python compact_messages.py --db otra.db --batch-sessions 200 --vacuum
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+from typing import Dict, List
+
+from migrations import apply_migrations_conn
+
+logger = logging.getLogger(__name__)
+
+# Condición de duplicado (filas sin metadata propia con una copia anterior idéntica)
+_DUPLICATE_WHERE = """
+    m.session_id IN ({placeholders})
+    AND (m.metadata IS NULL OR m.metadata IN ('', '{{}}'))
+    AND m.message_uid IS NULL
+    AND EXISTS (
+        SELECT 1 FROM messages o
+        WHERE o.session_id = m.session_id
+          AND o.role = m.role
+          AND o.content = m.content
+          AND o.id < m.id
+    )
+"""
+
+
+def compact_messages(conn: sqlite3.Connection, batch_sessions: int = 100, dry_run: bool = False) -> Dict[str, int]:
+    """Eliminar mensajes duplicados por lotes de sesiones (una transacción corta por lote)"""
+    session_ids: List[str] = [r[0] for r in conn.execute("SELECT DISTINCT session_id FROM messages")]
+    total_before = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    duplicates = 0
+
+    for i in range(0, len(session_ids), batch_sessions):
+        chunk = session_ids[i:i + batch_sessions]
+        where = _DUPLICATE_WHERE.format(placeholders=",".join("?" * len(chunk)))
+        if dry_run:
+            duplicates += conn.execute(f"SELECT COUNT(*) FROM messages m WHERE {where}", chunk).fetchone()[0]
+            continue
+        # Lotes cortos: el servicio puede seguir escribiendo entre un lote y otro
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                f"DELETE FROM messages WHERE id IN (SELECT m.id FROM messages m WHERE {where})",
+                chunk,
+            )
+            duplicates += cursor.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"🧹 Sesiones {i + len(chunk)}/{len(session_ids)}: {duplicates} duplicados eliminados")
+
+    return {
+        "sessions": len(session_ids),
+        "messages_before": total_before,
+        "duplicates": duplicates,
+        "messages_after": total_before - (0 if dry_run else duplicates),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Eliminar mensajes duplicados de chatbot.db")
+    parser.add_argument("--db", default="chatbot.db", help="Ruta de la base de datos SQLite")
+    parser.add_argument("--batch-sessions", type=int, default=100, help="Sesiones por transacción")
+    parser.add_argument("--dry-run", action="store_true", help="Solo contar duplicados, sin borrar")
+    parser.add_argument("--vacuum", action="store_true", help="Ejecutar VACUUM al terminar (bloquea la base de datos)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(args.db, timeout=30.0, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Asegura la columna message_uid y el índice (session_id, timestamp)
+        apply_migrations_conn(conn)
+        start = time.time()
+        report = compact_messages(conn, batch_sessions=max(1, args.batch_sessions), dry_run=args.dry_run)
+        accion = "encontrados" if args.dry_run else "eliminados"
+        print(
+            f"📦 {args.db}: {report['sessions']} sesiones, {report['messages_before']} mensajes, "
+            f"{report['duplicates']} duplicados {accion}, {report['messages_after']} restantes "
+            f"({time.time() - start:.1f}s)"
+        )
+        if not args.dry_run and report["duplicates"]:
+            conn.execute("ANALYZE")
+            if args.vacuum:
+                print("🗜️ Ejecutando VACUUM...")
+                conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Ensamblado del contexto de los prompts de chat con presupuesto de tokens
+Sustituye las reglas fijas (últimos 3-5 mensajes) por un empaquetado por prioridad con
+conteos reales del tokenizer local (cacheados por contenido en TokenCounter).
+
+Prioridad (de mayor a menor):
+1. System prompt (obligatorio)
+2. Mensaje actual del usuario (obligatorio; se recorta en frontera de token si no cabe)
+3. Contexto de entidades (se añade al system, con tope propio)
+4. Historial, del más reciente al más antiguo (el más antiguo que no cabe entero se recorta)
+5. Ejemplos few-shot (solo pares completos)
+
+- CHATBOT_MAX_MODEL_LEN: contexto máximo del modelo en vLLM (--max-model-len)
+- CHATBOT_CONTEXT_BUDGET: tope de tokens del prompt (0 = max_model_len - max_tokens de la respuesta)
+- CHATBOT_CONTEXT_HISTORY_TOKENS / CHATBOT_CONTEXT_ENTITY_TOKENS: topes del historial y de las entidades,
+  para no pagar prefill por contexto que apenas aporta
+"""
+
+import logging
+import os
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from token_counter import get_token_counter
+
+logger = logging.getLogger(__name__)
+
+MAX_MODEL_LEN = int(os.getenv("CHATBOT_MAX_MODEL_LEN", "8192"))
+CONTEXT_BUDGET = int(os.getenv("CHATBOT_CONTEXT_BUDGET", "0"))
+CONTEXT_HISTORY_TOKENS = int(os.getenv("CHATBOT_CONTEXT_HISTORY_TOKENS", "1536"))
+CONTEXT_ENTITY_TOKENS = int(os.getenv("CHATBOT_CONTEXT_ENTITY_TOKENS", "256"))
+# Margen para el error del conteo (más amplio con la aproximación de caracteres)
+CONTEXT_SAFETY_TOKENS = int(os.getenv("CHATBOT_CONTEXT_SAFETY_TOKENS", "32"))
+APPROX_SAFETY_RATIO = 0.15
+# Un mensaje recortado por debajo de esto no aporta: se descarta
+MIN_TRUNCATED_TOKENS = 48
+TRUNCATION_MARK = " […]"
+
+# Mensaje en formato de chat: (rol, contenido) con rol system/user/assistant
+ChatTurn = Tuple[str, str]
+
+
+class AssembledContext(NamedTuple):
+    messages: List[ChatTurn]
+    breakdown: Dict[str, Any]
+
+
+class ContextAssembler:
+    """Empaqueta system, entidades, few-shot e historial dentro del presupuesto de tokens"""
+
+    def __init__(
+        self,
+        max_model_len: int = MAX_MODEL_LEN,
+        budget: int = CONTEXT_BUDGET,
+        history_tokens: int = CONTEXT_HISTORY_TOKENS,
+        entity_tokens: int = CONTEXT_ENTITY_TOKENS,
+    ):
+        self.max_model_len = max_model_len
+        self.budget = budget
+        self.history_tokens = history_tokens
+        self.entity_tokens = entity_tokens
+        self._lock = threading.Lock()
+        self.stats = {"assembled": 0, "truncated": 0, "history_dropped": 0}
+
+    def prompt_budget(self, max_tokens: int, reserved_tokens: int = 0) -> int:
+        """Tokens disponibles para el prompt dejando sitio a la respuesta (y a imágenes u otros reservados)"""
+        counter = get_token_counter()
+        available = self.max_model_len - max_tokens - reserved_tokens
+        if self.budget > 0:
+            available = min(available, self.budget)
+        safety = CONTEXT_SAFETY_TOKENS if counter.exact else max(CONTEXT_SAFETY_TOKENS, int(available * APPROX_SAFETY_RATIO))
+        return max(0, available - safety)
+
+    def assemble(
+        self,
+        system_prompt: str,
+        user_message: str,
+        history: Sequence[ChatTurn] = (),
+        entity_context: str = "",
+        few_shots: Sequence[Dict[str, str]] = (),
+        max_tokens: int = 2048,
+        reserved_tokens: int = 0,
+        truncate_history: bool = True,
+    ) -> AssembledContext:
+        """Mensajes [system, few-shot..., historial..., user] que caben en el presupuesto
+
+        El historial conserva el orden cronológico y empieza siempre por un mensaje del usuario
+        (el chat template de MedGemma exige alternancia user/assistant tras el system).
+        Con truncate_history=False el mensaje más antiguo que no cabe se descarta en vez de
+        recortarse (un recorte distinto en cada turno rompería el prefijo cacheado).
+        """
+        counter = get_token_counter()
+        budget = self.prompt_budget(max_tokens, reserved_tokens)
+        turn_tokens = counter.turn_overhead
+        overhead = counter.bos_tokens + counter.generation_prompt_tokens + 2 * turn_tokens
+        remaining = budget - overhead
+        truncated: List[str] = []
+
+        # 1-2. System y mensaje actual: obligatorios; el system nunca se come más de la mitad
+        system_prompt = system_prompt or ""
+        system_tokens = counter.count_text(system_prompt)
+        if system_tokens > remaining // 2:
+            system_prompt = counter.truncate_text(system_prompt, max(0, remaining // 2))
+            system_tokens = counter.count_text(system_prompt)
+            truncated.append("system")
+        remaining -= system_tokens
+
+        user_tokens = counter.count_text(user_message)
+        if user_tokens > remaining:
+            user_message = counter.truncate_text(user_message, max(0, remaining - counter.count_text(TRUNCATION_MARK))) + TRUNCATION_MARK
+            user_tokens = counter.count_text(user_message)
+            truncated.append("user")
+            logger.warning(f"⚠️ Mensaje del usuario recortado a {user_tokens} tokens para caber en el contexto ({budget})")
+        remaining -= user_tokens
+
+        # 3. Entidades, dentro del system
+        entity_tokens = 0
+        if entity_context and remaining > 0:
+            entity_context = "\n\n" + entity_context.strip()
+            cap = min(self.entity_tokens, remaining)
+            entity_tokens = counter.count_text(entity_context)
+            if entity_tokens > cap:
+                entity_context = counter.truncate_text(entity_context, cap)
+                entity_tokens = counter.count_text(entity_context)
+                truncated.append("entity_context")
+            if entity_tokens:
+                system_prompt += entity_context
+                remaining -= entity_tokens
+
+        # 4. Historial del más reciente al más antiguo
+        history_budget = min(self.history_tokens, max(0, remaining))
+        selected: List[Tuple[ChatTurn, int]] = []
+        for role, content in reversed(list(history)):
+            content = content or ""
+            cost = counter.count_text(content) + turn_tokens
+            if cost <= history_budget:
+                selected.append(((role, content), cost))
+                history_budget -= cost
+                continue
+            room = history_budget - turn_tokens - counter.count_text(TRUNCATION_MARK)
+            if truncate_history and room >= MIN_TRUNCATED_TOKENS:
+                content = counter.truncate_text(content, room) + TRUNCATION_MARK
+                cost = counter.count_text(content) + turn_tokens
+                selected.append(((role, content), cost))
+                history_budget -= cost
+                truncated.append("history")
+            break
+        selected.reverse()
+        # El historial debe empezar por user para que los roles alternen
+        while selected and selected[0][0][0] != "user":
+            selected.pop(0)
+        history_used = sum(cost for _, cost in selected)
+        history_dropped = len(history) - len(selected)
+        remaining -= history_used
+
+        # 5. Few-shot: solo pares completos y solo si sobra presupuesto
+        few_shot_turns: List[ChatTurn] = []
+        few_shot_tokens = 0
+        for example in few_shots:
+            if not (example.get("user") and example.get("assistant")):
+                continue
+            cost = counter.count_text(example["user"]) + counter.count_text(example["assistant"]) + 2 * turn_tokens
+            if cost > remaining:
+                break
+            few_shot_turns.extend([("user", example["user"]), ("assistant", example["assistant"])])
+            few_shot_tokens += cost
+            remaining -= cost
+
+        messages: List[ChatTurn] = [("system", system_prompt.strip())]
+        messages.extend(few_shot_turns)
+        messages.extend(turn for turn, _ in selected)
+        messages.append(("user", user_message))
+
+        breakdown = {
+            "budget": budget,
+            "total": budget - remaining,
+            "system": system_tokens,
+            "entity_context": entity_tokens,
+            "few_shots": few_shot_tokens,
+            "history": history_used,
+            "history_messages": len(selected),
+            "history_dropped": history_dropped,
+            "user": user_tokens,
+            "overhead": overhead,
+            "truncated": truncated,
+            "exact": counter.exact,
+        }
+        with self._lock:
+            self.stats["assembled"] += 1
+            self.stats["history_dropped"] += history_dropped
+            if truncated:
+                self.stats["truncated"] += 1
+        return AssembledContext(messages, breakdown)
+
+
+# Instancia global
+_context_assembler: Optional[ContextAssembler] = None
+_context_assembler_lock = threading.Lock()
+
+
+def get_context_assembler() -> ContextAssembler:
+    """Obtener el ensamblador de contexto compartido del proceso"""
+    global _context_assembler
+    if _context_assembler is None:
+        with _context_assembler_lock:
+            if _context_assembler is None:
+                _context_assembler = ContextAssembler()
+    return _context_assembler
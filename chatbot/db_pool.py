@@ -0,0 +1,203 @@
+"""
+Pool de conexiones SQLite para el Chatbot IMSS
+Conexiones reutilizables en modo WAL con API síncrona y asíncrona (executor)
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Configuración del pool (ajustable por variables de entorno)
+DB_POOL_SIZE = int(os.getenv("CHATBOT_DB_POOL_SIZE", "8"))
+DB_CACHED_STATEMENTS = int(os.getenv("CHATBOT_DB_CACHED_STATEMENTS", "256"))  # Sentencias preparadas por conexión
+DB_BUSY_TIMEOUT_MS = int(os.getenv("CHATBOT_DB_BUSY_TIMEOUT_MS", "5000"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("CHATBOT_DB_ACQUIRE_TIMEOUT", "10"))
+DB_SYNCHRONOUS = os.getenv("CHATBOT_DB_SYNCHRONOUS", "NORMAL").upper()
+
+
+class SQLitePool:
+    """Pool de conexiones SQLite compartido por MemoryManager y AuthManager
+
+    - journal_mode=WAL: lectores concurrentes sin bloquear al escritor
+    - synchronous=NORMAL: un fsync por checkpoint en lugar de uno por commit
+    - cached_statements: sqlite3 reutiliza las sentencias preparadas por conexión
+    - Las operaciones async se ejecutan en un executor dedicado para no bloquear el event loop
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        size: int = DB_POOL_SIZE,
+        cached_statements: int = DB_CACHED_STATEMENTS,
+        busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS,
+    ):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.cached_statements = cached_statements
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # Un hilo por conexión: nunca hay más trabajos concurrentes que conexiones disponibles
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="sqlite-pool")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Crear una conexión nueva con los PRAGMAs de rendimiento"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000.0,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        """Obtener una conexión libre (o crear una si no se alcanzó el tamaño máximo)"""
+        if self._closed:
+            raise RuntimeError("El pool de SQLite está cerrado")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = self._connect()
+                self._all.append(conn)
+                return conn
+        try:
+            return self._idle.get(timeout=DB_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError(f"No hay conexiones SQLite disponibles tras {DB_ACQUIRE_TIMEOUT}s")
+
+    def _release(self, conn: sqlite3.Connection):
+        """Devolver la conexión al pool descartando transacciones pendientes"""
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Context manager para usar una conexión del pool"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Context manager con commit al salir (rollback si hay excepción)"""
+        with self.connection() as conn:
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    # --- API síncrona ---
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """Ejecutar una sentencia de escritura y devolver rowcount"""
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        """Ejecutar una sentencia para varios parámetros en una sola transacción"""
+        with self.transaction() as conn:
+            return conn.executemany(sql, seq_of_params).rowcount
+
+    def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        """Consultar una fila"""
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        """Consultar todas las filas"""
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def fetchall_dict(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        """Consultar filas como diccionarios {columna: valor}"""
+        with self.connection() as conn:
+            cursor = conn.execute(sql, params)
+            cols = [c[0] for c in cursor.description]
+            return [dict(zip(cols, r)) for r in cursor.fetchall()]
+
+    # --- API asíncrona (executor) ---
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Ejecutar una función bloqueante en el executor del pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def execute_async(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return await self.run(self.execute, sql, params)
+
+    async def executemany_async(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        return await self.run(self.executemany, sql, list(seq_of_params))
+
+    async def fetchone_async(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        return await self.run(self.fetchone, sql, params)
+
+    async def fetchall_async(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return await self.run(self.fetchall, sql, params)
+
+    async def fetchall_dict_async(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        return await self.run(self.fetchall_dict, sql, params)
+
+    def close(self):
+        """Cerrar todas las conexiones y el executor"""
+        self._closed = True
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._all:
+                try:
+                    conn.close()
+                except Exception as e:
+                    logger.warning(f"⚠️ Error cerrando conexión SQLite: {e}")
+            self._all.clear()
+        logger.info(f"✅ Pool SQLite cerrado: {self.db_path}")
+
+
+# Pools globales por archivo de base de datos
+_pools: Dict[str, SQLitePool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str = "chatbot.db") -> SQLitePool:
+    """Obtener el pool compartido para un archivo de base de datos"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._closed:
+            pool = SQLitePool(db_path)
+            _pools[key] = pool
+            logger.info(f"✅ Pool SQLite inicializado (WAL, {pool.size} conexiones): {db_path}")
+        return pool
+
+
+def close_all_pools():
+    """Cerrar todos los pools (usar en el shutdown de la aplicación)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
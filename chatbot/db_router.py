@@ -0,0 +1,281 @@
+"""
+Enrutador de bases de datos SQLite para el Chatbot IMSS
+Reparte los datos en varios archivos para que cada dominio tenga su propio lock de escritura.
+
+Modos (CHATBOT_DB_PARTITIONING):
+- "single": todo en chatbot.db (por defecto, compatible con despliegues existentes)
+- "domain": un archivo por dominio
+    chatbot_auth.db     users, user_sessions, session_directory
+    chatbot_metrics.db  metrics y rollups
+    chatbot_chat.db     conversations, messages, conversation_memory
+                        (chatbot_chat_0.db ... chatbot_chat_{N-1}.db con CHATBOT_DB_CHAT_SHARDS=N)
+
+Con shards, cada conversación vive en el shard de su user_id (crc32 % N); el mapa
+session_id -> shard se guarda en session_directory. Las sesiones sin entrada (p. ej. temp_*)
+usan crc32(session_id) % N, y se quedan en ese shard si ya tienen datos al registrarse.
+
+Uso (copiar una chatbot.db existente a los archivos particionados):
+    CHATBOT_DB_PARTITIONING=domain CHATBOT_DB_CHAT_SHARDS=4 python db_router.py --split chatbot.db
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+from db_pool import SQLitePool, get_pool
+from metrics_rollup import rebuild_rollups
+from migrations import apply_migrations, apply_migrations_conn
+
+logger = logging.getLogger(__name__)
+
+DB_PARTITIONING = os.getenv("CHATBOT_DB_PARTITIONING", "single").lower()
+DB_CHAT_SHARDS = max(1, int(os.getenv("CHATBOT_DB_CHAT_SHARDS", "1")))
+
+# Tablas por dominio (para --split); los rollups se recalculan desde metrics
+CHAT_TABLES = ("conversations", "messages", "conversation_memory", "message_archive")
+AUTH_TABLES = ("users", "user_sessions")
+METRICS_TABLES = ("metrics",)
+
+
+def _shard_index(key: str, shards: int) -> int:
+    return zlib.crc32(key.encode("utf-8")) % shards if shards > 1 else 0
+
+
+class DBRouter:
+    """Elige el pool SQLite de cada operación según dominio y shard"""
+
+    def __init__(self, db_path: str = "chatbot.db", partitioning: str = DB_PARTITIONING, chat_shards: int = DB_CHAT_SHARDS):
+        if partitioning not in ("single", "domain"):
+            logger.warning(f"⚠️ Particionado desconocido '{partitioning}', usando 'single'")
+            partitioning = "single"
+        self.db_path = db_path
+        self.partitioning = partitioning
+        stem, ext = os.path.splitext(db_path)
+        ext = ext or ".db"
+        if partitioning == "single":
+            self.chat_shards = 1
+            self.auth_path = self.metrics_path = db_path
+            self.chat_paths = [db_path]
+        else:
+            self.chat_shards = max(1, chat_shards)
+            self.auth_path = f"{stem}_auth{ext}"
+            self.metrics_path = f"{stem}_metrics{ext}"
+            self.chat_paths = (
+                [f"{stem}_chat{ext}"] if self.chat_shards == 1
+                else [f"{stem}_chat_{i}{ext}" for i in range(self.chat_shards)]
+            )
+        self.auth_pool: SQLitePool = get_pool(self.auth_path)
+        self.metrics_pool: SQLitePool = get_pool(self.metrics_path)
+        self.chat_pools: List[SQLitePool] = [get_pool(p) for p in self.chat_paths]
+        # session_id -> shard (las entradas no cambian; tamaño acotado)
+        self._directory_cache: Dict[str, int] = {}
+        self._directory_lock = threading.Lock()
+
+    def all_pools(self) -> List[SQLitePool]:
+        """Pools distintos (un archivo aparece una sola vez)"""
+        seen: Dict[str, SQLitePool] = {}
+        for pool in [self.auth_pool, self.metrics_pool, *self.chat_pools]:
+            seen.setdefault(os.path.abspath(pool.db_path), pool)
+        return list(seen.values())
+
+    def apply_migrations(self) -> List[int]:
+        """Mismo esquema en todos los archivos (las tablas de otros dominios quedan vacías)"""
+        applied: List[int] = []
+        for pool in self.all_pools():
+            applied.extend(apply_migrations(pool))
+        return applied
+
+    # --- Enrutamiento de chat ---
+
+    def shard_for_user(self, user_id: Optional[str]) -> int:
+        return _shard_index(user_id or "", self.chat_shards)
+
+    def shard_for_session(self, session_id: str) -> int:
+        if self.chat_shards == 1:
+            return 0
+        shard = self._directory_cache.get(session_id)
+        if shard is not None:
+            return shard
+        row = self.auth_pool.fetchone("SELECT shard FROM session_directory WHERE session_id = ?", (session_id,))
+        shard = row[0] if row else _shard_index(session_id, self.chat_shards)
+        if row:
+            self._remember(session_id, shard)
+        return shard
+
+    def pool_for_session(self, session_id: str) -> SQLitePool:
+        return self.chat_pools[self.shard_for_session(session_id)]
+
+    def cached_pool_for_session(self, session_id: str) -> Optional[SQLitePool]:
+        """Pool de la sesión sin consultar SQLite (None si hay que leer session_directory)"""
+        if self.chat_shards == 1:
+            return self.chat_pools[0]
+        shard = self._directory_cache.get(session_id)
+        return self.chat_pools[shard] if shard is not None else None
+
+    def pool_for_user(self, user_id: Optional[str]) -> SQLitePool:
+        return self.chat_pools[self.shard_for_user(user_id)]
+
+    def assign_session(self, session_id: str, user_id: Optional[str]) -> SQLitePool:
+        """Registrar en qué shard vive una conversación nueva (la primera asignación gana)"""
+        if self.chat_shards == 1:
+            return self.chat_pools[0]
+        # Ya registrada: ensure_conversation se llama en cada mensaje, no reescribir el directorio
+        if session_id in self._directory_cache:
+            return self.pool_for_session(session_id)
+        self.auth_pool.execute(
+            "INSERT OR IGNORE INTO session_directory (session_id, shard) VALUES (?, ?)",
+            (session_id, self._initial_shard(session_id, user_id)),
+        )
+        return self.pool_for_session(session_id)
+
+    def _initial_shard(self, session_id: str, user_id: Optional[str]) -> int:
+        """Shard que se registra para una sesión: el del usuario salvo que ya tenga datos
+
+        Sin entrada en el directorio la sesión se lee y escribe en crc32(session_id); si ya hay
+        filas ahí, registrar otro shard las dejaría huérfanas.
+        """
+        fallback = _shard_index(session_id, self.chat_shards)
+        has_data = self.chat_pools[fallback].fetchone("""
+            SELECT 1 FROM messages WHERE session_id = ?
+            UNION ALL SELECT 1 FROM conversations WHERE id = ?
+            UNION ALL SELECT 1 FROM conversation_memory WHERE session_id = ?
+            LIMIT 1
+        """, (session_id, session_id, session_id))
+        return fallback if has_data else self.shard_for_user(user_id)
+
+    def forget_sessions(self, session_ids: List[str]):
+        """Eliminar sesiones borradas del directorio"""
+        if self.chat_shards == 1 or not session_ids:
+            return
+        self.auth_pool.executemany("DELETE FROM session_directory WHERE session_id = ?", [(s,) for s in session_ids])
+        with self._directory_lock:
+            for session_id in session_ids:
+                self._directory_cache.pop(session_id, None)
+
+    def _remember(self, session_id: str, shard: int):
+        with self._directory_lock:
+            if len(self._directory_cache) >= 100_000:
+                self._directory_cache.clear()
+            self._directory_cache[session_id] = shard
+
+
+# Routers globales por ruta base
+_routers: Dict[str, DBRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(db_path: str = "chatbot.db") -> DBRouter:
+    """Obtener el enrutador compartido para una ruta base (aplica migraciones al crearlo)"""
+    key = os.path.abspath(db_path)
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None or any(p._closed for p in router.all_pools()):
+            router = DBRouter(db_path)
+            router.apply_migrations()
+            _routers[key] = router
+            logger.info(
+                f"✅ Enrutador SQLite ({router.partitioning}): auth={router.auth_path}, "
+                f"metrics={router.metrics_path}, chat={len(router.chat_paths)} shard(s)"
+            )
+        return router
+
+
+def _copy_tables(target_path: str, source_path: str, tables, where: str = ""):
+    """INSERT ... SELECT desde la base de origen adjunta (una transacción por archivo)"""
+    conn = sqlite3.connect(target_path, timeout=30.0, isolation_level=None)
+    try:
+        apply_migrations_conn(conn)
+        conn.execute("ATTACH DATABASE ? AS src", (source_path,))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table, key in tables:
+                cols = [r[1] for r in conn.execute(f"PRAGMA src.table_info({table})")]
+                if not cols:
+                    continue
+                col_list = ", ".join(cols)
+                table_where = where.format(key=key) if where else ""
+                conn.execute(
+                    f"INSERT OR IGNORE INTO main.{table} ({col_list}) "
+                    f"SELECT {col_list} FROM src.{table} {table_where}"
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        conn.execute("DETACH DATABASE src")
+    finally:
+        conn.close()
+
+
+def split_database(source_path: str, router: DBRouter) -> Dict[int, int]:
+    """Copiar una chatbot.db de un solo archivo a los archivos particionados del router
+
+    Devuelve el número de conversaciones copiadas por shard.
+    """
+    _copy_tables(router.auth_path, source_path, [(t, None) for t in AUTH_TABLES])
+    _copy_tables(router.metrics_path, source_path, [(t, None) for t in METRICS_TABLES])
+    # Los rollups se recalculan a partir de metrics en el archivo destino
+    with router.metrics_pool.transaction() as conn:
+        rebuild_rollups(conn)
+
+    src = sqlite3.connect(source_path)
+    try:
+        owners = src.execute("SELECT id, user_id FROM conversations").fetchall()
+    finally:
+        src.close()
+    by_shard: Dict[int, List[str]] = {}
+    for session_id, user_id in owners:
+        by_shard.setdefault(router.shard_for_user(user_id), []).append(session_id)
+    if router.chat_shards > 1:
+        router.auth_pool.executemany(
+            "INSERT OR IGNORE INTO session_directory (session_id, shard) VALUES (?, ?)",
+            [(s, shard) for shard, ids in by_shard.items() for s in ids],
+        )
+
+    chat_tables = [(t, "id" if t == "conversations" else "session_id") for t in CHAT_TABLES]
+    for shard, path in enumerate(router.chat_paths):
+        ids = by_shard.get(shard, [])
+        # Lista de sesiones del shard en una tabla auxiliar para filtrar todas las tablas de chat
+        conn = sqlite3.connect(path, timeout=30.0)
+        try:
+            apply_migrations_conn(conn)
+            conn.execute("DROP TABLE IF EXISTS _split_sessions")
+            conn.execute("CREATE TABLE _split_sessions (id TEXT PRIMARY KEY)")
+            conn.executemany("INSERT INTO _split_sessions (id) VALUES (?)", [(s,) for s in ids])
+            conn.commit()
+        finally:
+            conn.close()
+        _copy_tables(path, source_path, chat_tables, where="WHERE {key} IN (SELECT id FROM main._split_sessions)")
+        conn = sqlite3.connect(path, timeout=30.0)
+        try:
+            conn.execute("DROP TABLE _split_sessions")
+            conn.commit()
+        finally:
+            conn.close()
+        logger.info(f"✅ Shard {shard}: {len(ids)} conversaciones copiadas a {path}")
+    return {shard: len(by_shard.get(shard, [])) for shard in range(router.chat_shards)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Particionado de chatbot.db")
+    parser.add_argument("--db", default="chatbot.db", help="Ruta base de las bases de datos")
+    parser.add_argument("--split", metavar="ORIGEN", help="Copiar una chatbot.db de un solo archivo a las particiones")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    router = get_router(args.db)
+    print(f"📦 Modo {router.partitioning}: auth={router.auth_path}, metrics={router.metrics_path}, chat={router.chat_paths}")
+    if args.split:
+        if router.partitioning == "single":
+            print("⚠️ CHATBOT_DB_PARTITIONING=single: no hay nada que particionar")
+            return
+        copied = split_database(args.split, router)
+        print(f"✅ Conversaciones por shard: {copied} (los mensajes sin conversación no se copian)")
+
+
+if __name__ == "__main__":
+    main()
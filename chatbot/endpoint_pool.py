@@ -0,0 +1,227 @@
+"""
+Pool de endpoints OpenAI-compatibles (réplicas de vLLM) para el Chatbot IMSS
+Reparte las peticiones de FallbackLLM entre varias réplicas con salud por endpoint.
+
+- CHATBOT_VLLM_ENDPOINTS: lista separada por comas (por defecto solo VLLM_ENDPOINT)
+- CHATBOT_LB_STRATEGY: "least_outstanding" (menos peticiones en curso) o "ewma" (menor latencia
+  al primer token, ponderada por las peticiones en curso)
+- Circuit breaker por endpoint: se abre tras N fallos consecutivos y, pasado el enfriamiento,
+  deja pasar una sola petición de prueba (half-open) antes de cerrarse
+- Expulsión pasiva de outliers: un endpoint cuya latencia EWMA supera CHATBOT_LB_OUTLIER_FACTOR
+  veces la mediana del pool se expulsa temporalmente (tiempo creciente con cada expulsión),
+  sin dejar nunca el pool sin endpoints disponibles
+"""
+
+import logging
+import os
+import statistics
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+LB_STRATEGY = os.getenv("CHATBOT_LB_STRATEGY", "least_outstanding").lower()
+LB_FAILURE_THRESHOLD = int(os.getenv("CHATBOT_LB_FAILURE_THRESHOLD", "5"))
+LB_OPEN_SECONDS = float(os.getenv("CHATBOT_LB_OPEN_SECONDS", "30"))
+LB_EWMA_ALPHA = float(os.getenv("CHATBOT_LB_EWMA_ALPHA", "0.3"))
+LB_OUTLIER_FACTOR = float(os.getenv("CHATBOT_LB_OUTLIER_FACTOR", "3.0"))
+LB_OUTLIER_MIN_SAMPLES = int(os.getenv("CHATBOT_LB_OUTLIER_MIN_SAMPLES", "10"))
+LB_EJECTION_SECONDS = float(os.getenv("CHATBOT_LB_EJECTION_SECONDS", "30"))
+LB_MAX_EJECTION_PERCENT = int(os.getenv("CHATBOT_LB_MAX_EJECTION_PERCENT", "50"))
+
+STRATEGIES = ("least_outstanding", "ewma")
+
+
+class NoHealthyEndpoint(Exception):
+    """Todos los endpoints tienen el circuit breaker abierto"""
+
+
+def normalize_endpoint(url: str) -> str:
+    """Asegurar que el endpoint termine en /v1/ (compatibilidad con la API de OpenAI)"""
+    url = url.strip()
+    if url.endswith("/v1/"):
+        return url
+    return url.rstrip("/") + ("/" if url.rstrip("/").endswith("/v1") else "/v1/")
+
+
+class Endpoint:
+    """Estado de salud y carga de una réplica"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.ewma_latency: Optional[float] = None  # segundos hasta el primer token / respuesta
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.half_open_probe = False
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.requests = 0
+        self.failures = 0
+
+    def available(self, now: float) -> bool:
+        if now < self.ejected_until:
+            return False
+        if self.open_until:
+            # Abierto: solo una petición de prueba cuando vence el enfriamiento
+            return now >= self.open_until and not self.half_open_probe
+        return True
+
+    def score(self, strategy: str) -> float:
+        if strategy == "ewma":
+            # Sin muestras: latencia 0 para que reciba tráfico y se mida
+            return (self.ewma_latency or 0.0) * (self.in_flight + 1)
+        return float(self.in_flight)
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        if now < self.ejected_until:
+            state = "ejected"
+        elif self.open_until:
+            state = "half_open" if now >= self.open_until else "open"
+        else:
+            state = "closed"
+        return {
+            "url": self.url,
+            "state": state,
+            "in_flight": self.in_flight,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+        }
+
+
+class EndpointPool:
+    """Selección de endpoint y registro de resultados (thread-safe)"""
+
+    def __init__(self, urls: Iterable[str], strategy: str = LB_STRATEGY):
+        if strategy not in STRATEGIES:
+            logger.warning(f"⚠️ Estrategia de balanceo desconocida '{strategy}', usando 'least_outstanding'")
+            strategy = "least_outstanding"
+        self.strategy = strategy
+        self.endpoints: List[Endpoint] = []
+        for url in urls:
+            url = normalize_endpoint(url)
+            if url and all(ep.url != url for ep in self.endpoints):
+                self.endpoints.append(Endpoint(url))
+        if not self.endpoints:
+            raise ValueError("Se requiere al menos un endpoint")
+        self._lock = threading.Lock()
+        self._rr = 0
+        # request_id -> endpoint que lo atiende (para cancelar en la réplica correcta)
+        self._assignments: Dict[str, Endpoint] = {}
+
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+
+    def acquire(self, exclude: Iterable[Endpoint] = (), request_id: Optional[str] = None) -> Endpoint:
+        """Elegir un endpoint (excluyendo los ya intentados) y contar la petición en curso"""
+        excluded = set(id(ep) for ep in exclude)
+        now = time.monotonic()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if id(ep) not in excluded and ep.available(now)]
+            if not candidates:
+                raise NoHealthyEndpoint(
+                    "Circuit breaker is open. Server may be overloaded. Please try again later."
+                )
+            # Desempate round-robin para repartir entre endpoints con la misma puntuación
+            self._rr = (self._rr + 1) % len(self.endpoints)
+            ep = min(
+                candidates,
+                key=lambda e: (e.score(self.strategy), (self.endpoints.index(e) - self._rr) % len(self.endpoints)),
+            )
+            if ep.open_until:
+                ep.half_open_probe = True
+                logger.info(f"🔎 Petición de prueba (half-open) a {ep.url}")
+            ep.in_flight += 1
+            ep.requests += 1
+            if request_id:
+                self._assignments[request_id] = ep
+            return ep
+
+    def release(self, ep: Endpoint, success: Optional[bool], latency: Optional[float] = None, request_id: Optional[str] = None):
+        """Registrar el resultado de una petición iniciada con acquire()
+
+        success=None: la petición terminó sin decir nada de la salud del endpoint
+        (cliente desconectado, error 4xx); solo libera la plaza y la prueba half-open.
+        """
+        now = time.monotonic()
+        with self._lock:
+            ep.in_flight = max(0, ep.in_flight - 1)
+            if request_id:
+                self._assignments.pop(request_id, None)
+            if success is None:
+                ep.half_open_probe = False
+                return
+            if success:
+                if ep.open_until:
+                    logger.info(f"✅ Circuit breaker cerrado para {ep.url}")
+                ep.consecutive_failures = 0
+                ep.open_until = 0.0
+                ep.half_open_probe = False
+                if latency is not None:
+                    ep.ewma_latency = latency if ep.ewma_latency is None else (
+                        LB_EWMA_ALPHA * latency + (1 - LB_EWMA_ALPHA) * ep.ewma_latency
+                    )
+                    ep.samples += 1
+                    self._check_outlier(ep, now)
+                return
+            ep.failures += 1
+            ep.consecutive_failures += 1
+            if ep.half_open_probe or ep.consecutive_failures >= LB_FAILURE_THRESHOLD:
+                ep.open_until = now + LB_OPEN_SECONDS
+                ep.half_open_probe = False
+                logger.warning(
+                    f"⚠️ Circuit breaker abierto para {ep.url} ({ep.consecutive_failures} fallos consecutivos). "
+                    f"Reintentando en {LB_OPEN_SECONDS:.0f}s"
+                )
+
+    def _check_outlier(self, ep: Endpoint, now: float):
+        """Expulsar temporalmente un endpoint mucho más lento que el resto (con el lock tomado)"""
+        if len(self.endpoints) < 2 or ep.samples < LB_OUTLIER_MIN_SAMPLES:
+            return
+        others = [e.ewma_latency for e in self.endpoints if e is not ep and e.ewma_latency is not None]
+        if not others or ep.ewma_latency <= LB_OUTLIER_FACTOR * statistics.median(others):
+            return
+        ejected = sum(1 for e in self.endpoints if now < e.ejected_until)
+        if (ejected + 1) * 100 > LB_MAX_EJECTION_PERCENT * len(self.endpoints) or ejected + 1 >= len(self.endpoints):
+            return
+        ep.ejections += 1
+        ep.ejected_until = now + LB_EJECTION_SECONDS * ep.ejections
+        # Al volver empieza a medir de nuevo
+        ep.ewma_latency = None
+        ep.samples = 0
+        logger.warning(f"⚠️ Endpoint {ep.url} expulsado {LB_EJECTION_SECONDS * ep.ejections:.0f}s por latencia atípica")
+
+    def endpoint_for(self, request_id: str) -> Optional[Endpoint]:
+        """Endpoint que atiende un request_id en curso"""
+        with self._lock:
+            return self._assignments.get(request_id)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {"strategy": self.strategy, "endpoints": [ep.snapshot(now) for ep in self.endpoints]}
+
+
+# Pools globales por lista de endpoints
+_pools: Dict[str, EndpointPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_endpoint_pool(default_endpoint: str) -> EndpointPool:
+    """Obtener el pool compartido (CHATBOT_VLLM_ENDPOINTS o, si no está, solo default_endpoint)"""
+    configured = [u for u in os.getenv("CHATBOT_VLLM_ENDPOINTS", "").split(",") if u.strip()]
+    urls = configured or [default_endpoint]
+    key = ",".join(normalize_endpoint(u) for u in urls)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = EndpointPool(urls)
+            _pools[key] = pool
+            logger.info(f"✅ Pool de endpoints ({pool.strategy}): {[ep.url for ep in pool.endpoints]}")
+        return pool
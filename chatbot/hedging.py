@@ -0,0 +1,140 @@
+"""
+Peticiones de cobertura (hedging) para el streaming del Chatbot IMSS
+Si el primer token no llega dentro de un umbral adaptativo (percentil del TTFT reciente),
+FallbackLLM lanza la misma petición a otra réplica; gana el stream que produzca antes un token
+y el perdedor se aborta (desconexión + API de cancelación de vLLM).
+
+- CHATBOT_HEDGE=1 lo activa (desactivado por defecto; necesita al menos dos endpoints)
+- CHATBOT_HEDGE_PERCENTILE: percentil del TTFT reciente usado como umbral (0.95)
+- CHATBOT_HEDGE_MAX_PERCENT: presupuesto de carga extra; cada petición aporta ese porcentaje
+  de una petición de cobertura (cubo de fichas)
+"""
+
+import logging
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.getenv("CHATBOT_HEDGE", "0") in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("CHATBOT_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MAX_PERCENT = float(os.getenv("CHATBOT_HEDGE_MAX_PERCENT", "5"))
+HEDGE_WINDOW = int(os.getenv("CHATBOT_HEDGE_WINDOW", "500"))  # TTFT recientes considerados
+HEDGE_MIN_SAMPLES = int(os.getenv("CHATBOT_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("CHATBOT_HEDGE_MIN_DELAY", "0.25"))  # segundos
+HEDGE_MAX_DELAY = float(os.getenv("CHATBOT_HEDGE_MAX_DELAY", "10"))
+# Fichas acumulables: permite ráfagas cortas de coberturas tras un periodo tranquilo
+HEDGE_BURST = 10.0
+
+
+class HedgePolicy:
+    """Umbral adaptativo y presupuesto de las peticiones de cobertura (thread-safe)"""
+
+    def __init__(
+        self,
+        enabled: bool = HEDGE_ENABLED,
+        percentile: float = HEDGE_PERCENTILE,
+        max_percent: float = HEDGE_MAX_PERCENT,
+        window: int = HEDGE_WINDOW,
+    ):
+        self.enabled = enabled
+        self.percentile = min(max(percentile, 0.5), 0.999)
+        self.ratio = max(0.0, max_percent) / 100
+        self._ttft: deque = deque(maxlen=max(1, window))
+        self._sorted_cache: Optional[float] = None
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self.stats_counters = {
+            "requests": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "budget_denied": 0,
+            "losers_cancelled": 0,
+        }
+
+    # --- TTFT ---
+
+    def observe_ttft(self, seconds: float):
+        with self._lock:
+            self._ttft.append(seconds)
+            self._sorted_cache = None
+
+    def delay(self) -> Optional[float]:
+        """Segundos a esperar el primer token antes de cubrir (None: sin datos suficientes o desactivado)"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if len(self._ttft) < HEDGE_MIN_SAMPLES:
+                return None
+            if self._sorted_cache is None:
+                ordered = sorted(self._ttft)
+                self._sorted_cache = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+            return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, self._sorted_cache))
+
+    # --- Presupuesto ---
+
+    def record_request(self):
+        with self._lock:
+            self.stats_counters["requests"] += 1
+            self._tokens = min(HEDGE_BURST, self._tokens + self.ratio)
+
+    def try_hedge(self) -> bool:
+        """Consumir una ficha del presupuesto para lanzar una cobertura"""
+        with self._lock:
+            if self._tokens < 1.0:
+                self.stats_counters["budget_denied"] += 1
+                return False
+            self._tokens -= 1.0
+            self.stats_counters["hedged"] += 1
+            return True
+
+    def refund(self):
+        """Devolver la ficha si no se pudo lanzar la cobertura (sin otro endpoint disponible)"""
+        with self._lock:
+            self._tokens = min(HEDGE_BURST, self._tokens + 1.0)
+            self.stats_counters["hedged"] -= 1
+
+    def record_winner(self, hedge: bool):
+        with self._lock:
+            self.stats_counters["hedge_wins" if hedge else "primary_wins"] += 1
+
+    def record_cancelled(self):
+        with self._lock:
+            self.stats_counters["losers_cancelled"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        delay = self.delay()
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.stats_counters)
+            requests = stats["requests"]
+            stats.update({
+                "enabled": self.enabled,
+                "threshold_ms": round(delay * 1000, 1) if delay is not None else None,
+                "hedge_rate": round(stats["hedged"] / requests, 4) if requests else 0.0,
+                "max_percent": round(self.ratio * 100, 2),
+                "ttft_samples": len(self._ttft),
+            })
+        return stats
+
+
+# Instancia global
+_hedge_policy: Optional[HedgePolicy] = None
+_hedge_policy_lock = threading.Lock()
+
+
+def get_hedge_policy() -> HedgePolicy:
+    """Obtener la política de coberturas del proceso"""
+    global _hedge_policy
+    if _hedge_policy is None:
+        with _hedge_policy_lock:
+            if _hedge_policy is None:
+                _hedge_policy = HedgePolicy()
+                if _hedge_policy.enabled:
+                    logger.info(
+                        f"✅ Hedging activo: p{_hedge_policy.percentile * 100:.0f} del TTFT, "
+                        f"máximo {_hedge_policy.ratio * 100:.1f}% de carga extra"
+                    )
+    return _hedge_policy
@@ -5,13 +5,13 @@ Integración completa con LangChain: ChatMessageHistory, LCEL, Runnables, Output
 """
 
 import logging
-from typing import Dict, List, Optional, Any, AsyncGenerator
+from typing import Dict, List, Optional, Any, AsyncGenerator, Tuple
 import asyncio
 import httpx
-import sqlite3
 import json
 import os
 import time
+import uuid
 
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, BaseMessage, ChatMessage
@@ -32,6 +32,29 @@ from langchain_core.prompts import (
 from langchain_community.chat_message_histories import ChatMessageHistory
 from pydantic import BaseModel, Field
 
+from db_router import get_router
+from memory_manager import message_uid
+from session_cache import (
+    HISTORY_TAIL,
+    CachedHistory,
+    HistoryEntry,
+    append_history_entry,
+    get_session_cache,
+    history_cache_key,
+)
+from context_assembler import ChatTurn
+from endpoint_pool import Endpoint, NoHealthyEndpoint, get_endpoint_pool
+from hedging import get_hedge_policy
+from latency_model import get_latency_model
+from prompt_layout import PromptLayout, load_system_prompt
+from response_cache import get_response_cache
+from security_llm import get_security_manager
+from single_flight import get_single_flight, request_key
+from sse_decoder import DONE, SSEDecoder, parse_delta
+from text_normalizer import StreamNormalizer, fix_fragmented_words, normalize_text
+from token_counter import get_token_counter
+from write_queue import get_write_queue
+
 logger = logging.getLogger(__name__)
 
 
@@ -44,80 +67,175 @@ class MedicalAnalysis(BaseModel):
     nivel_urgencia: str = Field(description="Nivel de urgencia: baja, media, alta")
 
 
+def _to_turns(messages: List[BaseMessage]) -> List[ChatTurn]:
+    """BaseMessage -> (rol, contenido) en formato de chat"""
+    turns = []
+    for m in messages:
+        role = "user"
+        if isinstance(m, SystemMessage):
+            role = "system"
+        elif isinstance(m, AIMessage):
+            role = "assistant"
+        turns.append((role, str(getattr(m, "content", m))))
+    return turns
+
+
+def _from_turns(turns: List[ChatTurn]) -> List[BaseMessage]:
+    """(rol, contenido) -> BaseMessage"""
+    types = {"system": SystemMessage, "assistant": AIMessage}
+    return [types.get(role, HumanMessage)(content=content) for role, content in turns]
+
+
+async def _run_for_session(db_path: str, session_id: str, fn, *args):
+    """Ejecutar SQLite en el executor del shard de la sesión, fuera del event loop"""
+    router = get_router(db_path)
+    pool = router.cached_pool_for_session(session_id)
+    if pool is None:
+        pool = await router.auth_pool.run(router.pool_for_session, session_id)
+    return await pool.run(fn, *args)
+
+
 class SQLiteChatMessageHistory(ChatMessageHistory):
-    """ChatMessageHistory persistido en SQLite - Integración completa con LangChain"""
+    """ChatMessageHistory persistido en SQLite - Integración completa con LangChain
+    
+    Solo mantiene la cola del historial (últimos `tail` mensajes), que es lo que usan
+    los prompts; la cola se comparte entre instancias mediante el cache de sesión y cada
+    uso se valida contra conversations.version (otros workers escriben en la misma sesión).
     
-    def __init__(self, session_id: str, db_path: str = "chatbot.db"):
+    Desde código async usar load_async y add_*_message_async: la carga y las escrituras
+    corren en el executor del shard en vez de bloquear el event loop.
+    """
+    
+    def __init__(self, session_id: str, db_path: str = "chatbot.db", tail: int = HISTORY_TAIL):
         super().__init__()
         # Usar object.__setattr__ para evitar validación de Pydantic v2
         object.__setattr__(self, 'session_id', session_id)
         object.__setattr__(self, 'db_path', db_path)
+        object.__setattr__(self, 'tail', tail)
         self._load_messages()
     
     def _load_messages(self):
-        """Cargar mensajes desde SQLite y convertirlos a BaseMessage"""
+        """Cargar la cola del historial (cache de sesión o SQLite) y convertirla a BaseMessage
+        
+        Hidrata self.messages directamente: no pasa por add_*_message, que persisten,
+        para no volver a insertar el historial en cada carga.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT role, content, metadata
-                FROM messages
-                WHERE session_id = ?
-                ORDER BY timestamp ASC
-            """, (self.session_id,))
+            entries = self._cached_tail()
             
-            for row in cursor.fetchall():
-                role, content, metadata_str = row
-                metadata = json.loads(metadata_str) if metadata_str else {}
-                
+            for _uid, role, content in entries:
                 # Convertir a BaseMessage según el rol
                 if role == "user":
-                    self.add_user_message(content)
+                    self.messages.append(HumanMessage(content=content))
                 elif role == "assistant":
-                    self.add_ai_message(content)
+                    self.messages.append(AIMessage(content=content))
                 elif role == "system":
                     self.messages.append(SystemMessage(content=content))
             
-            conn.close()
-            logger.debug(f"✅ Cargados {len(self.messages)} mensajes desde SQLite para sesión {self.session_id}")
+            logger.debug(f"✅ Cargados {len(self.messages)} mensajes para sesión {self.session_id}")
         except Exception as e:
             logger.error(f"❌ Error cargando mensajes desde SQLite: {e}")
     
-    def add_user_message(self, content: str):
+    def _cached_tail(self) -> List[HistoryEntry]:
+        """Cola cacheada si conversations.version no cambió desde que se leyó (una consulta por PK)"""
+        pool = get_router(self.db_path).pool_for_session(self.session_id)
+        row = pool.fetchone("SELECT version FROM conversations WHERE id = ?", (self.session_id,))
+        if row is None:
+            # Sin fila en conversations (sesiones temp_*) no hay versión que validar: leer SQLite
+            return self._fetch_tail()
+        cache = get_session_cache()
+        key = history_cache_key(self.session_id)
+        cached = cache.get(key)
+        if cached is not None and cached.version == row[0]:
+            return list(cached.messages)
+        entries = self._fetch_tail()
+        cache.put(key, CachedHistory(entries, row[0]))
+        return list(entries)
+    
+    def _fetch_tail(self) -> List[HistoryEntry]:
+        """Leer solo los últimos `tail` mensajes (usa idx_messages_session_ts, sin recorrer toda la sesión)"""
+        pool = get_router(self.db_path).pool_for_session(self.session_id)
+        # Mensajes de este proceso que aún estén en la cola de escritura
+        get_write_queue(pool).flush()
+        rows = pool.fetchall("""
+            SELECT message_uid, role, content
+            FROM messages
+            WHERE session_id = ?
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        """, (self.session_id, self.tail))
+        return [tuple(r) for r in reversed(rows)]
+    
+    @classmethod
+    async def load_async(cls, session_id: str, db_path: str = "chatbot.db", tail: int = HISTORY_TAIL) -> "SQLiteChatMessageHistory":
+        """Crear el historial cargando la cola en el executor del shard"""
+        return await _run_for_session(db_path, session_id, cls, session_id, db_path, tail)
+    
+    async def add_user_message_async(self, content: str, message_id: Optional[str] = None):
+        await _run_for_session(self.db_path, self.session_id, self.add_user_message, content, message_id)
+    
+    async def add_ai_message_async(self, content: str, message_id: Optional[str] = None):
+        await _run_for_session(self.db_path, self.session_id, self.add_ai_message, content, message_id)
+    
+    def add_user_message(self, content: str, message_id: Optional[str] = None):
         """Agregar mensaje de usuario y persistir en SQLite"""
-        super().add_user_message(content)
-        self._persist_message("user", content)
+        # La clase base también delega en add_message: construir el mensaje aquí evita persistirlo dos veces
+        self.add_message(HumanMessage(content=content, id=message_id))
     
-    def add_ai_message(self, content: str):
+    def add_ai_message(self, content: str, message_id: Optional[str] = None):
         """Agregar mensaje de AI y persistir en SQLite"""
-        super().add_ai_message(content)
-        self._persist_message("assistant", content)
+        self.add_message(AIMessage(content=content, id=message_id))
     
     def add_message(self, message: BaseMessage):
         """Agregar mensaje BaseMessage y persistir"""
         super().add_message(message)
         
         # Determinar rol y contenido
+        message_id = getattr(message, "id", None)
         if isinstance(message, HumanMessage):
-            self._persist_message("user", message.content)
+            self._persist_message("user", message.content, message_id)
         elif isinstance(message, AIMessage):
-            self._persist_message("assistant", message.content)
+            self._persist_message("assistant", message.content, message_id)
         elif isinstance(message, SystemMessage):
-            self._persist_message("system", message.content)
+            self._persist_message("system", message.content, message_id)
     
-    def _persist_message(self, role: str, content: str):
-        """Persistir mensaje en SQLite"""
+    def _persist_message(self, role: str, content: str, message_id: Optional[str] = None):
+        """Persistir mensaje en SQLite
+        
+        Con message_id la inserción es idempotente (INSERT OR IGNORE sobre messages.message_uid):
+        reintentos o el guardado paralelo desde main.py no generan filas duplicadas.
+        """
+        inserted = 0
+        version: Optional[int] = None
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO messages (session_id, role, content, timestamp, metadata)
-                VALUES (?, ?, ?, ?, ?)
-            """, (self.session_id, role, content, int(time.time()), json.dumps({})))
-            conn.commit()
-            conn.close()
+            now = int(time.time())
+            with get_router(self.db_path).pool_for_session(self.session_id).transaction() as conn:
+                inserted = conn.execute("""
+                    INSERT OR IGNORE INTO messages (session_id, role, content, timestamp, metadata, message_uid)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (self.session_id, role, content, now, json.dumps({}), message_id)).rowcount
+                if inserted:
+                    # Versión de la sesión (ETag de /api/history)
+                    conn.execute(
+                        "UPDATE conversations SET updated_at = ?, version = version + 1 WHERE id = ?",
+                        (now, self.session_id),
+                    )
+                    row = conn.execute("SELECT version FROM conversations WHERE id = ?", (self.session_id,)).fetchone()
+                    version = row[0] if row else None
         except Exception as e:
             logger.error(f"❌ Error persistiendo mensaje en SQLite: {e}")
+            return
+        
+        def write_through(history: CachedHistory):
+            # Solo si la entrada estaba al día justo antes de esta escritura; si no, se recarga
+            if version is not None and history.version == version - 1:
+                append_history_entry(history.messages, (message_id, role, content), self.tail)
+                history.version = version
+            elif inserted:
+                history.version = None
+        
+        # Write-through a la cola cacheada para las siguientes cargas de la sesión
+        get_session_cache().update(history_cache_key(self.session_id), write_through)
 
 
 class FallbackLLM:
@@ -125,8 +243,8 @@ class FallbackLLM:
     
     Optimizado para aprovechar autoscaling de Ray Serve:
     - Connection pool persistente (singleton)
-    - Timeouts adaptativos basados en tamaño del prompt
-    - Circuit breaker para evitar sobrecarga
+    - Timeouts por fase (connect, primer token, entre tokens) aprendidos por endpoint (LatencyModel)
+    - Varias réplicas (EndpointPool) con circuit breaker y expulsión de outliers por endpoint
     - Backoff exponencial con jitter
     - Respeta headers de rate limiting
     """
@@ -134,15 +252,13 @@ class FallbackLLM:
     # Cliente singleton para connection pool
     _client: Optional[httpx.AsyncClient] = None
     _client_lock = asyncio.Lock()
-    
-    # Circuit breaker state
-    _failure_count = 0
-    _last_failure_time: Optional[float] = None
-    _circuit_open = False
-    _circuit_open_until: Optional[float] = None
+    # Cancelaciones en curso de intentos abortados
+    _background: set = set()
     
     def __init__(self, vllm_endpoint: str = "http://localhost:8000/v1/"):
-        self.vllm_endpoint = vllm_endpoint
+        # Réplicas de vLLM con circuit breaker por endpoint (CHATBOT_VLLM_ENDPOINTS; por defecto solo vllm_endpoint)
+        self.endpoints = get_endpoint_pool(vllm_endpoint)
+        self.vllm_endpoint = self.endpoints.primary.url
         # Configurar ChatOpenAI para usar vLLM con Ray Serve (compatible con OpenAI API)
         self.ollama_llm = ChatOpenAI(
             model="google/medgemma-27b",
@@ -175,63 +291,6 @@ class FallbackLLM:
                     logger.info("✅ Cliente HTTP con connection pool inicializado")
         return cls._client
     
-    @classmethod
-    def _calculate_adaptive_timeout(cls, messages: List[Dict], max_tokens: int) -> float:
-        """Calcular timeout adaptativo basado en el tamaño del prompt y max_tokens"""
-        total_chars = sum(len(m.get("content", "")) for m in messages)
-        estimated_tokens = total_chars // 4  # Aproximación: 4 chars = 1 token
-        
-        # Base timeout: 10 segundos
-        base_timeout = 10.0
-        
-        # Agregar tiempo por token de entrada (0.01s por token)
-        input_time = estimated_tokens * 0.01
-        
-        # Agregar tiempo por token de salida (0.05s por token, más lento)
-        output_time = max_tokens * 0.05
-        
-        # Agregar margen de seguridad (20%)
-        total_timeout = (base_timeout + input_time + output_time) * 1.2
-        
-        # Limitar entre 30s y 300s
-        timeout = max(30.0, min(300.0, total_timeout))
-        logger.debug(f"⏱️ Timeout adaptativo calculado: {timeout:.2f}s (input: {estimated_tokens} tokens, output: {max_tokens} tokens)")
-        return timeout
-    
-    @classmethod
-    def _check_circuit_breaker(cls) -> None:
-        """Verificar si el circuit breaker está abierto"""
-        if cls._circuit_open and cls._circuit_open_until:
-            if time.time() < cls._circuit_open_until:
-                raise Exception("Circuit breaker is open. Server may be overloaded. Please try again later.")
-            else:
-                # Intentar resetear
-                cls._circuit_open = False
-                cls._circuit_open_until = None
-                cls._failure_count = 0
-                logger.info("✅ Circuit breaker reseteado")
-    
-    @classmethod
-    def _record_failure(cls) -> None:
-        """Registrar fallo y abrir circuit breaker si es necesario"""
-        cls._failure_count += 1
-        cls._last_failure_time = time.time()
-        
-        # Si hay 5 fallos consecutivos, abrir circuit breaker por 30 segundos
-        if cls._failure_count >= 5:
-            cls._circuit_open = True
-            cls._circuit_open_until = time.time() + 30.0
-            logger.warning(f"⚠️ Circuit breaker abierto por {cls._failure_count} fallos consecutivos. Reintentando en 30s")
-    
-    @classmethod
-    def _record_success(cls) -> None:
-        """Registrar éxito y resetear contador"""
-        if cls._failure_count > 0:
-            logger.info(f"✅ Request exitoso. Reseteando contador de fallos ({cls._failure_count} → 0)")
-        cls._failure_count = 0
-        cls._circuit_open = False
-        cls._circuit_open_until = None
-    
     async def invoke(self, messages: List[BaseMessage], **kwargs) -> Any:
         """Invocar LLM desde vLLM con Ray Serve"""
         try:
@@ -243,6 +302,26 @@ class FallbackLLM:
             raise
     
     async def stream(self, messages: List[BaseMessage], **kwargs) -> AsyncGenerator[str, None]:
+        """Streaming con coalescencia: peticiones idénticas en curso comparten una sola generación
+        
+        Mismos argumentos que _stream_upstream (incluido usage={} para recibir el usage final).
+        """
+        usage: Optional[Dict[str, Any]] = kwargs.pop('usage', None)
+        # El request_id no forma parte de la clave: peticiones idénticas usan el del primer llamador
+        request_id: Optional[str] = kwargs.pop('request_id', None)
+        key = request_key(
+            self.vllm_endpoint,
+            [{"role": m.type, "content": str(getattr(m, 'content', ''))} for m in messages],
+            kwargs,
+        )
+        async for delta in get_single_flight().stream(
+            key,
+            lambda flight_usage: self._stream_upstream(messages, usage=flight_usage, request_id=request_id, **kwargs),
+            usage,
+        ):
+            yield delta
+    
+    async def _stream_upstream(self, messages: List[BaseMessage], **kwargs) -> AsyncGenerator[str, None]:
         """
         Streaming desde vLLM con Ray Serve - Llamada directa con httpx como curl
         
@@ -250,7 +329,21 @@ class FallbackLLM:
         - Conversión eficiente de mensajes LangChain → OpenAI
         - Manejo robusto de errores con logging detallado
         - Streaming de chunks con max_tokens configurable (2048 por defecto)
+        
+        Si se pasa usage={} se rellena con el usage del último chunk del servidor
+        (stream_options.include_usage) o, si no llega, con el conteo local, y con el resultado:
+        "completed" (True solo si el stream terminó sin error) y "finish_reason" del último chunk.
+        Los errores se devuelven como texto del stream, así que el texto no basta para distinguirlos.
+        
+        request_id se reenvía a vLLM (los reintentos y coberturas llevan un sufijo) para poder
+        abortar la generación si el consumidor deja de leer.
         """
+        usage: Optional[Dict[str, Any]] = kwargs.pop('usage', None)
+        request_id: str = kwargs.pop('request_id', None) or f"chatcmpl-{uuid.uuid4().hex}"
+        if usage is not None:
+            # Fallido hasta que un intento termine bien (también si el consumidor abandona)
+            usage["completed"] = False
+            usage["finish_reason"] = None
         try:
             # Optimización: Conversión directa sin funciones anidadas para mejor rendimiento
             messages_data = []
@@ -291,94 +384,73 @@ class FallbackLLM:
                 "messages": messages_data,
                 "temperature": kwargs.get('temperature', 0.7),
                 "max_tokens": max_tokens,
-                "stream": True
+                "stream": True,
+                # vLLM envía el usage exacto en un último chunk sin choices
+                "stream_options": {"include_usage": True},
             }
             
             logger.debug(f"📦 Payload configurado: model={payload['model']}, max_tokens={max_tokens}, temperature={payload['temperature']}")
             
-            # Verificar circuit breaker antes de hacer request
-            self._check_circuit_breaker()
-            
-            # Calcular timeout adaptativo
-            adaptive_timeout = self._calculate_adaptive_timeout(messages_data, max_tokens)
+            # Tokens del prompt (conteo local cacheado): fijan la cota del primer token de cada endpoint
+            prompt_tokens = get_token_counter().count_messages(messages_data)
             
             # Obtener cliente singleton con connection pool
             client = await self.get_client()
             
-            # Llamar directamente a vLLM con httpx (igual que el curl que funciona)
-            # Usar timeout adaptativo en lugar de fijo
-            chunks_received = 0
-            chunks_with_content = 0
+            # Antes del primer token un fallo se reintenta en otro endpoint del pool
+            tried: List[Endpoint] = []
+            error_message: Optional[str] = None
+            # request_id por intento: permite cancelar en vLLM cada stream por separado
+            attempts = 0
+            
+            def start_attempt(exclude: List[Endpoint]) -> _Attempt:
+                nonlocal attempts
+                attempts += 1
+                attempt_id = request_id if attempts == 1 else f"{request_id}-{attempts}"
+                attempt = _Attempt(self.endpoints.acquire(exclude=exclude, request_id=attempt_id), attempt_id)
+                attempt.source = self._stream_endpoint(
+                    attempt, client, dict(payload, request_id=attempt.request_id), prompt_tokens, usage, messages_data
+                )
+                return attempt
             
-            try:
+            while True:
                 try:
-                    # Usar timeout adaptativo en la request
-                    timeout = httpx.Timeout(adaptive_timeout, connect=10.0)
-                    async with client.stream(
-                        "POST",
-                        f"{self.vllm_endpoint}chat/completions",
-                        json=payload,
-                        timeout=timeout
-                    ) as response:
-                        if response.status_code == 200:
-                            logger.debug("✅ Conexión streaming establecida con vLLM")
-                            async for line in response.aiter_lines():
-                                chunks_received += 1
-                                if line.startswith("data: ") and line.strip() != "data: [DONE]":
-                                    try:
-                                        data = json.loads(line[6:])
-                                        if "choices" in data and len(data["choices"]) > 0:
-                                            delta_content = data["choices"][0].get("delta", {}).get("content", "")
-                                            if delta_content:
-                                                chunks_with_content += 1
-                                                yield delta_content
-                                    except json.JSONDecodeError as json_err:
-                                        logger.warning(f"⚠️ Error parseando JSON del chunk {chunks_received}: {json_err} - Línea: {line[:100]}")
-                                        continue
-                                    except Exception as parse_err:
-                                        logger.warning(f"⚠️ Error procesando chunk {chunks_received}: {parse_err}")
-                                        continue
-                            
-                            logger.info(f"✅ Streaming completado: {chunks_received} chunks recibidos, {chunks_with_content} con contenido")
-                            # Registrar éxito para circuit breaker
-                            self._record_success()
-                        else:
-                            # Manejo detallado de errores HTTP
-                            error_text = await response.aread()
-                            error_str = error_text.decode('utf-8', errors='replace') if error_text else 'Unknown error'
-                            
-                            logger.error(f"❌ Error HTTP {response.status_code} en vLLM")
-                            logger.error(f"📋 Detalles del error: {error_str[:500]}")
-                            logger.error(f"📦 Payload enviado: {json.dumps(payload, ensure_ascii=False, indent=2)[:1000]}")
-                            logger.error(f"🔗 Endpoint: {self.vllm_endpoint}chat/completions")
-                            
-                            # Registrar fallo para circuit breaker
-                            self._record_failure()
-                            
-                            # Intentar parsear error si es JSON
-                            try:
-                                error_json = json.loads(error_str)
-                                error_detail = error_json.get('error', {}).get('message', error_str)
-                                yield f"Error: {error_detail}"
-                            except:
-                                yield f"Error: No se pudo procesar la solicitud ({response.status_code})"
-                except httpx.TimeoutException as timeout_err:
-                    logger.error(f"❌ Timeout esperando respuesta de vLLM: {timeout_err}")
-                    self._record_failure()
-                    yield "Error: Timeout esperando respuesta del servidor"
-                except httpx.RequestError as req_err:
-                    logger.error(f"❌ Error de conexión con vLLM: {req_err}")
-                    logger.error(f"🔗 Endpoint: {self.vllm_endpoint}chat/completions")
-                    self._record_failure()
-                    yield f"Error: No se pudo conectar con el servidor - {str(req_err)}"
-                except Exception as stream_err:
-                    logger.error(f"❌ Error inesperado en streaming: {stream_err}", exc_info=True)
-                    self._record_failure()
-                    yield f"Error: {str(stream_err)}"
-            except Exception as circuit_err:
-                # Error de circuit breaker
-                logger.warning(f"⚠️ Circuit breaker activo: {circuit_err}")
-                yield f"Error: {str(circuit_err)}"
+                    attempt = start_attempt(tried)
+                except NoHealthyEndpoint as circuit_err:
+                    # Sin más endpoints: devolver el último error (o el del circuit breaker)
+                    logger.warning(f"⚠️ Circuit breaker activo: {circuit_err}")
+                    yield error_message or f"Error: {str(circuit_err)}"
+                    return
+                
+                attempt, first = await self._first_token(attempt, start_attempt, tried)
+                # Sin primer token el intento ya terminó
+                completed = first is None
+                try:
+                    if first is not None:
+                        yield first
+                        async for delta in attempt.source:
+                            yield delta
+                        completed = True
+                finally:
+                    # Cerrar el stream HTTP aunque el consumidor deje de iterar
+                    await attempt.source.aclose()
+                    if not completed:
+                        # Abandonado a mitad de respuesta (cliente desconectado o cancelado): parar la réplica ya
+                        logger.info(f"🛑 Stream abandonado, cancelando {attempt.request_id} en {attempt.endpoint.url}")
+                        self._schedule_cancel(attempt)
+                
+                if attempt.outcome:
+                    if usage is not None:
+                        usage["completed"] = True
+                        usage["finish_reason"] = attempt.finish_reason
+                    return
+                error_message = attempt.error_message or error_message
+                if attempt.outcome is False and attempt.first_token_at is None:
+                    tried.append(attempt.endpoint)
+                    logger.warning(f"⚠️ Fallo antes del primer token en {attempt.endpoint.url}, reintentando en otro endpoint")
+                    continue
+                yield error_message or "Error: No se pudo procesar la solicitud"
+                return
                     
         except Exception as e:
             logger.error(f"❌ Error crítico en streaming: {e}", exc_info=True)
@@ -386,6 +458,262 @@ class FallbackLLM:
             yield f"Error: {str(e)}"
 
 
+    async def _stream_endpoint(
+        self,
+        attempt: "_Attempt",
+        client: httpx.AsyncClient,
+        payload: Dict[str, Any],
+        prompt_tokens: int,
+        usage: Optional[Dict[str, Any]],
+        messages_data: List[Dict[str, Any]],
+    ) -> AsyncGenerator[str, None]:
+        """Un intento de streaming contra un endpoint; el resultado queda en attempt.outcome/error_message
+        
+        Sin timeout total: el primer token tiene su cota (según el prompt) y después cada chunk debe
+        llegar dentro de la cota entre tokens, así que un stream parado se corta pronto y una
+        respuesta larga que sigue fluyendo no.
+        """
+        endpoint = attempt.endpoint
+        url = f"{endpoint.url}chat/completions"
+        latency_model = get_latency_model()
+        bounds = latency_model.bounds(endpoint.url, payload["model"], prompt_tokens)
+        # La cota de lectura de httpx es solo una red de seguridad; las fases se vigilan abajo
+        timeout = httpx.Timeout(max(bounds.first_token, bounds.inter_token), connect=bounds.connect)
+        chunks_received = 0
+        chunks_with_content = 0
+        headers_at: Optional[float] = None
+        last_token_at: Optional[float] = None
+        max_gap = 0.0
+        completion_tokens: Optional[int] = None
+        try:
+            async with client.stream("POST", url, json=payload, timeout=timeout) as response:
+                headers_at = time.monotonic()
+                if response.status_code == 200:
+                    logger.debug(f"✅ Conexión streaming establecida con vLLM ({endpoint.url})")
+                    # Eventos SSE cortados sobre los bytes; de cada uno solo se extrae delta.content
+                    decoder = SSEDecoder()
+                    reads = response.aiter_bytes()
+                    stream_error: Optional[str] = None
+                    first_token_deadline = attempt.started + bounds.first_token
+                    while stream_error is None:
+                        wait = (
+                            first_token_deadline - time.monotonic() if attempt.first_token_at is None
+                            else bounds.inter_token
+                        )
+                        read_started = time.monotonic()
+                        try:
+                            raw = await asyncio.wait_for(reads.__anext__(), max(0.0, wait))
+                        except StopAsyncIteration:
+                            raw = None
+                        events = decoder.feed(raw) if raw is not None else decoder.close()
+                        for event in events:
+                            chunks_received += 1
+                            if event == DONE:
+                                continue
+                            try:
+                                delta = parse_delta(event)
+                            except Exception as parse_err:
+                                logger.warning(f"⚠️ Error procesando chunk {chunks_received}: {parse_err} - Evento: {event[:100]!r}")
+                                continue
+                            if delta.error:
+                                stream_error = delta.error
+                                break
+                            if delta.usage:
+                                completion_tokens = delta.usage.get("completion_tokens")
+                                if usage is not None:
+                                    usage.update(delta.usage)
+                            if delta.content:
+                                now = time.monotonic()
+                                if attempt.first_token_at is None:
+                                    attempt.first_token_at = now
+                                else:
+                                    # Solo la espera de la lectura (no el tiempo del consumidor entre chunks)
+                                    max_gap = max(max_gap, now - read_started)
+                                last_token_at = now
+                                chunks_with_content += 1
+                                attempt.parts.append(delta.content)
+                                yield delta.content
+                            if delta.finish_reason:
+                                attempt.finish_reason = delta.finish_reason
+                            if delta.finish_reason == "length":
+                                logger.warning(f"⚠️ Respuesta cortada por max_tokens ({payload['max_tokens']}) en {endpoint.url}")
+                        if raw is None:
+                            break
+                    
+                    if stream_error is not None:
+                        # Error enviado por vLLM a mitad del stream (p. ej. la petición se abortó en el motor)
+                        logger.error(f"❌ Error de vLLM durante el streaming ({endpoint.url}): {stream_error}")
+                        attempt.outcome = False
+                        attempt.error_message = f"Error: {stream_error}"
+                        return
+                    logger.info(f"✅ Streaming completado: {chunks_received} chunks recibidos, {chunks_with_content} con contenido")
+                    if usage is not None and not usage.get("prompt_tokens"):
+                        usage.update(get_token_counter().usage(messages_data, "".join(attempt.parts)))
+                    attempt.outcome = True
+                    if attempt.first_token_at is not None:
+                        latency_model.observe(
+                            endpoint.url,
+                            payload["model"],
+                            headers_seconds=headers_at - attempt.started,
+                            first_token_seconds=attempt.first_token_at - attempt.started,
+                            prompt_tokens=prompt_tokens,
+                            # Sin usage del servidor: un token por chunk (lo habitual en vLLM)
+                            completion_tokens=completion_tokens or chunks_with_content,
+                            decode_seconds=last_token_at - attempt.first_token_at,
+                            max_gap_seconds=max_gap,
+                        )
+                else:
+                    # Manejo detallado de errores HTTP
+                    error_text = await response.aread()
+                    error_str = error_text.decode('utf-8', errors='replace') if error_text else 'Unknown error'
+                    
+                    logger.error(f"❌ Error HTTP {response.status_code} en vLLM")
+                    logger.error(f"📋 Detalles del error: {error_str[:500]}")
+                    logger.error(f"📦 Payload enviado: {json.dumps(payload, ensure_ascii=False, indent=2)[:1000]}")
+                    logger.error(f"🔗 Endpoint: {url}")
+                    
+                    # 5xx y 429 son problemas del endpoint; otros 4xx son de la petición y no se reintentan
+                    if response.status_code >= 500 or response.status_code == 429:
+                        attempt.outcome = False
+                    
+                    # Intentar parsear error si es JSON
+                    try:
+                        error_json = json.loads(error_str)
+                        error_detail = error_json.get('error', {}).get('message', error_str)
+                        attempt.error_message = f"Error: {error_detail}"
+                    except:
+                        attempt.error_message = f"Error: No se pudo procesar la solicitud ({response.status_code})"
+        except asyncio.TimeoutError:
+            # Stream parado: sin primer token a tiempo o sin chunks dentro de la cota entre tokens
+            before_first = attempt.first_token_at is None
+            latency_model.record_stall(
+                endpoint.url,
+                payload["model"],
+                first_token=before_first,
+                waited_seconds=bounds.first_token if before_first else bounds.inter_token,
+                prompt_tokens=prompt_tokens,
+                headers_seconds=headers_at - attempt.started if headers_at is not None else None,
+            )
+            if before_first:
+                logger.error(f"❌ Sin primer token en {bounds.first_token:.1f}s desde {endpoint.url} ({prompt_tokens} tokens de prompt)")
+            else:
+                logger.error(f"❌ Stream parado en {endpoint.url}: sin datos en {bounds.inter_token:.1f}s tras {chunks_with_content} chunks")
+            attempt.outcome = False
+            attempt.error_message = "Error: Timeout esperando respuesta del servidor"
+        except httpx.TimeoutException as timeout_err:
+            logger.error(f"❌ Timeout esperando respuesta de vLLM ({endpoint.url}): {timeout_err}")
+            attempt.outcome = False
+            attempt.error_message = "Error: Timeout esperando respuesta del servidor"
+        except httpx.RequestError as req_err:
+            logger.error(f"❌ Error de conexión con vLLM: {req_err}")
+            logger.error(f"🔗 Endpoint: {url}")
+            attempt.outcome = False
+            attempt.error_message = f"Error: No se pudo conectar con el servidor - {str(req_err)}"
+        except Exception as stream_err:
+            logger.error(f"❌ Error inesperado en streaming: {stream_err}", exc_info=True)
+            attempt.outcome = False
+            attempt.error_message = f"Error: {str(stream_err)}"
+        finally:
+            # Latencia al primer token (o total si no hubo tokens) para la selección por EWMA
+            latency = (attempt.first_token_at or time.monotonic()) - attempt.started
+            self.endpoints.release(
+                endpoint, attempt.outcome, latency if attempt.outcome else None, request_id=attempt.request_id
+            )
+    
+    async def _first_token(self, primary: "_Attempt", start_attempt, tried: List[Endpoint]) -> Tuple["_Attempt", Optional[str]]:
+        """Esperar el primer token y, si tarda más que el umbral de hedging, cubrir con otra réplica
+        
+        Gana el primer intento que produce un token; los demás se abortan.
+        Devuelve el intento ganador y su primer delta (None si terminó sin tokens).
+        """
+        policy = get_hedge_policy()
+        policy.record_request()
+        delay = policy.delay() if len(self.endpoints.endpoints) > 1 else None
+        pending: Dict[asyncio.Future, _Attempt] = {asyncio.ensure_future(primary.source.__anext__()): primary}
+        hedge: Optional[_Attempt] = None
+        winner: Optional[_Attempt] = None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(list(pending), timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Sin primer token dentro del umbral: una sola cobertura por petición
+                    waited, delay = delay, None
+                    if policy.try_hedge():
+                        try:
+                            hedge = start_attempt(tried + [primary.endpoint])
+                        except NoHealthyEndpoint:
+                            policy.refund()
+                        else:
+                            logger.info(f"🪂 Sin primer token en {waited:.2f}s desde {primary.endpoint.url}; cobertura en {hedge.endpoint.url}")
+                            pending[asyncio.ensure_future(hedge.source.__anext__())] = hedge
+                    continue
+                for task in done:
+                    attempt = pending.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        # Terminó sin tokens: si falló y sigue otro intento en curso, esperar a ese
+                        if pending and not attempt.outcome:
+                            if attempt.outcome is False:
+                                tried.append(attempt.endpoint)
+                            continue
+                        winner = attempt
+                        return attempt, None
+                    winner = attempt
+                    if hedge is not None:
+                        policy.record_winner(attempt is hedge)
+                    policy.observe_ttft(attempt.first_token_at - attempt.started)
+                    return attempt, first
+            return primary, None
+        finally:
+            # Abortar los intentos que siguen en curso (perdedores, o todos si se canceló la petición)
+            for task, attempt in pending.items():
+                if attempt is not winner:
+                    await self._abort_attempt(task, attempt)
+                    policy.record_cancelled()
+    
+    async def _abort_attempt(self, task: asyncio.Future, attempt: "_Attempt"):
+        """Cerrar el stream de un intento y pedir a vLLM que libere la petición"""
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await attempt.source.aclose()
+        self._schedule_cancel(attempt)
+    
+    def _schedule_cancel(self, attempt: "_Attempt"):
+        """Cancelar en vLLM en segundo plano (no bloquea a quien aborta)"""
+        cancel = asyncio.ensure_future(self._cancel_upstream(attempt))
+        # Referencia fuerte hasta que termine (el event loop solo guarda referencias débiles)
+        self._background.add(cancel)
+        cancel.add_done_callback(self._background.discard)
+    
+    async def _cancel_upstream(self, attempt: "_Attempt"):
+        """API de cancelación de vLLM (la desconexión ya aborta; esto libera la réplica antes)"""
+        try:
+            client = await self.get_client()
+            await client.post(f"{attempt.endpoint.url}requests/{attempt.request_id}/cancel", timeout=5.0)
+            logger.debug(f"🛑 Cancelado en {attempt.endpoint.url}: {attempt.request_id}")
+        except Exception as e:
+            logger.debug(f"⚠️ No se pudo cancelar {attempt.request_id} en {attempt.endpoint.url}: {e}")
+
+
+class _Attempt:
+    """Un intento de streaming contra un endpoint (resultado para el circuit breaker y el hedging)"""
+    
+    __slots__ = ("endpoint", "request_id", "source", "started", "first_token_at", "outcome", "error_message", "parts", "finish_reason")
+    
+    def __init__(self, endpoint: Endpoint, request_id: str):
+        self.endpoint = endpoint
+        self.request_id = request_id
+        self.source: Optional[AsyncGenerator[str, None]] = None
+        self.started = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        # True: éxito; False: fallo del endpoint; None: sin resultado (cancelado o error del cliente)
+        self.outcome: Optional[bool] = None
+        self.error_message: Optional[str] = None
+        self.parts: List[str] = []
+        self.finish_reason: Optional[str] = None
+
+
 class EntityMemory:
     """Memoria que extrae y recuerda entidades importantes"""
     
@@ -476,6 +804,8 @@ class MedicalChain:
         self.system_prompt = self._load_medical_prompt()
         # Few-shot: se cargan desde prompts/few_shots.json
         self.few_shots: List[Dict[str, str]] = self._load_few_shots()
+        # Disposición de los prompts de chat: prefijo estable (versionado) primero para el prefix cache de vLLM
+        self.layout = PromptLayout(self.system_prompt)
         
         # Crear ChatPromptTemplate con MessagesPlaceholder para historial
         self.chat_prompt = ChatPromptTemplate.from_messages([
@@ -494,12 +824,12 @@ class MedicalChain:
         self.json_chain = self._build_json_chain()
         self.structured_chain = self._build_structured_chain()
     
-    def _get_chat_history(self, session_id: str) -> SQLiteChatMessageHistory:
-        """Obtener ChatMessageHistory para una sesión"""
+    async def _get_chat_history_async(self, session_id: str) -> SQLiteChatMessageHistory:
+        """Obtener ChatMessageHistory para una sesión (cargado en el executor del shard)"""
         if not session_id:
             # Si no hay session_id, crear uno temporal
             session_id = "temp_" + str(int(time.time()))
-        return SQLiteChatMessageHistory(session_id=session_id, db_path=self.db_path)
+        return await SQLiteChatMessageHistory.load_async(session_id, self.db_path)
     
     def _create_few_shot_template(self) -> Optional[FewShotPromptTemplate]:
         """Crear FewShotPromptTemplate para ejemplos"""
@@ -611,26 +941,7 @@ class MedicalChain:
     
     def _load_medical_prompt(self) -> str:
         """Cargar prompt médico desde archivo"""
-        try:
-            prompt_path = os.path.join(os.path.dirname(__file__), 'prompts', 'medico.md')
-            with open(prompt_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                # Extraer el system prompt principal
-                if '## System Prompt Principal' in content:
-                    start = content.find('## System Prompt Principal') + len('## System Prompt Principal')
-                    end = content.find('##', start)
-                    if end > start:
-                        return content[start:end].strip()
-                return content
-        except Exception as e:
-            logger.warning(f"⚠️ Error cargando prompt médico: {e}")
-        
-        # Fallback
-        return """Eres un asistente médico especializado del IMSS que proporciona información médica general, 
-interpretación de síntomas y guías de salud preventiva. 
-
-IMPORTANTE: Siempre recomiendas consultar con profesionales de la salud del IMSS para diagnósticos específicos 
-y tratamientos médicos. Responde en español."""
+        return load_system_prompt()
     
     def _load_few_shots(self) -> List[Dict[str, str]]:
         """Cargar ejemplos few-shot desde prompts/few_shots.json"""
@@ -654,106 +965,12 @@ y tratamientos médicos. Responde en español."""
         return []
     
     def _fix_fragmented_words(self, text: str) -> str:
-        """Corregir palabras fragmentadas comunes en español"""
-        if not text:
-            return text
-        
-        import re
-        
-        original_text = text
-        logger.debug(f"🔧 Corrigiendo palabras fragmentadas (longitud: {len(text)})")
-        logger.debug(f"📝 Texto original: '{text[:100]}...'")
-        
-        # Correcciones específicas para fragmentos comunes
-        # Orden importante: aplicar las más específicas primero
-        
-        # 1. Corregir "¡ola" -> "¡Hola" (al inicio o después de espacio)
-        text = re.sub(r'(^|\s)¡ola', r'\1¡Hola', text, flags=re.IGNORECASE)
-        
-        # 2. Corregir "ola" al inicio de frase -> "Hola"
-        if text.startswith('ola') or text.startswith('¡ola'):
-            if text.startswith('¡ola'):
-                text = '¡Hola' + text[4:]
-            elif text.startswith('ola'):
-                text = 'Hola' + text[3:]
-        
-        # 3. Corregir "¿ué" -> "¿Qué" (al inicio o después de espacio)
-        text = re.sub(r'(^|\s)¿ué', r'\1¿Qué', text, flags=re.IGNORECASE)
-        
-        # 4. Corregir "ué" después de "¿" -> "Qué"
-        text = re.sub(r'¿ué', '¿Qué', text, flags=re.IGNORECASE)
-        
-        # 5. Corregir "do rte" -> "duele"
-        text = re.sub(r'do\s+rte', 'duele', text, flags=re.IGNORECASE)
-        
-        # 6. Corregir "rte" después de "do " -> "duele"
-        text = re.sub(r'do\s+rte', 'duele', text, flags=re.IGNORECASE)
-        
-        # 7. Corregir "ola" seguido de signo de puntuación -> "Hola"
-        text = re.sub(r'ola([¿¡\s])', r'Hola\1', text, flags=re.IGNORECASE)
-        
-        # 8. Corregir "ué" seguido de signo de puntuación -> "Qué"
-        text = re.sub(r'ué([¿¡\s])', r'Qué\1', text, flags=re.IGNORECASE)
-        
-        if text != original_text:
-            logger.debug(f"✅ Texto corregido (longitud: {len(text)})")
-            logger.debug(f"📝 Texto corregido: '{text[:100]}...'")
-        else:
-            logger.debug(f"ℹ️ Texto no cambió después de corrección")
-        
-        return text
+        """Corregir palabras fragmentadas comunes en español (patrones compilados en text_normalizer)"""
+        return fix_fragmented_words(text)
     
     def _normalize_text(self, text: str) -> str:
-        """Normalizar texto para asegurar espacios correctos entre palabras"""
-        if not text:
-            return text
-        
-        import re
-        
-        original_text = text
-        logger.debug(f"🔧 Normalizando texto (longitud original: {len(text)})")
-        logger.debug(f"📝 Texto original: '{text[:100]}...'")
-        
-        # Primero, corregir palabras fragmentadas
-        text = self._fix_fragmented_words(text)
-        if text != original_text:
-            logger.debug(f"✅ Texto corregido después de fix_fragmented_words: '{text[:100]}...'")
-        
-        # Normalizar espacios múltiples a un solo espacio
-        text = re.sub(r'\s+', ' ', text)
-        
-        # Detectar y separar palabras concatenadas (palabras en español comunes)
-        # Patrón para detectar transiciones de minúscula a mayúscula (posible inicio de palabra)
-        # Ejemplo: "holaSoy" -> "hola Soy"
-        text = re.sub(r'([a-záéíóúñü])([A-ZÁÉÍÓÚÑÜ])', r'\1 \2', text)
-        
-        # Detectar transiciones de mayúscula a minúscula después de una palabra completa
-        # Ejemplo: "Soytu" -> "Soy tu" (pero no "IMSS" -> "IM SS")
-        # Solo si la primera letra es mayúscula y la siguiente es minúscula
-        text = re.sub(r'([A-ZÁÉÍÓÚÑÜ][a-záéíóúñü]+)([A-ZÁÉÍÓÚÑÜ][a-záéíóúñü])', r'\1 \2', text)
-        
-        # Asegurar espacios después de signos de puntuación comunes (excepto si ya hay espacio)
-        text = re.sub(r'([.!?,:;])([^\s])', r'\1 \2', text)
-        
-        # Asegurar espacios antes de signos de puntuación de apertura
-        text = re.sub(r'([^\s])([¡¿])', r'\1 \2', text)
-        
-        # Asegurar espacios después de signos de puntuación de cierre
-        text = re.sub(r'([!?])([^\s])', r'\1 \2', text)
-        
-        # Normalizar espacios múltiples nuevamente después de todas las transformaciones
-        text = re.sub(r'\s+', ' ', text)
-        
-        # Limpiar espacios al inicio y final
-        text = text.strip()
-        
-        if text != original_text:
-            logger.debug(f"✅ Texto normalizado (longitud: {len(text)})")
-            logger.debug(f"📝 Texto normalizado: '{text[:100]}...'")
-        else:
-            logger.debug(f"ℹ️ Texto no cambió después de normalización")
-        
-        return text
+        """Normalizar texto para asegurar espacios correctos entre palabras (incluye la corrección anterior)"""
+        return normalize_text(text)
     
     def _has_sufficient_information(self, user_message: str, conversation_history: List[BaseMessage]) -> tuple[bool, List[str], Optional[str]]:
         """
@@ -897,7 +1114,7 @@ y tratamientos médicos. Responde en español."""
         """
         try:
             # Obtener historial de conversación desde SQLite
-            history = self._get_chat_history(session_id)
+            history = await self._get_chat_history_async(session_id)
             
             # Detectar si hay suficiente información
             try:
@@ -947,8 +1164,8 @@ o	Si existen, por favor, detalle los hallazgos clave de radiografías, tomograf
 Con esta información, puedo ayudarle a explorar posibles diagnósticos diferenciales, sugerir estudios adicionales o recordar criterios de alarma relevantes.
 
 Por favor, proceda con la información. Estoy aquí para colaborar con su práctica clínica."""
-                    history.add_user_message(user_message)
-                    history.add_ai_message(response)
+                    await history.add_user_message_async(user_message, message_uid(request_id, "user"))
+                    await history.add_ai_message_async(response, message_uid(request_id, "assistant"))
                     logger.info(f"📋 Saludo detectado. Respondiendo con formato estructurado profesional")
                     return response
                 
@@ -1007,8 +1224,8 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
                     response = "".join(response_parts)
                     
                     # Guardar en historial
-                    history.add_user_message(user_message)
-                    history.add_ai_message(response)
+                    await history.add_user_message_async(user_message, message_uid(request_id, "user"))
+                    await history.add_ai_message_async(response, message_uid(request_id, "assistant"))
                     
                     logger.info(f"📋 Información insuficiente detectada. Solicitando información con formato estructurado")
                     return response
@@ -1016,38 +1233,19 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
                 logger.error(f"❌ Error en detección de información suficiente: {e}", exc_info=True)
                 # Continuar con el flujo normal si hay error en la detección
             
-            # Preparar contexto en paralelo (async optimizado)
-            async def prepare_context():
-                entity_ctx = await self._get_entity_context_async() if use_entities else ""
-                return {
-                    "entity_context": entity_ctx,
-                    "history": history.messages[-5:],  # Últimos 5 mensajes
-                }
-            
-            context = await prepare_context()
-            
-            # Formatear mensajes - SIMPLIFICADO para evitar errores 500 en vLLM
-            # El servidor vLLM usa apply_chat_template() que puede tener problemas con muchos mensajes
-            messages_list: List[BaseMessage] = []
-            
-            # System message con contexto de entidades (combinar todo en un solo system message)
-            system_content = f"{self.system_prompt}"
-            if context.get('entity_context'):
-                system_content += f"\n\n{context.get('entity_context', '')}"
-            system_content = system_content.strip()
-            messages_list.append(SystemMessage(content=system_content))
-            
-            # Historial de conversación (solo últimos 3 mensajes para evitar payload muy grande)
-            if context.get('history'):
-                # Tomar solo los últimos 3 mensajes del historial
-                recent_history = context['history'][-3:] if len(context['history']) > 3 else context['history']
-                messages_list.extend(recent_history)
-            
+            # Contexto empaquetado por prioridad dentro del presupuesto de tokens
+            # (un solo system message: el chat template de vLLM no admite varios)
+            entity_ctx = await self._get_entity_context_async() if use_entities else ""
             # NO incluir few-shot examples en la llamada directa (pueden causar problemas con apply_chat_template)
-            # Los few-shot ya están en el system_prompt si son necesarios
-            
-            # User message actual
-            messages_list.append(HumanMessage(content=user_message))
+            assembled = self.layout.build(
+                user_message,
+                _to_turns(history.messages),
+                session_id=session_id,
+                entity_context=entity_ctx,
+                max_tokens=2048,
+            )
+            logger.info(f"📐 Contexto: {assembled.breakdown}")
+            messages_list: List[BaseMessage] = _from_turns(assembled.messages)
             
             # Llamada directa a vLLM sin streaming (similar a estimate_usage_from_messages)
             # Adaptar mensajes a formato OpenAI
@@ -1144,26 +1342,43 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
             if len(messages_data) > 10 or total_chars > 10000:
                 logger.warning(f"⚠️ Payload muy grande: {len(messages_data)} mensajes, {total_chars} caracteres")
             
-            # Verificar circuit breaker antes de hacer request
-            self.llm._check_circuit_breaker()
-            
-            # Calcular timeout adaptativo
-            adaptive_timeout = self.llm._calculate_adaptive_timeout(messages_data, 2048)
+            # Tokens del prompt para las cotas de tiempo del modelo de latencia
+            prompt_tokens = get_token_counter().count_messages(messages_data)
+            latency_model = get_latency_model()
             
             # Obtener cliente singleton con connection pool
             client = await self.llm.get_client()
             
-            # Usar timeout adaptativo
-            timeout = httpx.Timeout(adaptive_timeout, connect=10.0)
-            
+            # Cada reintento va a un endpoint distinto; con todos ya intentados se espera (backoff) y se repite
+            tried: List[Endpoint] = []
             for attempt in range(max_retries):
+                try:
+                    endpoint = self.llm.endpoints.acquire(exclude=tried, request_id=request_id)
+                except NoHealthyEndpoint:
+                    if not tried:
+                        raise
+                    logger.warning(f"⚠️ Todos los endpoints fallaron (intento {attempt + 1}/{max_retries}), reintentando en {retry_delay:.2f}s...")
+                    await asyncio.sleep(retry_delay)
+                    retry_delay *= 1.5  # Backoff exponencial más suave (1.5x en lugar de 2x)
+                    tried = []
+                    endpoint = self.llm.endpoints.acquire(request_id=request_id)
+                
+                url = f"{endpoint.url}chat/completions"
+                # Sin streaming no hay fases observables: primer token + max_tokens al ritmo lento de decode
+                timeout = httpx.Timeout(
+                    latency_model.total_timeout(endpoint.url, payload["model"], prompt_tokens, payload["max_tokens"]),
+                    connect=latency_model.bounds(endpoint.url, payload["model"], prompt_tokens).connect,
+                )
+                started = time.monotonic()
+                # True: éxito; False: fallo del endpoint; None: error de la petición (4xx)
+                outcome: Optional[bool] = None
                 try:
                     # Log del request en el primer intento
                     if attempt == 0:
-                        logger.info(f"📤 Enviando request a {self.llm.vllm_endpoint}chat/completions")
+                        logger.info(f"📤 Enviando request a {url}")
                     
                     resp = await client.post(
-                        f"{self.llm.vllm_endpoint}chat/completions",
+                        url,
                         json=payload,
                         headers={
                             "Content-Type": "application/json",
@@ -1178,46 +1393,45 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
                             logger.info(f"✅ Respuesta recibida desde vLLM (sin streaming) después de {attempt + 1} intentos")
                         else:
                             logger.info("✅ Respuesta recibida desde vLLM (sin streaming)")
-                        # Registrar éxito para circuit breaker
-                        self.llm._record_success()
+                        outcome = True
                         break
                     else:
                         error_text = resp.text[:1000]  # Aumentar tamaño del error para logging
+                        if resp.status_code >= 500 or resp.status_code == 429:
+                            outcome = False
                         if attempt < max_retries - 1:
-                            logger.warning(f"⚠️ Error {resp.status_code} en vLLM (intento {attempt + 1}/{max_retries}), reintentando en {retry_delay:.2f}s...")
+                            logger.warning(f"⚠️ Error {resp.status_code} en {endpoint.url} (intento {attempt + 1}/{max_retries}), reintentando...")
                             if resp.status_code == 500:
                                 logger.error(f"📋 Detalles del error 500: {error_text}")
                                 # Log del request que falló para debugging
                                 logger.error(f"📋 Request que falló: {len(messages_data)} mensajes, {total_chars} caracteres")
                                 if attempt == 0:  # Solo en el primer intento
                                     logger.error(f"📋 Primeros 3 mensajes: {json.dumps(messages_data[:3], indent=2, ensure_ascii=False)[:500]}")
-                            await asyncio.sleep(retry_delay)
-                            retry_delay *= 1.5  # Backoff exponencial más suave (1.5x en lugar de 2x)
+                            tried.append(endpoint)
                         else:
                             logger.error(f"❌ Error en vLLM después de {max_retries} intentos: {resp.status_code} - {error_text}")
-                            # Registrar fallo para circuit breaker
-                            self.llm._record_failure()
                             raise Exception(f"HTTP {resp.status_code}: {error_text}")
-                except httpx.HTTPError as e:
+                except httpx.TimeoutException as e:
+                    outcome = False
                     if attempt < max_retries - 1:
-                        logger.warning(f"⚠️ Error de conexión en vLLM (intento {attempt + 1}/{max_retries}), reintentando en {retry_delay:.2f}s...")
-                        await asyncio.sleep(retry_delay)
-                        retry_delay *= 1.5
+                        logger.warning(f"⚠️ Timeout en {endpoint.url} (intento {attempt + 1}/{max_retries}), reintentando...")
+                        tried.append(endpoint)
                     else:
-                        logger.error(f"❌ Error de conexión en vLLM después de {max_retries} intentos: {e}")
-                        # Registrar fallo para circuit breaker
-                        self.llm._record_failure()
+                        logger.error(f"❌ Timeout en vLLM después de {max_retries} intentos: {e}")
                         raise
-                except httpx.TimeoutException as e:
+                except httpx.HTTPError as e:
+                    outcome = False
                     if attempt < max_retries - 1:
-                        logger.warning(f"⚠️ Timeout en vLLM (intento {attempt + 1}/{max_retries}), reintentando en {retry_delay:.2f}s...")
-                        await asyncio.sleep(retry_delay)
-                        retry_delay *= 1.5
+                        logger.warning(f"⚠️ Error de conexión en {endpoint.url} (intento {attempt + 1}/{max_retries}), reintentando...")
+                        tried.append(endpoint)
                     else:
-                        logger.error(f"❌ Timeout en vLLM después de {max_retries} intentos: {e}")
-                        # Registrar fallo para circuit breaker
-                        self.llm._record_failure()
+                        logger.error(f"❌ Error de conexión en vLLM después de {max_retries} intentos: {e}")
                         raise
+                finally:
+                    # Resultado para el circuit breaker y la latencia EWMA del endpoint
+                    self.llm.endpoints.release(
+                        endpoint, outcome, time.monotonic() - started if outcome else None, request_id=request_id
+                    )
             
             # NO guardar en historial aquí - main.py ya guarda los mensajes
             # Esto evita duplicados cuando se carga la conversación
@@ -1237,34 +1451,21 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
     async def build_context_messages(self, user_message: str, session_id: str = "", use_entities: bool = True) -> List[BaseMessage]:
         """Construir mensajes (System+Human) con el mismo contexto usado en process_chat."""
         # Obtener historial
-        history = self._get_chat_history(session_id)
-        
-        # Preparar contexto
+        history = await self._get_chat_history_async(session_id)
         entity_ctx = await self._get_entity_context_async() if use_entities else ""
-        history_messages = history.messages[-5:]
-        
-        # Formatear mensajes
-        messages_list: List[BaseMessage] = []
-        
-        # System message con contexto de entidades
-        system_content = f"{self.system_prompt}\n\n{entity_ctx or ''}".strip()
-        messages_list.append(SystemMessage(content=system_content))
-        
-        # Historial (si existe)
-        if history_messages:
-            messages_list.extend(history_messages)
         
-        # Few-shot examples
-        few_shot_messages = self._format_few_shots_as_messages()
-        messages_list.extend(few_shot_messages)
-        
-        # User message
-        messages_list.append(HumanMessage(content=user_message))
-        
-        return messages_list
+        assembled = self.layout.build(
+            user_message,
+            _to_turns(history.messages),
+            session_id=session_id,
+            entity_context=entity_ctx,
+            max_tokens=2048,
+            measure=False,
+        )
+        return _from_turns(assembled.messages)
 
-    async def estimate_usage_from_messages(self, messages: List[BaseMessage]) -> Dict[str, Any]:
-        """Realiza una llamada directa (no streaming) a vLLM para obtener usage tokens."""
+    async def estimate_usage_from_messages(self, messages: List[BaseMessage], completion: Optional[str] = None) -> Dict[str, Any]:
+        """Estimar usage tokens con el tokenizer local (sin llamada a vLLM)"""
         try:
             # Adaptar mensajes a formato OpenAI
             def to_openai(m: BaseMessage):
@@ -1276,123 +1477,134 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
                 return {"role": role, "content": getattr(m, 'content', str(m))}
 
             messages_data = [to_openai(m) for m in messages]
-
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                resp = await client.post(
-                    f"{self.llm.vllm_endpoint}chat/completions",
-                    json={
-                        "model": "google/medgemma-27b",
-                        "messages": messages_data,
-                        "temperature": 0.0,
-                        "max_tokens": 1,
-                        "stream": False,
-                    },
-                )
-            if resp.status_code == 200:
-                data = resp.json()
-                usage = data.get("usage", {})
-                return {
-                    "input_tokens": usage.get("prompt_tokens"),
-                    "output_tokens": usage.get("completion_tokens"),
-                    "total_tokens": usage.get("total_tokens"),
-                    "model": data.get("model"),
-                    "system_fingerprint": data.get("system_fingerprint"),
-                }
-            else:
-                logger.warning(f"⚠️ estimate_usage status={resp.status_code}")
+            usage = get_token_counter().usage(messages_data, completion)
+            return {
+                "input_tokens": usage["prompt_tokens"],
+                "output_tokens": usage["completion_tokens"] if completion is not None else None,
+                "total_tokens": usage["total_tokens"],
+            }
         except Exception as e:
             logger.warning(f"⚠️ No se pudo estimar usage: {e}")
         return {}
     
-    async def stream_chat(self, user_message: str, session_id: str = "", user_name: Optional[str] = None) -> AsyncGenerator[str, None]:
+    async def stream_chat(self, user_message: str, session_id: str = "", user_name: Optional[str] = None, request_id: Optional[str] = None, usage: Optional[Dict[str, Any]] = None, use_cache: bool = True) -> AsyncGenerator[str, None]:
         """Procesar chat con streaming usando LCEL completo con historial, Few-shot, Runnable
         
         Args:
             user_message: Mensaje del usuario
             session_id: ID de sesión
             user_name: Nombre del usuario para personalización (opcional)
+            request_id: ID de request; deriva los ids de mensaje para no duplicar lo que persiste main.py
+            usage: Diccionario que se rellena con prompt/completion/total tokens al terminar
+                (con "cached": True si la respuesta salió del cache de respuestas)
+            use_cache: Consultar y alimentar el cache de respuestas (opt-out por usuario)
         """
         try:
             # Obtener historial de conversación desde SQLite
-            history = self._get_chat_history(session_id)
-            
-            # Preparar contexto en paralelo (async optimizado)
-            entity_context = await self._get_entity_context_async()
-            history_messages = history.messages[-5:]  # Últimos 5 mensajes
+            history = await self._get_chat_history_async(session_id)
             
-            # Formatear mensajes con historial y few-shot
-            messages_list: List[BaseMessage] = []
-            
-            # System message - Simplificar para evitar errores 500
-            # Usar un prompt simple y básico similar al curl que funciona
-            # Incluir nombre del usuario si está disponible para personalización
-            if user_name and user_name.strip():
-                first_name = user_name.strip().split()[0] if user_name.strip() else ""
-                system_content = f"Eres un asistente médico del IMSS. Responde en español de manera clara y profesional. El usuario es Dr./Dra. {first_name}."
-            else:
-                system_content = "Eres un asistente médico del IMSS. Responde en español de manera clara y profesional."
-            messages_list.append(SystemMessage(content=system_content))
+            history_messages = history.messages
             
-            # Historial de conversación (solo últimos 2 mensajes para evitar sobrecarga)
             # Filtrar para evitar duplicados del mensaje actual
             if history_messages:
                 # Verificar si el último mensaje del historial es el mismo que el mensaje actual
-                last_message = history_messages[-1] if history_messages else None
-                if last_message and isinstance(last_message, HumanMessage):
-                    if last_message.content == user_message:
-                        # Si el último mensaje es el mismo, no agregar el historial (ya está incluido)
-                        history_messages = history_messages[:-1]
-                
-                if history_messages:
-                    messages_list.extend(history_messages[-2:])
-            
-            # Few-shot examples - Deshabilitar temporalmente para debugging
-            # few_shot_messages = self._format_few_shots_as_messages()
-            # messages_list.extend(few_shot_messages)
-            
-            # User message actual
-            messages_list.append(HumanMessage(content=user_message))
+                last_message = history_messages[-1]
+                if isinstance(last_message, HumanMessage) and last_message.content == user_message:
+                    # Si el último mensaje es el mismo, no agregarlo (ya va como mensaje actual)
+                    history_messages = history_messages[:-1]
+            
+            # Mismo system que process_chat; el nombre del usuario va detrás del mensaje actual
+            # para no romper el prefijo compartido (sin few-shot ni entidades: prompt simple)
+            assembled = self.layout.build(
+                user_message,
+                _to_turns(history_messages),
+                session_id=session_id,
+                user_name=user_name,
+                max_tokens=2048,
+            )
+            logger.info(f"📐 Contexto: {assembled.breakdown}")
+            messages_list: List[BaseMessage] = _from_turns(assembled.messages)
             
             # Guardar user message en historial (solo si no está ya guardado)
             # Verificar si el último mensaje del historial es diferente
             if not history.messages or (history.messages[-1].content != user_message if isinstance(history.messages[-1], HumanMessage) else True):
-                history.add_user_message(user_message)
+                await history.add_user_message_async(user_message, message_uid(request_id, "user"))
+            
+            # Cache de respuestas: la clave depende del system prompt, el historial enviado y el muestreo
+            response_cache = get_response_cache()
+            context_key = None
+            cached = None
+            if use_cache and response_cache.enabled:
+                # El nombre del usuario (contexto volátil) también condiciona la respuesta
+                context_key = response_cache.context_key(
+                    self.layout.version + self.layout.volatile_context(user_name),
+                    [(m.type, str(m.content)) for m in messages_list[1:-1]],
+                    {"model": "google/medgemma-27b", "temperature": 0.7, "max_tokens": 2048},
+                )
+                cached = await response_cache.lookup_async(context_key, user_message)
             
             # Stream response usando el método stream() de FallbackLLM que calcula deltas correctamente
             # Este método maneja automáticamente los deltas y espacios entre chunks
             accumulated_text = ""
             chunk_count = 0
+            deltas: List[str] = []
+            # Resultado del stream upstream (completed / finish_reason) aunque el llamador no pida usage
+            upstream: Dict[str, Any] = usage if usage is not None else {}
+            # Normalización del texto final mientras llegan los deltas (al terminar solo queda el último bloque);
+            # fix_passes=2 reproduce la corrección previa + _normalize_text de antes
+            normalizer = StreamNormalizer(fix_passes=2)
+            
+            if cached is not None:
+                logger.info(f"⚡ Respuesta desde cache para mensaje: {user_message[:50]}...")
+                source = response_cache.replay(cached)
+                if usage is not None:
+                    usage.update(get_token_counter().usage(
+                        [{"role": m.type, "content": str(m.content)} for m in messages_list], "".join(cached)
+                    ))
+                    usage["cached"] = True
+            else:
+                logger.info(f"🔄 Iniciando streaming para mensaje: {user_message[:50]}...")
+                # Usar stream() de FallbackLLM que maneja deltas correctamente
+                source = self.llm.stream(messages_list, usage=upstream, request_id=request_id)
             
-            logger.info(f"🔄 Iniciando streaming para mensaje: {user_message[:50]}...")
-            
-            # Usar stream() de FallbackLLM que maneja deltas correctamente
-            async for delta in self.llm.stream(messages_list):
-                if delta:
-                    chunk_count += 1
-                    accumulated_text += delta
-                    logger.debug(f"📦 Chunk #{chunk_count} enviado: '{delta[:50]}...' (longitud: {len(delta)})")
-                    # Enviar delta directamente (ya tiene espacios agregados por stream())
-                    yield delta
+            try:
+                async for delta in source:
+                    if delta:
+                        chunk_count += 1
+                        accumulated_text += delta
+                        deltas.append(delta)
+                        normalizer.feed(delta)
+                        logger.debug(f"📦 Chunk #{chunk_count} enviado: '{delta[:50]}...' (longitud: {len(delta)})")
+                        # Enviar delta directamente (ya tiene espacios agregados por stream())
+                        yield delta
+            finally:
+                # Si el consumidor abandona, cerrar ya el stream upstream (cancela la generación en vLLM)
+                await source.aclose()
             
             # Corregir y normalizar el texto final antes de guardar
             if accumulated_text:
-                # Corregir palabras fragmentadas
-                corrected = self._fix_fragmented_words(accumulated_text)
-                
-                # Normalizar el texto
-                final_normalized = self._normalize_text(corrected)
+                # Palabras fragmentadas y espacios (normalizado incrementalmente durante el stream)
+                # y validación de salida (LLM05, LLM07): esta es la fila canónica del turno, la
+                # escritura posterior de main.py con el mismo message_uid se ignora
+                final_normalized = get_security_manager().validate_output(normalizer.finish())
                 
                 logger.info(f"✅ Streaming completado - Total chunks: {chunk_count}, Texto final: {len(final_normalized)} caracteres")
                 
+                # Solo respuestas completas: sin error (stream() devuelve los errores como texto, también
+                # a mitad de la respuesta) y terminadas por el modelo, no cortadas por max_tokens
+                if (context_key is not None and cached is None
+                        and upstream.get("completed") and upstream.get("finish_reason") == "stop"):
+                    await response_cache.store_async(context_key, user_message, deltas)
+                
                 # Guardar en historial (SQLiteChatMessageHistory persiste automáticamente)
-                history.add_ai_message(final_normalized)
+                await history.add_ai_message_async(final_normalized, message_uid(request_id, "assistant"))
                 
                 # Guardar en memoria de entidades
                 self.memory.add_message("user", user_message)
                 self.memory.add_message("assistant", final_normalized)
             else:
                 # Si no hay texto acumulado, guardar vacío
-                history.add_ai_message("")
+                await history.add_ai_message_async("", message_uid(request_id, "assistant"))
                 self.memory.add_message("user", user_message)
                 self.memory.add_message("assistant", "")
             
@@ -1439,18 +1651,15 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
             conversation_history = []
             entity_context = ""
             try:
-                history = self._get_chat_history(session_id)
+                history = await self._get_chat_history_async(session_id)
                 conversation_history = history.messages[-5:] if history.messages else []
                 entity_context = await self._get_entity_context_async()
             except Exception as e:
                 logger.warning(f"⚠️ No se pudo obtener contexto: {e}")
             
-            # Construir prompt completo con contexto de entidades si existe
-            full_system_prompt = self.system_prompt
-            if entity_context:
-                full_system_prompt = f"{self.system_prompt}\n\n{entity_context}"
-            
-            # Agregar contexto de historial si existe
+            # Prompt de más estable a más volátil para reutilizar el prefijo cacheado:
+            # system (el mismo que el chat) -> instrucciones de imagen -> historial -> entidades -> petición
+            history_text = ""
             if conversation_history and len(conversation_history) > 0:
                 recent_history = conversation_history[-3:] if len(conversation_history) > 3 else conversation_history
                 history_text = "\n\n## Contexto de la conversación:\n"
@@ -1458,11 +1667,11 @@ Por favor, proceda con la información. Estoy aquí para colaborar con su práct
                     if hasattr(msg, 'content'):
                         role = "Usuario" if hasattr(msg, '__class__') and 'Human' in str(type(msg)) else "Asistente"
                         history_text += f"{role}: {msg.content}\n"
-                full_system_prompt = f"{full_system_prompt}\n{history_text}"
+            entity_text = f"\n\n{entity_context}" if entity_context else ""
             
             # Construir prompt final para análisis de imagen
             # IMPORTANTE: Todas las respuestas deben estar dirigidas AL DOCTOR, NO al paciente
-            analysis_prompt = f"""{full_system_prompt}
+            analysis_prompt = f"""{self.layout.system_prompt}
 
 IMPORTANTE: El usuario ha compartido una radiografía/imagen médica.
 Analiza la imagen proporcionada y proporciona información dirigida AL DOCTOR:
@@ -1475,12 +1684,12 @@ REGLA CRÍTICA:
 - TODAS las respuestas deben estar dirigidas AL DOCTOR, NO al paciente
 - NUNCA uses lenguaje como "El paciente debe consultar..." o "Es importante que el paciente se dirija..."
 - SIEMPRE usa lenguaje médico profesional dirigido al doctor: "Se recomienda evaluación por radiólogo...", "Considerar interpretación especializada..."
-- NUNCA digas "El paciente debe..." - eso es para el paciente, no para el doctor
+- NUNCA digas "El paciente debe..." - eso es para el paciente, no para el doctor{history_text}{entity_text}
 
 Prompt del usuario: {user_message if user_message else 'Analiza esta radiografía médica en detalle'}"""
             
             logger.info(f"🖼️ Enviando imagen a Ollama con streaming...")
-            logger.info(f"📏 Tamaño de imagen base64: {len(image_data)} caracteres (~{len(image_data) // 4} tokens estimados)")
+            logger.info(f"📏 Tamaño de imagen base64: {len(image_data)} caracteres (~{get_token_counter().count_image(image_data)} tokens estimados)")
             
             # Preparar payload para Ollama con streaming y optimizaciones
             # Importar configuración de optimización
@@ -0,0 +1,358 @@
+"""
+Modelo de latencia aprendido en línea para los timeouts de vLLM
+Sustituye el timeout total estimado con constantes (0.01 s por token de entrada, 0.05 s por token
+de salida) por cotas por fase aprendidas de las peticiones completadas de cada endpoint y modelo:
+
+- connect: percentil del tiempo hasta las cabeceras de respuesta
+- primer token: cabeceras + espera en cola + prompt_tokens / throughput de prefill (tokens/s)
+- entre tokens: percentil de la mayor pausa entre chunks de cada respuesta; un stream parado se
+  corta en segundos sin limitar la duración total de una respuesta larga
+- los cortes por timeout entran como muestras censuradas (la cota que saltó), así que si el
+  endpoint se vuelve más lento las cotas se ensanchan en vez de cortar todas las respuestas
+
+Cada cota es percentil * margen, acotada entre un mínimo y un máximo; sin muestras suficientes
+se usan los valores fijos de siempre. Las ventanas se guardan en la base de métricas
+(tabla latency_model) y se cargan al arrancar.
+
+- CHATBOT_LATENCY_QUANTILE: percentil de las cotas (0.99)
+- CHATBOT_LATENCY_MARGIN: multiplicador sobre el percentil (1.5)
+- CHATBOT_INTER_TOKEN_TIMEOUT: pausa máxima entre chunks mientras no hay datos (30 s)
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from write_queue import get_write_queue
+
+logger = logging.getLogger(__name__)
+
+LATENCY_QUANTILE = float(os.getenv("CHATBOT_LATENCY_QUANTILE", "0.99"))
+LATENCY_MARGIN = float(os.getenv("CHATBOT_LATENCY_MARGIN", "1.5"))
+LATENCY_WINDOW = int(os.getenv("CHATBOT_LATENCY_WINDOW", "500"))  # peticiones recientes por endpoint y modelo
+LATENCY_MIN_SAMPLES = int(os.getenv("CHATBOT_LATENCY_MIN_SAMPLES", "20"))
+LATENCY_SAVE_EVERY = int(os.getenv("CHATBOT_LATENCY_SAVE_EVERY", "50"))  # observaciones entre guardados
+
+# Valores fijos sin muestras suficientes (y límites de las cotas aprendidas), en segundos
+CONNECT_TIMEOUT = float(os.getenv("CHATBOT_CONNECT_TIMEOUT", "10"))
+CONNECT_TIMEOUT_MIN = 1.0
+FIRST_TOKEN_TIMEOUT_MIN = float(os.getenv("CHATBOT_FIRST_TOKEN_TIMEOUT_MIN", "5"))
+FIRST_TOKEN_TIMEOUT_MAX = float(os.getenv("CHATBOT_FIRST_TOKEN_TIMEOUT_MAX", "300"))
+INTER_TOKEN_TIMEOUT = float(os.getenv("CHATBOT_INTER_TOKEN_TIMEOUT", "30"))
+INTER_TOKEN_TIMEOUT_MIN = float(os.getenv("CHATBOT_INTER_TOKEN_TIMEOUT_MIN", "2"))
+TOTAL_TIMEOUT_MAX = 600.0
+
+# Estimación fija anterior (FallbackLLM._calculate_adaptive_timeout)
+FALLBACK_BASE_SECONDS = 10.0
+FALLBACK_PREFILL_SECONDS_PER_TOKEN = 0.01
+FALLBACK_DECODE_SECONDS_PER_TOKEN = 0.05
+FALLBACK_SAFETY = 1.2
+FALLBACK_MIN_SECONDS = 30.0
+
+# El throughput de prefill solo se mide con prompts donde el cómputo domina sobre la espera en cola
+PREFILL_MIN_TOKENS = 128
+MIN_RATE_SAMPLES = 5
+
+
+def _quantile(ordered: Sequence[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * q)))]
+
+
+def _clamp(value: float, low: float, high: float) -> float:
+    return min(high, max(low, value))
+
+
+class LatencyBounds(NamedTuple):
+    """Timeouts por fase de una petición (segundos)"""
+    connect: float
+    first_token: float
+    inter_token: float
+    learned: bool
+
+
+class _Fit(NamedTuple):
+    headers: float  # percentil del tiempo hasta las cabeceras
+    queue: float  # percentil del tiempo de primer token no explicado por el prefill
+    prefill_rate: Optional[float]  # tokens/s típicos (mediana)
+    prefill_rate_low: Optional[float]  # tokens/s en el percentil lento
+    decode_rate: Optional[float]
+    decode_rate_low: Optional[float]
+    gap: float  # percentil de la mayor pausa entre chunks
+
+
+class _Profile:
+    """Ventanas de muestras de un endpoint y modelo"""
+
+    __slots__ = ("headers", "prefill", "decode", "gaps", "fit", "stalls", "first_token_timeouts")
+
+    def __init__(self, window: int):
+        self.headers: deque = deque(maxlen=window)  # s hasta las cabeceras de respuesta
+        self.prefill: deque = deque(maxlen=window)  # (prompt_tokens, s desde las cabeceras al primer token)
+        self.decode: deque = deque(maxlen=window)  # tokens/s después del primer token
+        self.gaps: deque = deque(maxlen=window)  # mayor pausa entre chunks de cada respuesta
+        self.fit: Optional[_Fit] = None
+        self.stalls = 0
+        self.first_token_timeouts = 0
+
+    @property
+    def samples(self) -> int:
+        return len(self.headers)
+
+    def compute_fit(self, q: float) -> _Fit:
+        if self.fit is not None:
+            return self.fit
+        rates = sorted(n / s for n, s in self.prefill if n >= PREFILL_MIN_TOKENS and s > 0)
+        prefill_rate = statistics.median(rates) if len(rates) >= MIN_RATE_SAMPLES else None
+        if prefill_rate:
+            # Lo que el throughput típico no explica es espera en cola (o ruido)
+            residuals = sorted(max(0.0, s - n / prefill_rate) for n, s in self.prefill)
+        else:
+            residuals = sorted(s for _, s in self.prefill)
+        decode = sorted(self.decode)
+        self.fit = _Fit(
+            headers=_quantile(sorted(self.headers), q),
+            queue=_quantile(residuals, q),
+            prefill_rate=prefill_rate,
+            prefill_rate_low=_quantile(rates, 1 - q) if prefill_rate else None,
+            decode_rate=statistics.median(decode) if len(decode) >= MIN_RATE_SAMPLES else None,
+            decode_rate_low=_quantile(decode, 1 - q) if len(decode) >= MIN_RATE_SAMPLES else None,
+            gap=_quantile(sorted(self.gaps), q),
+        )
+        return self.fit
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            "headers": [round(v, 4) for v in self.headers],
+            "prefill": [[n, round(s, 4)] for n, s in self.prefill],
+            "decode": [round(v, 2) for v in self.decode],
+            "gaps": [round(v, 4) for v in self.gaps],
+        }
+
+    def restore(self, data: Dict[str, Any]):
+        self.headers.extend(float(v) for v in data.get("headers", []))
+        self.prefill.extend((int(n), float(s)) for n, s in data.get("prefill", []))
+        self.decode.extend(float(v) for v in data.get("decode", []))
+        self.gaps.extend(float(v) for v in data.get("gaps", []))
+        self.fit = None
+
+
+class LatencyModel:
+    """Throughput de prefill/decode y pausas por (endpoint, modelo), con timeouts por percentil (thread-safe)"""
+
+    def __init__(
+        self,
+        quantile: float = LATENCY_QUANTILE,
+        margin: float = LATENCY_MARGIN,
+        window: int = LATENCY_WINDOW,
+        min_samples: int = LATENCY_MIN_SAMPLES,
+    ):
+        self.quantile = min(max(quantile, 0.5), 0.999)
+        self.margin = max(1.0, margin)
+        self.window = max(1, window)
+        self.min_samples = max(1, min_samples)
+        self._profiles: Dict[Tuple[str, str], _Profile] = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._unsaved = 0
+
+    def _profile(self, endpoint: str, model: str) -> _Profile:
+        profile = self._profiles.get((endpoint, model))
+        if profile is None:
+            profile = self._profiles[(endpoint, model)] = _Profile(self.window)
+        return profile
+
+    def _learned_fit(self, endpoint: str, model: str) -> Optional[_Fit]:
+        """Ajuste del endpoint o None si aún no hay muestras suficientes (con el lock tomado)"""
+        profile = self._profiles.get((endpoint, model))
+        if profile is None or profile.samples < self.min_samples:
+            return None
+        return profile.compute_fit(self.quantile)
+
+    # --- Cotas ---
+
+    def bounds(self, endpoint: str, model: str, prompt_tokens: int) -> LatencyBounds:
+        """Timeouts de connect, primer token (para este prompt) y entre tokens"""
+        with self._lock:
+            fit = self._learned_fit(endpoint, model)
+        if fit is None:
+            first_token = (FALLBACK_BASE_SECONDS + prompt_tokens * FALLBACK_PREFILL_SECONDS_PER_TOKEN) * FALLBACK_SAFETY
+            return LatencyBounds(
+                connect=CONNECT_TIMEOUT,
+                first_token=_clamp(first_token, FALLBACK_MIN_SECONDS, FIRST_TOKEN_TIMEOUT_MAX),
+                inter_token=INTER_TOKEN_TIMEOUT,
+                learned=False,
+            )
+        prefill = prompt_tokens * (
+            1 / fit.prefill_rate_low if fit.prefill_rate_low else FALLBACK_PREFILL_SECONDS_PER_TOKEN
+        )
+        return LatencyBounds(
+            connect=_clamp(fit.headers * self.margin, CONNECT_TIMEOUT_MIN, CONNECT_TIMEOUT),
+            first_token=_clamp(
+                (fit.headers + fit.queue + prefill) * self.margin, FIRST_TOKEN_TIMEOUT_MIN, FIRST_TOKEN_TIMEOUT_MAX
+            ),
+            inter_token=_clamp(fit.gap * self.margin, INTER_TOKEN_TIMEOUT_MIN, INTER_TOKEN_TIMEOUT),
+            learned=True,
+        )
+
+    def total_timeout(self, endpoint: str, model: str, prompt_tokens: int, max_tokens: int) -> float:
+        """Timeout de una petición sin streaming: primer token + max_tokens al ritmo lento de decode"""
+        bounds = self.bounds(endpoint, model, prompt_tokens)
+        with self._lock:
+            fit = self._learned_fit(endpoint, model)
+        if fit is None or not fit.decode_rate_low:
+            total = (
+                FALLBACK_BASE_SECONDS
+                + prompt_tokens * FALLBACK_PREFILL_SECONDS_PER_TOKEN
+                + max_tokens * FALLBACK_DECODE_SECONDS_PER_TOKEN
+            ) * FALLBACK_SAFETY
+            return _clamp(total, FALLBACK_MIN_SECONDS, TOTAL_TIMEOUT_MAX)
+        total = bounds.first_token + max_tokens / fit.decode_rate_low * self.margin
+        return _clamp(total, FIRST_TOKEN_TIMEOUT_MIN, TOTAL_TIMEOUT_MAX)
+
+    # --- Observaciones ---
+
+    def observe(
+        self,
+        endpoint: str,
+        model: str,
+        headers_seconds: float,
+        first_token_seconds: float,
+        prompt_tokens: int,
+        completion_tokens: int,
+        decode_seconds: float,
+        max_gap_seconds: float,
+    ):
+        """Registrar una respuesta en streaming completada (tiempos desde el inicio del intento)"""
+        with self._lock:
+            profile = self._profile(endpoint, model)
+            profile.headers.append(headers_seconds)
+            profile.prefill.append((prompt_tokens, max(0.0, first_token_seconds - headers_seconds)))
+            if completion_tokens > 1 and decode_seconds > 0:
+                profile.decode.append((completion_tokens - 1) / decode_seconds)
+            profile.gaps.append(max_gap_seconds)
+            profile.fit = None
+            self._unsaved += 1
+            save = self._pool is not None and self._unsaved >= LATENCY_SAVE_EVERY
+        if save:
+            self.save()
+
+    def record_stall(
+        self,
+        endpoint: str,
+        model: str,
+        first_token: bool,
+        waited_seconds: float,
+        prompt_tokens: int = 0,
+        headers_seconds: Optional[float] = None,
+    ):
+        """Contar un stream cortado por timeout (antes del primer token o entre tokens)
+
+        La espera real fue al menos la cota que saltó, así que se guarda como muestra censurada:
+        si los cortes superan el (1 - percentil) de la ventana, el percentil pasa a ser la cota
+        y la siguiente sale multiplicada por el margen. Con cortes solo en las muestras más lentas
+        las cotas no cambian; con un endpoint que se ha vuelto más lento se ensanchan solas.
+        """
+        with self._lock:
+            profile = self._profile(endpoint, model)
+            if first_token:
+                profile.first_token_timeouts += 1
+                if headers_seconds is not None:
+                    profile.prefill.append((prompt_tokens, max(0.0, waited_seconds - headers_seconds)))
+            else:
+                profile.stalls += 1
+                profile.gaps.append(waited_seconds)
+            profile.fit = None
+            self._unsaved += 1
+
+    # --- Persistencia ---
+
+    def load(self, pool):
+        """Cargar las ventanas guardadas (llamar fuera del event loop) y guardar en adelante en ese pool"""
+        self._pool = pool
+        try:
+            rows = pool.fetchall("SELECT endpoint, model, samples FROM latency_model")
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ No se pudo cargar el modelo de latencia: {e}")
+            return
+        with self._lock:
+            for endpoint, model, samples in rows:
+                try:
+                    self._profile(endpoint, model).restore(json.loads(samples))
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"⚠️ Muestras de latencia inválidas para {model}@{endpoint}: {e}")
+        if rows:
+            logger.info(f"✅ Modelo de latencia cargado: {len(rows)} endpoint(s)")
+
+    def save(self):
+        """Encolar el guardado de todas las ventanas (una fila por endpoint y modelo)"""
+        if self._pool is None:
+            return
+        now = int(time.time())
+        with self._lock:
+            rows = [
+                (endpoint, model, json.dumps(profile.dump()), now)
+                for (endpoint, model), profile in self._profiles.items()
+                if profile.samples
+            ]
+            self._unsaved = 0
+        if not rows:
+            return
+
+        def op(conn: sqlite3.Connection):
+            conn.executemany("""
+                INSERT INTO latency_model (endpoint, model, samples, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(endpoint, model) DO UPDATE SET samples = excluded.samples, updated_at = excluded.updated_at
+            """, rows)
+
+        get_write_queue(self._pool).submit(op, key="latency_model")
+
+    def stats(self) -> Dict[str, Any]:
+        reference = 1000  # prompt de referencia para mostrar la cota de primer token
+        with self._lock:
+            keys = list(self._profiles)
+        profiles: List[Dict[str, Any]] = []
+        for endpoint, model in keys:
+            bounds = self.bounds(endpoint, model, reference)
+            with self._lock:
+                profile = self._profiles[(endpoint, model)]
+                fit = self._learned_fit(endpoint, model)
+                profiles.append({
+                    "endpoint": endpoint,
+                    "model": model,
+                    "samples": profile.samples,
+                    "learned": bounds.learned,
+                    "prefill_tokens_per_s": round(fit.prefill_rate, 1) if fit and fit.prefill_rate else None,
+                    "decode_tokens_per_s": round(fit.decode_rate, 1) if fit and fit.decode_rate else None,
+                    "connect_timeout_s": round(bounds.connect, 2),
+                    "first_token_timeout_s": round(bounds.first_token, 2),
+                    "inter_token_timeout_s": round(bounds.inter_token, 2),
+                    "stalls": profile.stalls,
+                    "first_token_timeouts": profile.first_token_timeouts,
+                })
+        return {
+            "quantile": self.quantile,
+            "margin": self.margin,
+            "reference_prompt_tokens": reference,
+            "profiles": profiles,
+        }
+
+
+# Instancia global
+_latency_model: Optional[LatencyModel] = None
+_latency_model_lock = threading.Lock()
+
+
+def get_latency_model() -> LatencyModel:
+    """Obtener el modelo de latencia compartido del proceso"""
+    global _latency_model
+    if _latency_model is None:
+        with _latency_model_lock:
+            if _latency_model is None:
+                _latency_model = LatencyModel()
+    return _latency_model
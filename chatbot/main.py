@@ -5,17 +5,21 @@ Totalmente asíncrono y escalable
 
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 import uuid
 import json
+import base64
 import logging
 import asyncio
 import os
 import time
 import html
 import httpx
+from contextlib import asynccontextmanager
+
+from sse_framing import ChunkBatcher, encode_content, encode_event, framing_stats
 
 
 class AbortController:
@@ -42,17 +46,89 @@ class AbortSignal:
         """Marcar como abortado"""
         self._aborted = True
 
+
+# Cada cuánto se comprueba si el cliente sigue conectado mientras se espera al LLM
+DISCONNECT_POLL_SECONDS = int(os.getenv("CHATBOT_DISCONNECT_POLL_MS", "100")) / 1000
+
+
+class ClientDisconnected(Exception):
+    """El cliente cerró la conexión o canceló la generación"""
+
+
+async def stream_until_disconnect(
+    source,
+    request: Optional["Request"] = None,
+    abort_signal: Optional[AbortSignal] = None,
+    batcher: Optional[ChunkBatcher] = None,
+):
+    """Reenviar los chunks de `source` y abortarlo en cuanto el cliente se desconecta
+
+    Sondea Request.is_disconnected() (y la señal de cancelación) también mientras se espera
+    el siguiente chunk, así que el prefill o un chunk lento no retrasan el aborto. Al abortar,
+    la cancelación recorre stream_chat -> FallbackLLM.stream hasta la API de cancelación de vLLM.
+    Lanza ClientDisconnected.
+
+    Con `batcher` los chunks se agrupan por ventana de tiempo: cada valor devuelto es el texto
+    de una trama (la espera del siguiente chunk se corta cuando vence la ventana).
+    """
+    pending = None
+    try:
+        while True:
+            pending = asyncio.ensure_future(source.__anext__())
+            while True:
+                timeout = DISCONNECT_POLL_SECONDS
+                if batcher is not None and batcher.deadline is not None:
+                    timeout = min(timeout, max(0.0, batcher.deadline - time.monotonic()))
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if (abort_signal is not None and abort_signal.aborted) or (
+                    request is not None and await request.is_disconnected()
+                ):
+                    raise ClientDisconnected()
+                if done:
+                    break
+                if batcher is not None and batcher.due():
+                    yield batcher.flush()
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                if batcher is not None and batcher.pending:
+                    yield batcher.flush()
+                return
+            pending = None
+            if batcher is None:
+                yield chunk
+            elif chunk and batcher.add(chunk):
+                yield batcher.flush()
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await source.aclose()
+
 # Importar módulos
-from memory_manager import get_memory_manager
+from memory_manager import get_memory_manager, message_uid
 from media_storage import media_storage
 from langchain_system import get_medical_chain
 from medical_analysis import analyze_image_with_fallback
-from transcription_service import transcribe_audio
+from transcription_service import transcribe_audio, transcribe_audio_bytes
 from auth_manager import get_auth_manager
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi import Depends, Header, Request
+from fastapi import Depends, Header, Request, WebSocket
 from security_llm import get_security_manager
 from optimizations import get_rate_limiter
+from db_pool import close_all_pools
+from write_queue import close_all_write_queues
+from maintenance import MaintenanceScheduler
+from token_counter import get_token_counter
+from context_assembler import get_context_assembler
+from admission import AdmissionRejected, PRIORITY_BATCH, PRIORITY_INTERACTIVE, get_admission_controller
+from hedging import get_hedge_policy
+from latency_model import get_latency_model
+from prompt_layout import get_prefix_tracker
+from response_cache import get_response_cache
+from single_flight import get_single_flight
+from stream_resume import ResumableStream, get_stream_registry
+from ws_mux import MuxConnection, MuxStream, authenticate, mux_stats
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -99,6 +175,32 @@ auth_manager = get_auth_manager()
 security = HTTPBearer()
 security_manager = get_security_manager()
 rate_limiter = get_rate_limiter()
+# Plazas por backend (vLLM, Ollama, Whisper, TTS) con cola de prioridad
+admission = get_admission_controller()
+# Streams de chat reanudables: la generación sigue aunque se caiga la conexión del cliente
+stream_registry = get_stream_registry()
+
+
+def too_busy(err: AdmissionRejected) -> HTTPException:
+    """429 con Retry-After a partir de la espera estimada del control de admisión"""
+    return HTTPException(
+        status_code=429,
+        detail="El servicio está saturado. Intenta de nuevo en unos segundos.",
+        headers={"Retry-After": str(err.retry_after)},
+    )
+
+
+@asynccontextmanager
+async def admission_slot(backend: str, priority: int = PRIORITY_INTERACTIVE):
+    """Ocupar una plaza del backend durante el bloque (HTTPException 429 si no la hay a tiempo)"""
+    try:
+        ticket = await admission.acquire(backend, priority)
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    try:
+        yield ticket
+    finally:
+        ticket.release()
 
 # Diccionario para rastrear generaciones activas: {request_id: {"session_id": str, "user_id": str, "vllm_request_id": str}}
 active_requests: Dict[str, Dict[str, Any]] = {}
@@ -211,7 +313,7 @@ async def get_current_user(
         else:
             token = authorization
         
-        user = auth_manager.verify_token(token)
+        user = await auth_manager.verify_token_async(token)
         return user
     except Exception as e:
         logger.warning(f"Error verificando token: {e}")
@@ -225,6 +327,34 @@ def require_auth(user: Optional[Dict[str, Any]] = Depends(get_current_user)) ->
     return user
 
 
+# Retención, archivado y compactación periódicos de chatbot.db
+maintenance_scheduler = MaintenanceScheduler(memory_manager)
+
+
+@app.on_event("startup")
+async def startup_event():
+    """Arrancar tareas de fondo"""
+    maintenance_scheduler.start()
+    # Cargar el tokenizer local fuera del event loop antes de la primera petición
+    asyncio.get_running_loop().run_in_executor(None, get_token_counter().load)
+    # Timeouts aprendidos en ejecuciones anteriores (tabla latency_model de la base de métricas)
+    asyncio.get_running_loop().run_in_executor(None, get_latency_model().load, memory_manager.router.metrics_pool)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Liberar recursos al apagar el servidor"""
+    await maintenance_scheduler.stop()
+    # Generaciones en curso y buffers de streams reanudables
+    stream_registry.close_all()
+    # Guardar el modelo de latencia (se escribe al vaciar las colas)
+    get_latency_model().save()
+    # Vaciar escrituras diferidas pendientes antes de cerrar las conexiones
+    close_all_write_queues()
+    # Cerrar conexiones SQLite del pool (checkpoint WAL al cerrar la última conexión)
+    close_all_pools()
+
+
 # Endpoints
 @app.get("/")
 async def root():
@@ -235,7 +365,33 @@ async def root():
 @app.get("/api/health")
 async def health():
     """Health check"""
-    return {"status": "ok", "medical_analyzer": "enabled"}
+    return {
+        "status": "ok",
+        "medical_analyzer": "enabled",
+        # Contadores del cache de sesión (hits/misses/evictions) y de la cola de escritura
+        "session_cache": memory_manager.cache_stats(),
+        "write_queue": memory_manager.write_queue_stats(),
+        "response_cache": get_response_cache().stats(),
+        "single_flight": {**get_single_flight().stats, "in_flight": get_single_flight().in_flight()},
+        # Estado por réplica de vLLM (circuit breaker, peticiones en curso, latencia EWMA)
+        "llm_endpoints": medical_chain.llm.endpoints.stats(),
+        "hedging": get_hedge_policy().stats(),
+        # Deltas del LLM frente a tramas SSE enviadas
+        "sse_framing": framing_stats(),
+        # Streams en curso, sin cliente (en gracia), reanudados y tramas en disco
+        "resumable_streams": stream_registry.stats(),
+        # Conexiones, streams, créditos agotados y tráfico del WebSocket multiplexado
+        "websocket": mux_stats(),
+        # Plazas, cola y espera por backend del control de admisión
+        "admission": admission.stats(),
+        # Throughput de prefill/decode y timeouts por fase aprendidos por endpoint
+        "latency_model": get_latency_model().stats(),
+        "context_assembler": get_context_assembler().stats,
+        # Prefijo compartido entre peticiones (estimación local del prefix cache de vLLM)
+        "prefix_cache": get_prefix_tracker().stats(),
+        # Último reporte de mantenimiento de este worker (None si aún no ha corrido)
+        "maintenance": maintenance_scheduler.last_report,
+    }
 
 
 # Endpoints de autenticación
@@ -243,7 +399,7 @@ async def health():
 async def register(req: RegisterRequest):
     """Registrar nuevo usuario"""
     try:
-        result = auth_manager.register_user(req.email, req.password, req.name)
+        result = await auth_manager.register_user_async(req.email, req.password, req.name)
         if result.get("success"):
             return AuthResponse(success=True, user={"id": result["user_id"], "email": req.email, "name": req.name})
         else:
@@ -257,7 +413,7 @@ async def register(req: RegisterRequest):
 async def login(req: LoginRequest):
     """Iniciar sesión"""
     try:
-        result = auth_manager.login_user(req.email, req.password)
+        result = await auth_manager.login_user_async(req.email, req.password)
         if result.get("success"):
             return AuthResponse(
                 success=True,
@@ -277,7 +433,7 @@ async def logout(user: Dict[str, Any] = Depends(require_auth), authorization: Op
     try:
         if authorization and authorization.startswith("Bearer "):
             token = authorization[7:]
-            auth_manager.logout_user(token)
+            await auth_manager.logout_user_async(token)
         return {"success": True}
     except Exception as e:
         logger.error(f"Error en logout: {e}")
@@ -290,6 +446,131 @@ async def get_current_user_info(user: Dict[str, Any] = Depends(require_auth)):
     return {"success": True, "user": user}
 
 
+class PreferencesRequest(BaseModel):
+    response_cache: bool
+
+
+@app.patch("/api/auth/preferences")
+async def update_preferences(req: PreferencesRequest, user: Dict[str, Any] = Depends(require_auth)):
+    """Preferencias del usuario (opt-out del cache de respuestas)"""
+    ok = await auth_manager.set_response_cache_async(user["user_id"], req.response_cache)
+    if not ok:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    return {"success": True, "response_cache": req.response_cache}
+
+
+def new_request_id() -> str:
+    return f"req-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+
+
+async def prepare_chat(req: ChatRequest, user: Dict[str, Any], client_ip: str, request_id: str) -> str:
+    """Rate limiting, validación del mensaje y sesión de un turno de chat (HTTP y WebSocket); devuelve el session_id"""
+    # Aplicar rate limiting
+    if not rate_limiter.is_allowed(client_ip):
+        remaining = rate_limiter.get_remaining(client_ip)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Demasiadas peticiones. Intenta de nuevo en un momento. Peticiones restantes: {remaining}"
+        )
+    
+    logger.info(f"📥 Nuevo mensaje - User: {user.get('email')}, Session: {req.session_id}, Request ID: {request_id}, Tiene imagen: {req.image is not None}")
+    
+    # Validar que haya mensaje o imagen
+    if not req.message and not req.image:
+        raise HTTPException(status_code=400, detail="Message or image is required")
+    
+    # Validar y sanitizar entrada del usuario (LLM01: Inyección de Prompts)
+    if req.message:
+        is_valid, sanitized, error = security_manager.validate_input(req.message)
+        if not is_valid:
+            logger.warning(f"⚠️ Intento de inyección de prompts bloqueado para usuario {user.get('email')}: {error}")
+            raise HTTPException(status_code=400, detail=error)
+        req.message = sanitized
+    
+    # Generar session_id si no existe
+    # IMPORTANTE: NO reutilizar automáticamente la última conversación para evitar mezclar historiales
+    # Cada conversación debe tener su propio session_id único
+    if not req.session_id:
+        # Si no hay session_id, crear uno nuevo
+        session_id = str(uuid.uuid4())
+        logger.info(f"🆕 Creando nueva conversación: {session_id[:8]}...")
+    else:
+        session_id = req.session_id
+        # Validar que el session_id proporcionado pertenezca al usuario
+        if req.user_id:
+            if not await memory_manager.conversation_belongs_to_user_async(session_id, req.user_id):
+                logger.warning(f"⚠️ Session {session_id[:8]} no pertenece al usuario {req.user_id}. Creando nueva conversación.")
+                session_id = str(uuid.uuid4())
+                logger.info(f"🆕 Nueva conversación creada: {session_id[:8]}...")
+    
+    # Asegurar conversación si viene user_id
+    if req.user_id:
+        await memory_manager.ensure_conversation_async(req.user_id, session_id)
+    return session_id
+
+
+def register_image_request(request_id: str, session_id: str, user_id: str):
+    """Registrar request activo para cancelación (imágenes con Ollama)"""
+    active_requests[request_id] = {
+        "session_id": session_id,
+        "user_id": user_id,
+        "provider": "ollama",  # Indicar que es Ollama
+        "type": "image",  # Tipo de request
+        "abort_controller": None,  # Se asignará en process_image_stream
+    }
+
+
+def open_image_stream(req: ChatRequest, session_id: str, request_id: str):
+    """Stream de análisis de imagen (tramas SSE); 429 ahora si no habría plaza, que se espera dentro del stream"""
+    try:
+        admission.check("ollama")
+    except AdmissionRejected as e:
+        active_requests.pop(request_id, None)
+        raise too_busy(e)
+    return process_image_stream(req.message, req.image, session_id, request_id)
+
+
+async def start_text_stream(req: ChatRequest, user: Dict[str, Any], user_id: str, session_id: str, request_id: str) -> ResumableStream:
+    """Arrancar la generación de un stream de texto en su propia tarea (ver stream_resume.py)"""
+    # 429 antes de guardar nada si no habría plaza en vLLM a tiempo
+    try:
+        admission.check("vllm")
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    # Un reintento con el mismo request_id no debe arrancar otra generación: se registra el stream
+    # antes del primer await para que dos peticiones simultáneas no pasen las dos la comprobación
+    abort_controller = AbortController()
+    stream = stream_registry.create(request_id, user_id, session_id, abort=abort_controller.abort)
+    if stream is None:
+        raise HTTPException(
+            status_code=409,
+            detail=f"La generación {request_id} ya existe; reanúdala con GET /api/chat/stream/{request_id}",
+        )
+    # Guardar mensaje del usuario antes de iniciar streaming
+    try:
+        await memory_manager.add_message_to_conversation_async(session_id, "user", req.message or "", {"stream": True, "user_id": req.user_id}, message_uid(request_id, "user"))
+    except Exception as _e:
+        logger.warning(f"⚠️ No se pudo persistir mensaje de usuario (stream): {_e}")
+    
+    # Registrar request activo: /api/chat/cancel aborta el stream y la generación en vLLM
+    active_requests[request_id] = {
+        "session_id": session_id,
+        "user_id": user_id,
+        "provider": "vllm",
+        "type": "text_stream",
+        "vllm_request_id": request_id,
+        "abort_controller": abort_controller,
+    }
+    
+    # La generación corre en su propia tarea y escribe las tramas en el buffer del stream;
+    # las respuestas solo lo leen (si se cortan, el cliente reanuda con Last-Event-ID)
+    stream_registry.start(stream, process_text_stream(
+        req.message, session_id, user_name=user.get('name'), request_id=request_id,
+        use_cache=user.get('response_cache', True), abort_signal=abort_controller.signal,
+    ))
+    return stream
+
+
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require_auth), request: Request = None):
     """Endpoint principal para chat con soporte de imágenes y streaming - Requiere autenticación"""
@@ -299,68 +580,21 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
         # Obtener IP del cliente (FastAPI inyecta Request automáticamente)
         client_ip = request.client.host if request and request.client else 'unknown'
         
-        # Aplicar rate limiting
-        if not rate_limiter.is_allowed(client_ip):
-            remaining = rate_limiter.get_remaining(client_ip)
-            raise HTTPException(
-                status_code=429,
-                detail=f"Demasiadas peticiones. Intenta de nuevo en un momento. Peticiones restantes: {remaining}"
-            )
-        
         # Generar request_id si no se proporciona
-        request_id = req.request_id or f"req-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
-        
-        logger.info(f"📥 Nuevo mensaje - User: {user.get('email')}, Session: {req.session_id}, Request ID: {request_id}, Tiene imagen: {req.image is not None}")
-        
-        # Validar que haya mensaje o imagen
-        if not req.message and not req.image:
-            raise HTTPException(status_code=400, detail="Message or image is required")
+        request_id = req.request_id or new_request_id()
         
-        # Validar y sanitizar entrada del usuario (LLM01: Inyección de Prompts)
-        if req.message:
-            is_valid, sanitized, error = security_manager.validate_input(req.message)
-            if not is_valid:
-                logger.warning(f"⚠️ Intento de inyección de prompts bloqueado para usuario {user.get('email')}: {error}")
-                raise HTTPException(status_code=400, detail=error)
-            req.message = sanitized
-        
-        # Generar session_id si no existe
-        # IMPORTANTE: NO reutilizar automáticamente la última conversación para evitar mezclar historiales
-        # Cada conversación debe tener su propio session_id único
-        if not req.session_id:
-            # Si no hay session_id, crear uno nuevo
-            session_id = str(uuid.uuid4())
-            logger.info(f"🆕 Creando nueva conversación: {session_id[:8]}...")
-        else:
-            session_id = req.session_id
-            # Validar que el session_id proporcionado pertenezca al usuario
-            if req.user_id:
-                if not memory_manager.conversation_belongs_to_user(session_id, req.user_id):
-                    logger.warning(f"⚠️ Session {session_id[:8]} no pertenece al usuario {req.user_id}. Creando nueva conversación.")
-                    session_id = str(uuid.uuid4())
-                    logger.info(f"🆕 Nueva conversación creada: {session_id[:8]}...")
-        
-        # Asegurar conversación si viene user_id
-        if req.user_id:
-            memory_manager.ensure_conversation(req.user_id, session_id)
+        session_id = await prepare_chat(req, user, client_ip, request_id)
         
         # Procesar imagen si existe
         if req.image:
             logger.info("🖼️ Procesando imagen médica")
             
-            # Registrar request activo para cancelación (imágenes con Ollama)
-            active_requests[request_id] = {
-                "session_id": session_id,
-                "user_id": user_id,
-                "provider": "ollama",  # Indicar que es Ollama
-                "type": "image",  # Tipo de request
-                "abort_controller": None,  # Se asignará en process_image_stream
-            }
+            register_image_request(request_id, session_id, user_id)
             
             if req.stream:
                 # Streaming con imagen
                 return StreamingResponse(
-                    process_image_stream(req.message, req.image, session_id, request_id),
+                    open_image_stream(req, session_id, request_id),
                     media_type="text/event-stream",
                     headers={
                         'Cache-Control': 'no-cache',
@@ -373,7 +607,7 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                 start_ts = int(time.time() * 1000)
                 # Guardar mensaje del usuario en historial antes del análisis
                 try:
-                    memory_manager.add_message_to_conversation(session_id, "user", req.message or "[Imagen enviada]", {"has_image": True})
+                    await memory_manager.add_message_to_conversation_async(session_id, "user", req.message or "[Imagen enviada]", {"has_image": True}, message_uid(request_id, "user"))
                 except Exception as _e:
                     logger.warning(f"⚠️ No se pudo persistir mensaje de usuario (imagen): {_e}")
 
@@ -384,7 +618,7 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                     # Obtener historial de conversación
                     from langchain_system import get_medical_chain
                     medical_chain_instance = get_medical_chain(VLLM_ENDPOINT)
-                    history = medical_chain_instance._get_chat_history(session_id)
+                    history = await medical_chain_instance._get_chat_history_async(session_id)
                     conversation_history = history.messages[-5:] if history.messages else []
                     
                     # Obtener contexto de entidades
@@ -401,16 +635,17 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                 active_requests[request_id]["abort_controller"] = abort_controller
                 
                 try:
-                    analysis_result = await analyze_image_with_fallback(
-                        req.image,
-                        req.image_format,
-                        req.message or "Analiza esta radiografía médica del IMSS",
-                        session_id=session_id,
-                        conversation_history=conversation_history,
-                        entity_context=entity_context,
-                        system_prompt=system_prompt,
-                        abort_controller=abort_controller
-                    )
+                    async with admission_slot("ollama"):
+                        analysis_result = await analyze_image_with_fallback(
+                            req.image,
+                            req.image_format,
+                            req.message or "Analiza esta radiografía médica del IMSS",
+                            session_id=session_id,
+                            conversation_history=conversation_history,
+                            entity_context=entity_context,
+                            system_prompt=system_prompt,
+                            abort_controller=abort_controller
+                        )
                 finally:
                     # Limpiar request activo
                     if request_id in active_requests:
@@ -428,7 +663,7 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                 
                 # Persistir respuesta del asistente
                 try:
-                    memory_manager.add_message_to_conversation(session_id, "assistant", analysis_result.get('analysis', ''), {"is_image_analysis": True, "model": analysis_result.get('model', 'unknown'), "provider": analysis_result.get('provider', 'unknown'), "file": file_info})
+                    await memory_manager.add_message_to_conversation_async(session_id, "assistant", analysis_result.get('analysis', ''), {"is_image_analysis": True, "model": analysis_result.get('model', 'unknown'), "provider": analysis_result.get('provider', 'unknown'), "file": file_info}, message_uid(request_id, "assistant"))
                 except Exception as _e:
                     logger.warning(f"⚠️ No se pudo persistir respuesta del asistente (imagen): {_e}")
 
@@ -436,7 +671,7 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                 try:
                     end_ts = int(time.time() * 1000)
                     output_text = analysis_result.get('analysis', '') or ''
-                    memory_manager.log_chat_metrics(
+                    await memory_manager.log_chat_metrics_async(
                         session_id=session_id,
                         input_chars=len(req.message or ''),
                         output_chars=len(output_text),
@@ -466,40 +701,34 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
         
         # Procesar mensaje de texto
         if req.stream:
-            # Streaming con texto
-            # Guardar mensaje del usuario antes de iniciar streaming
-            try:
-                memory_manager.add_message_to_conversation(session_id, "user", req.message or "", {"stream": True, "user_id": req.user_id})
-            except Exception as _e:
-                logger.warning(f"⚠️ No se pudo persistir mensaje de usuario (stream): {_e}")
-
-            # Obtener nombre del usuario para personalización
-            user_name = user.get('name')
-            
+            # Streaming con texto: la generación sigue aunque se corte esta respuesta
+            stream = await start_text_stream(req, user, user_id, session_id, request_id)
             return StreamingResponse(
-                process_text_stream(req.message, session_id, user_name=user_name),
+                stream_registry.follow(stream, 0, request.is_disconnected if request else None),
                 media_type="text/event-stream",
                 headers={
                     'Cache-Control': 'no-cache',
                     'Connection': 'keep-alive',
                     'X-Accel-Buffering': 'no',
-                    'Content-Type': 'text/event-stream; charset=utf-8'
+                    'Content-Type': 'text/event-stream; charset=utf-8',
+                    'X-Stream-Id': request_id,
                 }
             )
         else:
             # Sin streaming - texto
             # Persistir mensaje del usuario
             try:
-                memory_manager.add_message_to_conversation(session_id, "user", req.message or "")
+                await memory_manager.add_message_to_conversation_async(session_id, "user", req.message or "", None, message_uid(request_id, "user"))
             except Exception as _e:
                 logger.warning(f"⚠️ No se pudo persistir mensaje de usuario (texto): {_e}")
 
             if req.json_mode:
                 start_ts = int(time.time() * 1000)
-                result_json = await medical_chain.process_chat_json(req.message)
+                async with admission_slot("vllm"):
+                    result_json = await medical_chain.process_chat_json(req.message)
                 # Persistir JSON como texto para historial
                 try:
-                    memory_manager.add_message_to_conversation(session_id, "assistant", json.dumps(result_json, ensure_ascii=False))
+                    await memory_manager.add_message_to_conversation_async(session_id, "assistant", json.dumps(result_json, ensure_ascii=False), None, message_uid(request_id, "assistant"))
                 except Exception as _e:
                     logger.warning(f"⚠️ No se pudo persistir respuesta JSON: {_e}")
                 try:
@@ -508,13 +737,13 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                     # Intentar estimar tokens (usage) con una llamada mínima
                     try:
                         messages = await medical_chain.build_context_messages(req.message, use_entities=True)
-                        usage = await medical_chain.estimate_usage_from_messages(messages)
+                        usage = await medical_chain.estimate_usage_from_messages(messages, out_text)
                         input_tokens = usage.get('input_tokens')
                         output_tokens = usage.get('output_tokens')
                         total_tokens = usage.get('total_tokens')
                     except Exception:
                         input_tokens = output_tokens = total_tokens = None
-                    memory_manager.log_chat_metrics(
+                    await memory_manager.log_chat_metrics_async(
                         session_id=session_id,
                         input_chars=len(req.message or ''),
                         output_chars=len(out_text),
@@ -555,11 +784,12 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                     start_ts = int(time.time() * 1000)
                     # Obtener nombre del usuario para personalización
                     user_name = user.get('name')
-                    response = await medical_chain.process_chat(req.message, session_id, request_id=request_id, user_name=user_name)
+                    async with admission_slot("vllm"):
+                        response = await medical_chain.process_chat(req.message, session_id, request_id=request_id, user_name=user_name)
                     
                     # Persistir respuesta del asistente
                     try:
-                        memory_manager.add_message_to_conversation(session_id, "assistant", response or "")
+                        await memory_manager.add_message_to_conversation_async(session_id, "assistant", response or "", None, message_uid(request_id, "assistant"))
                     except Exception as _e:
                         logger.warning(f"⚠️ No se pudo persistir respuesta del asistente (texto): {_e}")
                     
@@ -568,13 +798,13 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
                         # Intentar estimar tokens (usage)
                         try:
                             messages = await medical_chain.build_context_messages(req.message, use_entities=True)
-                            usage = await medical_chain.estimate_usage_from_messages(messages)
+                            usage = await medical_chain.estimate_usage_from_messages(messages, response or '')
                             input_tokens = usage.get('input_tokens')
                             output_tokens = usage.get('output_tokens')
                             total_tokens = usage.get('total_tokens')
                         except Exception:
                             input_tokens = output_tokens = total_tokens = None
-                        memory_manager.log_chat_metrics(
+                        await memory_manager.log_chat_metrics_async(
                             session_id=session_id,
                             input_chars=len(req.message or ''),
                             output_chars=len(response or ''),
@@ -615,6 +845,50 @@ async def chat_endpoint(req: ChatRequest, user: Dict[str, Any] = Depends(require
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def resumable_stream_for(stream_id: str, user: Dict[str, Any], last_event_id: Any) -> Tuple[ResumableStream, int]:
+    """Stream del usuario y última trama recibida por el cliente (HTTPException si no se puede reanudar)"""
+    stream = stream_registry.get(stream_id)
+    if stream is None:
+        # El registro es por worker: sin sticky sessions la reconexión puede caer en otro worker.
+        # La respuesta se persiste igualmente al terminar, así que el cliente la recupera del historial
+        raise HTTPException(
+            status_code=404,
+            detail="Stream no encontrado o expirado en este worker; recupera la respuesta con GET /api/history/since",
+        )
+    user_id = user.get('user_id') or user.get('id', 'unknown')
+    if stream.user_id != user_id:
+        raise HTTPException(status_code=403, detail="No autorizado para reanudar este stream")
+    try:
+        after = int(last_event_id) if last_event_id else 0
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Last-Event-ID inválido")
+    if after < 0 or after > stream.last_id:
+        raise HTTPException(status_code=400, detail=f"Last-Event-ID fuera de rango (última trama: {stream.last_id})")
+    return stream, after
+
+
+@app.get("/api/chat/stream/{stream_id}")
+async def resume_chat_stream(
+    stream_id: str,
+    request: Request,
+    user: Dict[str, Any] = Depends(require_auth),
+    last_event_id: Optional[str] = Header(None),
+):
+    """Reanudar un stream de chat: tramas posteriores a Last-Event-ID y después el resto en vivo"""
+    stream, after = resumable_stream_for(stream_id, user, last_event_id)
+    return StreamingResponse(
+        stream_registry.follow(stream, after, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={
+            'Cache-Control': 'no-cache',
+            'Connection': 'keep-alive',
+            'X-Accel-Buffering': 'no',
+            'Content-Type': 'text/event-stream; charset=utf-8',
+            'X-Stream-Id': stream_id,
+        }
+    )
+
+
 @app.post("/api/chat/cancel")
 async def cancel_chat_endpoint(req: CancelRequest, user: Dict[str, Any] = Depends(require_auth)):
     """Endpoint para cancelar una generación activa"""
@@ -646,14 +920,23 @@ async def cancel_chat_endpoint(req: CancelRequest, user: Dict[str, Any] = Depend
             else:
                 logger.warning(f"⚠️ No se encontró AbortController para request_id: {req.request_id}")
         elif provider == "vllm":
-            # Para vLLM, usar el endpoint de cancelación
+            # Streams: cortar el stream local (aborta también reintentos y coberturas en curso).
+            # La generación en vLLM la cancela single_flight cuando se va el último suscriptor:
+            # cancelarla aquí cortaría también a las peticiones idénticas suscritas a ella
+            abort_controller = request_info.get("abort_controller")
+            if abort_controller:
+                abort_controller.abort()
+            # Peticiones sin stream: usar el endpoint de cancelación de vLLM
             vllm_request_id = request_info.get("vllm_request_id")
-            if vllm_request_id:
+            if vllm_request_id and request_info.get("type") != "text_stream":
                 try:
                     # Llamar al endpoint de cancelación de vLLM
                     async with httpx.AsyncClient(timeout=5.0) as client:
+                        # Réplica que atiende el request (o la principal si ya terminó)
+                        endpoint = medical_chain.llm.endpoints.endpoint_for(vllm_request_id)
+                        endpoint_url = endpoint.url if endpoint else VLLM_ENDPOINT
                         # Construir URL correcta: quitar /v1/ del final si existe
-                        base_url = VLLM_ENDPOINT.rstrip('/v1/').rstrip('/')
+                        base_url = endpoint_url.rstrip('/v1/').rstrip('/')
                         cancel_url = f"{base_url}/v1/requests/{vllm_request_id}/cancel"
                         await client.post(cancel_url)
                         logger.info(f"✅ Cancelación enviada a vLLM para request_id: {req.request_id}")
@@ -673,7 +956,14 @@ async def cancel_chat_endpoint(req: CancelRequest, user: Dict[str, Any] = Depend
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def process_text_stream(message: str, session_id: str, user_name: Optional[str] = None):
+async def process_text_stream(
+    message: str,
+    session_id: str,
+    user_name: Optional[str] = None,
+    request_id: Optional[str] = None,
+    use_cache: bool = True,
+    abort_signal: Optional[AbortSignal] = None,
+):
     """
     Procesar texto con streaming usando Server-Sent Events (SSE)
     
@@ -693,45 +983,81 @@ async def process_text_stream(message: str, session_id: str, user_name: Optional
         message: Mensaje del usuario
         session_id: ID de sesión
         user_name: Nombre del usuario para personalización
+        request_id: ID de request (ids de mensaje compartidos con stream_chat; también el id en vLLM)
+        use_cache: Usar el cache de respuestas (preferencia del usuario)
+        abort_signal: Señal de /api/chat/cancel o del registro de streams (nadie se reconectó a tiempo)
+
+    Corre en la tarea del stream reanudable (stream_resume.py), no en la respuesta HTTP: una
+    desconexión del cliente no la interrumpe; cada trama recibe su `id:` al leerse del buffer.
     """
     try:
         full_response = ""
         start_ts = int(time.time() * 1000)
         chunk_count = 0
+        # Lo rellena el stream con el usage final de vLLM (o el conteo local)
+        usage: Dict[str, Any] = {}
         
         logger.info(f"🔄 Iniciando streaming para sesión {session_id[:8]}...")
         
+        # Plaza en vLLM durante toda la generación (la espera en cola cuenta como parte del primer token)
+        try:
+            ticket = await admission.acquire("vllm")
+        except AdmissionRejected as e:
+            yield encode_event({'error': 'El servicio está saturado. Intenta de nuevo en unos segundos.', 'retry_after': e.retry_after})
+            return
+        
+        # Deltas agrupados por ventana de tiempo: una trama SSE (y una escritura) por grupo
+        batcher = ChunkBatcher()
+        
         # Stream chunks desde LangChain
         try:
-            async for chunk in medical_chain.stream_chat(message, session_id, user_name=user_name):
+            source = medical_chain.stream_chat(message, session_id, user_name=user_name, request_id=request_id, usage=usage, use_cache=use_cache)
+            async for chunk in stream_until_disconnect(source, None, abort_signal, batcher=batcher):
                 if chunk:
                     chunk_count += 1
                     # Asegurar que el chunk sea string y esté en UTF-8
                     chunk_str = str(chunk) if not isinstance(chunk, str) else chunk
                     full_response += chunk_str
                     
-                    # Validar chunk individual (sanitización básica)
-                    # Nota: La validación completa se hace al final del stream
-                    chunk_str = html.escape(chunk_str) if chunk_str else ""
-                    
-                    # Enviar chunk como SSE con encoding UTF-8
+                    # Sanitización básica por trama (la validación completa se hace al final del stream)
                     # Formato: data: {"content": "chunk", "done": false}\n\n
-                    chunk_data = json.dumps({'content': chunk_str, 'done': False}, ensure_ascii=False)
-                    yield f"data: {chunk_data}\n\n"
+                    yield encode_content(html.escape(chunk_str))
+        except ClientDisconnected:
+            # Cancelada o sin clientes pasada la gracia: la generación ya se canceló en vLLM; guardar lo recibido
+            if batcher.pending:
+                full_response += batcher.flush()
+            logger.info(f"🛑 Generación abortada ({request_id}, {batcher.chunks} chunks)")
+            if full_response:
+                try:
+                    await memory_manager.add_message_to_conversation_async(
+                        session_id, "assistant", security_manager.validate_output(full_response),
+                        {"stream": True, "aborted": True}, message_uid(request_id, "assistant"),
+                    )
+                except Exception as persist_err:
+                    logger.warning(f"⚠️ No se pudo persistir respuesta parcial: {persist_err}")
+            if abort_signal is not None and abort_signal.aborted:
+                # Cancelado desde /api/chat/cancel: los clientes conectados esperan el cierre
+                yield encode_event({'content': '', 'done': True, 'cancelled': True, 'session_id': session_id})
+            return
         except Exception as stream_err:
             logger.error(f"❌ Error en stream_chat: {stream_err}", exc_info=True)
-            error_data = json.dumps({'error': f'Error en generación: {str(stream_err)}'}, ensure_ascii=False)
-            yield f"data: {error_data}\n\n"
+            yield encode_event({'error': f'Error en generación: {str(stream_err)}'})
             return
+        finally:
+            ticket.release()
+            batcher.close()
         
-        logger.info(f"✅ Streaming completado: {chunk_count} chunks, {len(full_response)} caracteres totales")
+        logger.info(f"✅ Streaming completado: {batcher.chunks} chunks en {chunk_count} tramas, {len(full_response)} caracteres totales")
         
         # Validar y sanitizar respuesta completa (LLM05, LLM07)
         validated_response = security_manager.validate_output(full_response)
         
         # Persistir respuesta completa al finalizar el stream
+        # (se encola en la cola write-behind: el evento done no espera al commit).
+        # stream_chat ya guardó la versión normalizada y validada con el mismo message_uid;
+        # esta escritura solo entra si aquella falló
         try:
-            memory_manager.add_message_to_conversation(session_id, "assistant", validated_response, {"stream": True})
+            await memory_manager.add_message_to_conversation_async(session_id, "assistant", validated_response, {"stream": True}, message_uid(request_id, "assistant"))
             logger.debug(f"💾 Respuesta persistida para sesión {session_id[:8]}")
         except Exception as persist_err:
             logger.error(f"❌ Error persistiendo respuesta: {persist_err}", exc_info=True)
@@ -741,15 +1067,18 @@ async def process_text_stream(message: str, session_id: str, user_name: Optional
         try:
             end_ts = int(time.time() * 1000)
             duration_ms = end_ts - start_ts
-            memory_manager.log_chat_metrics(
+            await memory_manager.log_chat_metrics_async(
                 session_id=session_id,
                 input_chars=len(message or ''),
                 output_chars=len(full_response or ''),
+                input_tokens=usage.get('prompt_tokens'),
+                output_tokens=usage.get('completion_tokens'),
+                total_tokens=usage.get('total_tokens'),
                 started_at=start_ts,
                 ended_at=end_ts,
                 duration_ms=duration_ms,
                 model='google/medgemma-27b',
-                provider='vllm',
+                provider='cache' if usage.get('cached') else 'vllm',
                 stream=True,
                 is_image=False,
                 success=True,
@@ -761,14 +1090,16 @@ async def process_text_stream(message: str, session_id: str, user_name: Optional
 
         # Enviar señal de finalización
         # Formato: data: {"content": "", "done": true, "session_id": "..."}\n\n
-        final_data = json.dumps({'content': '', 'done': True, 'session_id': session_id}, ensure_ascii=False)
-        yield f"data: {final_data}\n\n"
+        yield encode_event({'content': '', 'done': True, 'session_id': session_id})
         
     except Exception as e:
         logger.error(f"❌ Error crítico en streaming de texto: {e}", exc_info=True)
         logger.error(f"📋 Tipo de error: {type(e).__name__}")
-        error_data = json.dumps({'error': str(e)}, ensure_ascii=False)
-        yield f"data: {error_data}\n\n"
+        yield encode_event({'error': str(e)})
+    finally:
+        # Limpiar request activo (registrado en chat_endpoint)
+        if request_id:
+            active_requests.pop(request_id, None)
 
 
 async def process_image_stream(message: str, image_data: str, session_id: str, request_id: str):
@@ -781,13 +1112,21 @@ async def process_image_stream(message: str, image_data: str, session_id: str, r
         if request_id in active_requests:
             active_requests[request_id]["abort_controller"] = abort_controller
         
-        async for chunk in medical_chain.stream_medical_analysis(message, image_data, session_id, abort_controller=abort_controller):
-            # Verificar si fue cancelado
-            if abort_controller.signal.aborted:
-                logger.info(f"🛑 Streaming de imagen cancelado para request_id: {request_id}")
-                yield f"data: {json.dumps({'content': '', 'done': True, 'cancelled': True, 'session_id': session_id})}\n\n"
-                return
-            yield f"data: {json.dumps({'content': chunk, 'done': False})}\n\n"
+        try:
+            ticket = await admission.acquire("ollama")
+        except AdmissionRejected as e:
+            yield f"data: {json.dumps({'error': 'El servicio está saturado. Intenta de nuevo en unos segundos.', 'retry_after': e.retry_after})}\n\n"
+            return
+        try:
+            async for chunk in medical_chain.stream_medical_analysis(message, image_data, session_id, abort_controller=abort_controller):
+                # Verificar si fue cancelado
+                if abort_controller.signal.aborted:
+                    logger.info(f"🛑 Streaming de imagen cancelado para request_id: {request_id}")
+                    yield f"data: {json.dumps({'content': '', 'done': True, 'cancelled': True, 'session_id': session_id})}\n\n"
+                    return
+                yield f"data: {json.dumps({'content': chunk, 'done': False})}\n\n"
+        finally:
+            ticket.release()
         
         yield f"data: {json.dumps({'content': '', 'done': True, 'session_id': session_id})}\n\n"
     except asyncio.CancelledError:
@@ -817,7 +1156,7 @@ async def image_analysis_endpoint(req: ImageAnalysisRequest):
             if req.session_id:
                 from langchain_system import get_medical_chain
                 medical_chain_instance = get_medical_chain(VLLM_ENDPOINT)
-                history = medical_chain_instance._get_chat_history(req.session_id)
+                history = await medical_chain_instance._get_chat_history_async(req.session_id)
                 conversation_history = history.messages[-5:] if history.messages else []
                 
                 # Obtener contexto de entidades
@@ -828,15 +1167,17 @@ async def image_analysis_endpoint(req: ImageAnalysisRequest):
         except Exception as e:
             logger.warning(f"⚠️ No se pudo obtener contexto de Langchain: {e}")
         
-        analysis_result = await analyze_image_with_fallback(
-            req.image_data,
-            req.image_format,
-            req.prompt,
-            session_id=req.session_id,
-            conversation_history=conversation_history,
-            entity_context=entity_context,
-            system_prompt=system_prompt
-        )
+        # Endpoint de API (sin chat interactivo): cede las plazas de Ollama al chat
+        async with admission_slot("ollama", PRIORITY_BATCH):
+            analysis_result = await analyze_image_with_fallback(
+                req.image_data,
+                req.image_format,
+                req.prompt,
+                session_id=req.session_id,
+                conversation_history=conversation_history,
+                entity_context=entity_context,
+                system_prompt=system_prompt
+            )
         
         if not analysis_result.get('success'):
             raise HTTPException(status_code=500, detail=analysis_result.get('error'))
@@ -868,12 +1209,11 @@ async def transcribe_endpoint(req: TranscriptionRequest, user: Dict[str, Any] =
     try:
         logger.info(f"🎤 Transcribiendo audio - User: {user.get('email')}, Formato: {req.audio_format}")
         
-        # Transcribir audio
-        transcription_result = transcribe_audio(
-            req.audio_data,
-            req.audio_format,
-            req.language
-        )
+        # Transcribir audio fuera del event loop (Whisper es síncrono), con plaza en el backend
+        async with admission_slot("whisper"):
+            transcription_result = await asyncio.get_running_loop().run_in_executor(
+                None, transcribe_audio, req.audio_data, req.audio_format, req.language
+            )
         
         if not transcription_result.get('success'):
             raise HTTPException(status_code=500, detail=transcription_result.get('error', 'Error en transcripción'))
@@ -971,62 +1311,71 @@ def get_kani_tts_model():
     return _kani_tts_model
 
 
+async def synthesize_speech(text: str, speaker_id: Optional[str]) -> Tuple[bytes, int, str]:
+    """Audio WAV de `text` con KaniTTS (CPU): (wav, sample_rate, texto procesado); HTTPException si falla"""
+    # Validar que el texto no esté vacío
+    if not text or not text.strip():
+        raise HTTPException(status_code=400, detail="El texto no puede estar vacío")
+    
+    # Limitar longitud del texto (máximo 2000 caracteres para evitar problemas)
+    text = text.strip()[:2000]
+    
+    # Obtener modelo KaniTTS
+    try:
+        model = get_kani_tts_model()
+    except (ModuleNotFoundError, ImportError) as e:
+        error_detail = (
+            "El servicio de Text-to-Speech no está disponible. "
+            "Faltan dependencias necesarias. "
+            "Por favor, instala nemo-toolkit ejecutando: pip install nemo-toolkit[all] "
+            "o reinstala kani-tts con todas sus dependencias: pip install kani-tts"
+        )
+        logger.error(f"❌ Error en TTS (dependencias faltantes): {e}")
+        raise HTTPException(status_code=503, detail=error_detail)
+    
+    # Generar audio
+    # Usar speaker_id si está disponible
+    try:
+        # Fuera del event loop (KaniTTS es síncrono en CPU), con plaza en el backend
+        async with admission_slot("tts"):
+            if hasattr(model, 'speaker_list') and speaker_id in (model.speaker_list or []):
+                audio, processed_text = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: model(text, speaker_id=speaker_id)
+                )
+            else:
+                audio, processed_text = await asyncio.get_running_loop().run_in_executor(None, model, text)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error generando audio: {e}")
+        raise HTTPException(status_code=500, detail=f"Error generando audio: {str(e)}")
+    
+    import io
+    import soundfile as sf
+    
+    # Guardar audio en buffer en memoria
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, model.sample_rate, format='WAV')
+    return buffer.getvalue(), model.sample_rate, processed_text
+
+
 @app.post("/api/tts")
 async def tts_endpoint(req: TTSRequest, user: Dict[str, Any] = Depends(require_auth)):
     """Endpoint para generar audio desde texto usando KaniTTS (CPU)"""
     try:
         logger.info(f"🔊 Generando audio TTS - User: {user.get('email')}, Texto: {req.text[:50]}...")
         
-        # Validar que el texto no esté vacío
-        if not req.text or not req.text.strip():
-            raise HTTPException(status_code=400, detail="El texto no puede estar vacío")
-        
-        # Limitar longitud del texto (máximo 2000 caracteres para evitar problemas)
-        text = req.text.strip()[:2000]
-        
-        # Obtener modelo KaniTTS
-        try:
-            model = get_kani_tts_model()
-        except (ModuleNotFoundError, ImportError) as e:
-            error_detail = (
-                "El servicio de Text-to-Speech no está disponible. "
-                "Faltan dependencias necesarias. "
-                "Por favor, instala nemo-toolkit ejecutando: pip install nemo-toolkit[all] "
-                "o reinstala kani-tts con todas sus dependencias: pip install kani-tts"
-            )
-            logger.error(f"❌ Error en TTS (dependencias faltantes): {e}")
-            raise HTTPException(status_code=503, detail=error_detail)
-        
-        # Generar audio
-        # Usar speaker_id si está disponible
-        try:
-            if hasattr(model, 'speaker_list') and req.speaker_id in (model.speaker_list or []):
-                audio, processed_text = model(text, speaker_id=req.speaker_id)
-            else:
-                audio, processed_text = model(text)
-        except Exception as e:
-            logger.error(f"❌ Error generando audio: {e}")
-            raise HTTPException(status_code=500, detail=f"Error generando audio: {str(e)}")
+        wav, sample_rate, processed_text = await synthesize_speech(req.text, req.speaker_id)
         
         # Convertir audio a base64 para enviarlo al frontend
-        import base64
-        import io
-        import soundfile as sf
-        
-        # Guardar audio en buffer en memoria
-        buffer = io.BytesIO()
-        sf.write(buffer, audio, model.sample_rate, format='WAV')
-        buffer.seek(0)
-        
-        # Convertir a base64
-        audio_base64 = base64.b64encode(buffer.read()).decode('utf-8')
+        audio_base64 = base64.b64encode(wav).decode('utf-8')
         
         logger.info(f"✅ Audio generado exitosamente - Tamaño: {len(audio_base64)} caracteres base64")
         
         return {
             "success": True,
             "audio_data": audio_base64,
-            "sample_rate": model.sample_rate,
+            "sample_rate": sample_rate,
             "format": "wav",
             "text": processed_text
         }
@@ -1037,22 +1386,200 @@ async def tts_endpoint(req: TTSRequest, user: Dict[str, Any] = Depends(require_a
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# --- Transporte WebSocket multiplexado (ws_mux.py) ---
+
+def _ws_chat_request(message: Dict[str, Any], **extra: Any) -> ChatRequest:
+    """ChatRequest con los campos del mensaje del WebSocket (400 si no son válidos)"""
+    fields = {k: message[k] for k in ("message", "session_id", "user_id", "request_id", "image_format") if message.get(k) is not None}
+    try:
+        return ChatRequest(stream=True, **fields, **extra)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _ws_client_ip(stream: MuxStream) -> str:
+    client = stream.conn.websocket.client
+    return client.host if client else 'unknown'
+
+
+async def _ws_follow(stream: MuxStream, resumable: ResumableStream, after: int = 0):
+    """Reenviar las tramas del stream reanudable; al cerrarse el WebSocket solo se suelta el lector"""
+    async for frame in stream_registry.follow(resumable, after):
+        await stream.send_sse(frame)
+
+
+async def ws_chat(stream: MuxStream, message: Dict[str, Any]):
+    """{"type": "chat", "message": ...}: eventos del chat; "started" lleva el stream_id para reanudar"""
+    user = stream.conn.user
+    user_id = user.get('user_id') or user.get('id', 'unknown')
+    req = _ws_chat_request(message)
+    request_id = req.request_id or new_request_id()
+    session_id = await prepare_chat(req, user, _ws_client_ip(stream), request_id)
+    resumable = await start_text_stream(req, user, user_id, session_id, request_id)
+    stream.on_cancel = resumable.abort
+    await stream.send({"type": "started", "stream_id": request_id, "session_id": session_id})
+    await _ws_follow(stream, resumable)
+
+
+async def ws_resume(stream: MuxStream, message: Dict[str, Any]):
+    """{"type": "resume", "stream_id": ..., "last_event_id": n}: como GET /api/chat/stream/{stream_id}"""
+    resumable, after = resumable_stream_for(str(message.get("stream_id")), stream.conn.user, message.get("last_event_id"))
+    stream.on_cancel = resumable.abort
+    await _ws_follow(stream, resumable, after)
+
+
+async def ws_image(stream: MuxStream, message: Dict[str, Any]):
+    """{"type": "image", "message": ..., "image_format": ...} y la imagen en tramas binarias"""
+    user = stream.conn.user
+    user_id = user.get('user_id') or user.get('id', 'unknown')
+    image_bytes = await stream.read_payload()
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="Image is required")
+    # Ollama recibe la imagen en base64: se codifica una vez aquí en lugar de viajar así por la red
+    req = _ws_chat_request(message, image=base64.b64encode(image_bytes).decode('ascii'))
+    request_id = req.request_id or new_request_id()
+    session_id = await prepare_chat(req, user, _ws_client_ip(stream), request_id)
+    register_image_request(request_id, session_id, user_id)
+
+    def cancel():
+        abort_controller = (active_requests.get(request_id) or {}).get("abort_controller")
+        if abort_controller is not None:
+            abort_controller.abort()
+        else:
+            # Aún esperando plaza en Ollama
+            stream.task.cancel()
+
+    stream.on_cancel = cancel
+    await stream.send({"type": "started", "request_id": request_id, "session_id": session_id})
+    async for frame in open_image_stream(req, session_id, request_id):
+        await stream.send_sse(frame)
+
+
+async def ws_tts(stream: MuxStream, message: Dict[str, Any]):
+    """{"type": "tts", "text": ..., "speaker_id": ...}: metadatos y el WAV en tramas binarias"""
+    wav, sample_rate, processed_text = await synthesize_speech(message.get("text") or "", message.get("speaker_id") or "ash")
+    await stream.send({"type": "audio", "format": "wav", "sample_rate": sample_rate, "size": len(wav), "text": processed_text})
+    await stream.send_binary(wav)
+
+
+async def ws_transcribe(stream: MuxStream, message: Dict[str, Any]):
+    """{"type": "transcribe", "audio_format": ..., "language": ...} y el audio en tramas binarias
+
+    Cada segmento cerrado con FLAG_SEGMENT se transcribe al llegar (transcripción parcial); el
+    mensaje final une los textos.
+    """
+    audio_format = message.get("audio_format") or "webm"
+    language = message.get("language") or "es"
+    texts = []
+    async for segment, last in stream.segments():
+        async with admission_slot("whisper"):
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, transcribe_audio_bytes, segment, audio_format, language
+            )
+        if not result.get('success'):
+            raise HTTPException(status_code=500, detail=result.get('error', 'Error en transcripción'))
+        if result.get('text'):
+            texts.append(result['text'])
+        if not last:
+            await stream.send({"type": "transcript", "partial": True, "text": result.get('text', '')})
+    await stream.send({"type": "transcript", "partial": False, "text": " ".join(texts), "language": language})
+
+
+WS_HANDLERS = {
+    "chat": ws_chat,
+    "resume": ws_resume,
+    "image": ws_image,
+    "tts": ws_tts,
+    "transcribe": ws_transcribe,
+}
+
+
+@app.websocket("/api/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """Chat, imágenes, TTS y transcripción multiplexados sobre una conexión autenticada (ws_mux.py)"""
+    user = await authenticate(websocket, auth_manager.verify_token_async)
+    if user is None:
+        return
+    logger.info(f"🔌 WebSocket abierto - User: {user.get('email')}")
+    await MuxConnection(websocket, WS_HANDLERS, user).run()
+    logger.info(f"🔌 WebSocket cerrado - User: {user.get('email')}")
+
+
+def _history_etag(session_id: str, version: int, *params: Any) -> str:
+    """ETag débil del historial: versión de la sesión + parámetros de la página"""
+    return f'W/"{session_id}-v{version}-' + "-".join(str(p) for p in params) + '"'
+
+
+async def _history_response(
+    session_id: str,
+    user_id: Optional[str],
+    if_none_match: Optional[str],
+    limit: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+):
+    """Respuesta de historial con ETag; 304 si el cliente ya tiene esta versión"""
+    # Validar pertenencia si se proporciona user_id
+    if user_id and not await memory_manager.conversation_belongs_to_user_async(session_id, user_id):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    version = await memory_manager.get_session_version_async(session_id)
+    # Sesiones sin fila en conversations no tienen contador: sin ETag
+    etag = _history_etag(session_id, version, limit, before_id, after_id) if version is not None else None
+    if etag and if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    messages = await memory_manager.get_conversation_history_async(
+        session_id=session_id, limit=limit, before_id=before_id, after_id=after_id
+    )
+    body = {
+        "session_id": session_id,
+        "messages": messages,
+        "version": version,
+        # Cursores: before_id para páginas anteriores, after_id para el siguiente delta
+        "next_before_id": messages[0]["id"] if messages and len(messages) == limit and after_id is None else None,
+        "last_id": messages[-1]["id"] if messages else after_id,
+    }
+    content = json.dumps(body, ensure_ascii=False)
+    return Response(content=content, media_type="application/json", headers={"ETag": etag} if etag else None)
+
+
 @app.get("/api/history")
-async def get_history(session_id: Optional[str] = Query(None, description="Filtrar por session_id"), user_id: Optional[str] = Query(None, description="User ID para validar pertenencia")):
-    """Obtener historial de conversaciones desde SQLite"""
+async def get_history(
+    session_id: Optional[str] = Query(None, description="Filtrar por session_id"),
+    user_id: Optional[str] = Query(None, description="User ID para validar pertenencia"),
+    limit: int = Query(200, ge=1, le=1000),
+    before_id: Optional[int] = Query(None, description="Cursor: mensajes anteriores a este id"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Obtener historial de conversaciones desde SQLite (últimos mensajes, paginación por cursor)"""
     try:
         if not session_id:
             return {"conversations": []}
-        # Validar pertenencia si se proporciona user_id
-        if user_id and not memory_manager.conversation_belongs_to_user(session_id, user_id):
-            raise HTTPException(status_code=403, detail="Forbidden")
-        messages = memory_manager.get_conversation_history(session_id=session_id, limit=200)
-        return {"session_id": session_id, "messages": messages}
+        return await _history_response(session_id, user_id, if_none_match, limit, before_id=before_id)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error obteniendo historial: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/history/since")
+async def get_history_since(
+    session_id: str = Query(..., description="ID de la sesión"),
+    after_id: int = Query(0, ge=0, description="Último id de mensaje que ya tiene el cliente"),
+    user_id: Optional[str] = Query(None, description="User ID para validar pertenencia"),
+    limit: int = Query(200, ge=1, le=1000),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Delta del historial: solo los mensajes con id mayor que after_id"""
+    try:
+        return await _history_response(session_id, user_id, if_none_match, limit, after_id=after_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo delta de historial: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/api/metrics")
 async def get_metrics(
     session_id: Optional[str] = Query(None, description="Filtrar por session_id"),
@@ -1062,15 +1589,43 @@ async def get_metrics(
 ):
     """Obtener métricas desde SQLite (soporta filtros y paginación)"""
     try:
-        if session_id and user_id and not memory_manager.conversation_belongs_to_user(session_id, user_id):
+        if session_id and user_id and not await memory_manager.conversation_belongs_to_user_async(session_id, user_id):
             raise HTTPException(status_code=403, detail="Forbidden")
-        data = memory_manager.query_metrics(session_id=session_id, limit=limit, offset=offset)
+        data = await memory_manager.query_metrics_async(session_id=session_id, limit=limit, offset=offset)
         return {"metrics": data, "count": len(data)}
     except Exception as e:
         logger.error(f"❌ Error obteniendo métricas: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/metrics/summary")
+async def get_metrics_summary(
+    granularity: str = Query("hour", pattern="^(minute|hour)$"),
+    since: Optional[int] = Query(None, description="Inicio (epoch en segundos); por defecto últimas 24 h"),
+    until: Optional[int] = Query(None, description="Fin (epoch en segundos)"),
+    model: Optional[str] = None,
+    provider: Optional[str] = None,
+    stream: Optional[bool] = None,
+    is_image: Optional[bool] = None,
+    group_by: str = Query("model,provider", description="Dimensiones: model, provider, stream, is_image"),
+    per_bucket: bool = Query(False, description="Serie temporal por minuto/hora en lugar de totales"),
+):
+    """Métricas agregadas desde los rollups: conteos, tasa de error, tokens y p50/p95/p99 de duración"""
+    try:
+        data = await memory_manager.query_metrics_summary_async(
+            granularity=granularity,
+            since=since,
+            until=until,
+            filters={"model": model, "provider": provider, "stream": stream, "is_image": is_image},
+            group_by=tuple(d.strip() for d in group_by.split(",") if d.strip()),
+            per_bucket=per_bucket,
+        )
+        return {"granularity": granularity, "summary": data}
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo métricas agregadas: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 class ConversationCreateRequest(BaseModel):
     user_id: str
     title: Optional[str] = "Nueva conversación"
@@ -1079,7 +1634,7 @@ class ConversationCreateRequest(BaseModel):
 @app.post("/api/conversations")
 async def create_conversation(req: ConversationCreateRequest):
     try:
-        session_id = memory_manager.create_conversation(user_id=req.user_id, title=req.title or "Nueva conversación")
+        session_id = await memory_manager.create_conversation_async(user_id=req.user_id, title=req.title or "Nueva conversación")
         return {"session_id": session_id, "title": req.title or "Nueva conversación"}
     except Exception as e:
         logger.error(f"❌ Error creando conversación: {e}")
@@ -1087,19 +1642,53 @@ async def create_conversation(req: ConversationCreateRequest):
 
 
 @app.get("/api/conversations")
-async def list_conversations(user_id: str = Query(...), limit: int = 100, offset: int = 0):
+async def list_conversations(
+    user_id: str = Query(...),
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = 0,
+    cursor: Optional[str] = Query(None, description="Cursor 'updated_at:id' devuelto como next_cursor"),
+    updated_after: Optional[int] = Query(None, description="Solo conversaciones modificadas después de este timestamp"),
+):
     try:
-        items = memory_manager.list_conversations(user_id=user_id, limit=limit, offset=offset)
-        return {"conversations": items}
+        keyset = None
+        if cursor:
+            try:
+                updated_at, last_id = cursor.split(":", 1)
+                keyset = (int(updated_at), last_id)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Cursor inválido")
+        items = await memory_manager.list_conversations_async(
+            user_id=user_id, limit=limit, offset=offset, cursor=keyset, updated_after=updated_after
+        )
+        next_cursor = f"{items[-1]['updated_at']}:{items[-1]['id']}" if len(items) == limit else None
+        return {"conversations": items, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error listando conversaciones: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/conversations/search")
+async def search_conversations(
+    q: str = Query(..., min_length=1, max_length=200, description="Texto a buscar"),
+    limit: int = Query(20, ge=1, le=100),
+    session_id: Optional[str] = Query(None, description="Restringir a una conversación"),
+    user: Dict[str, Any] = Depends(require_auth),
+):
+    """Buscar consultas anteriores del usuario autenticado por contenido (FTS5, ordenado por bm25)"""
+    try:
+        results = await memory_manager.search_conversations_async(user_id=user["user_id"], query=q, limit=limit, session_id=session_id)
+        return {"query": q, "results": results}
+    except Exception as e:
+        logger.error(f"❌ Error buscando conversaciones: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.delete("/api/conversations")
 async def delete_conversations(user_id: str = Query(...)):
     try:
-        deleted = memory_manager.delete_all_conversations(user_id=user_id)
+        deleted = await memory_manager.delete_all_conversations_async(user_id=user_id)
         return {"deleted": deleted}
     except Exception as e:
         logger.error(f"❌ Error eliminando conversaciones: {e}")
@@ -1114,7 +1703,7 @@ class ConversationRenameRequest(BaseModel):
 @app.patch("/api/conversations/{session_id}")
 async def rename_conversation(session_id: str, req: ConversationRenameRequest):
     try:
-        ok = memory_manager.rename_conversation(session_id=session_id, user_id=req.user_id, new_title=req.title)
+        ok = await memory_manager.rename_conversation_async(session_id=session_id, user_id=req.user_id, new_title=req.title)
         if not ok:
             raise HTTPException(status_code=403, detail="Forbidden or not found")
         return {"session_id": session_id, "title": req.title}
@@ -1133,7 +1722,7 @@ class ConversationDeleteRequest(BaseModel):
 async def delete_conversation(session_id: str, req: ConversationDeleteRequest):
     """Eliminar una conversación individual"""
     try:
-        ok = memory_manager.delete_conversation(session_id=session_id, user_id=req.user_id)
+        ok = await memory_manager.delete_conversation_async(session_id=session_id, user_id=req.user_id)
         if not ok:
             raise HTTPException(status_code=403, detail="Forbidden or not found")
         return {"session_id": session_id, "deleted": True}
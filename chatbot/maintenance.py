@@ -0,0 +1,365 @@
+"""
+Mantenimiento de chatbot.db: retención, archivado y compactación
+- Borrado por conjuntos de sesiones temporales y abandonadas (TTL)
+- Archivado comprimido del historial frío en message_archive
+- Purga de user_sessions expiradas
+- VACUUM incremental y ANALYZE (PRAGMA optimize) programados
+
+Uso:
+    python maintenance.py                              # una pasada sobre chatbot.db
+    python maintenance.py --db otra.db
+    python maintenance.py --enable-incremental-vacuum  # convierte la BD a auto_vacuum=INCREMENTAL (VACUUM completo)
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin lock entre procesos
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Políticas de retención (0 desactiva la tarea)
+TEMP_SESSION_TTL_HOURS = int(os.getenv("CHATBOT_TEMP_SESSION_TTL_HOURS", "24"))
+ABANDONED_SESSION_DAYS = int(os.getenv("CHATBOT_ABANDONED_SESSION_DAYS", "0"))
+# Archivado desactivado por defecto: los mensajes archivados salen de la búsqueda FTS
+ARCHIVE_AFTER_DAYS = int(os.getenv("CHATBOT_ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_KEEP_RECENT = int(os.getenv("CHATBOT_ARCHIVE_KEEP_RECENT", "50"))  # mensajes que siempre quedan en caliente
+MAINTENANCE_INTERVAL_MIN = int(os.getenv("CHATBOT_MAINTENANCE_INTERVAL_MIN", "60"))
+MAINTENANCE_BATCH = int(os.getenv("CHATBOT_MAINTENANCE_BATCH", "500"))
+INCREMENTAL_VACUUM_PAGES = int(os.getenv("CHATBOT_INCREMENTAL_VACUUM_PAGES", "2000"))
+ROLLUP_MINUTE_RETENTION_DAYS = int(os.getenv("CHATBOT_ROLLUP_MINUTE_RETENTION_DAYS", "7"))
+
+# Tablas con filas por sesión que se borran junto con la conversación
+SESSION_TABLES = ("messages", "conversation_memory", "metrics", "message_archive")
+
+
+def delete_sessions(conn: sqlite3.Connection, select_sql: str, params: tuple = ()) -> List[str]:
+    """Borrar por conjuntos todas las filas de las sesiones seleccionadas por `select_sql`
+
+    Las ids se materializan en una tabla temporal y cada tabla se borra con un único
+    DELETE ... WHERE session_id IN (SELECT ...), sin límite de variables ni bucles por sesión.
+    Debe ejecutarse dentro de una transacción; devuelve las sesiones eliminadas.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _sessions_to_delete (id TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM _sessions_to_delete")
+    conn.execute(f"INSERT OR IGNORE INTO _sessions_to_delete (id) {select_sql}", params)
+    session_ids = [r[0] for r in conn.execute("SELECT id FROM _sessions_to_delete")]
+    if session_ids:
+        for table in SESSION_TABLES:
+            conn.execute(f"DELETE FROM {table} WHERE session_id IN (SELECT id FROM _sessions_to_delete)")
+        conn.execute("DELETE FROM conversations WHERE id IN (SELECT id FROM _sessions_to_delete)")
+    conn.execute("DELETE FROM _sessions_to_delete")
+    return session_ids
+
+
+def _batched(conn: sqlite3.Connection, fn, *args) -> List[str]:
+    """Repetir una tarea de borrado en transacciones cortas hasta que no quede nada"""
+    removed: List[str] = []
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            batch = fn(conn, *args)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        removed.extend(batch)
+        if len(batch) < MAINTENANCE_BATCH:
+            return removed
+
+
+def expire_temporary_sessions(conn: sqlite3.Connection, now: int) -> List[str]:
+    """Sesiones temporales sin actividad durante TEMP_SESSION_TTL_HOURS"""
+    cutoff = now - TEMP_SESSION_TTL_HOURS * 3600
+    return _batched(conn, lambda c: delete_sessions(
+        c,
+        "SELECT id FROM conversations WHERE is_temporary = 1 AND updated_at < ? LIMIT ?",
+        (cutoff, MAINTENANCE_BATCH),
+    ))
+
+
+def expire_abandoned_sessions(conn: sqlite3.Connection, now: int) -> List[str]:
+    """Conversaciones sin actividad durante ABANDONED_SESSION_DAYS y sesiones huérfanas temp_*"""
+    cutoff = now - ABANDONED_SESSION_DAYS * 86400
+    removed = _batched(conn, lambda c: delete_sessions(
+        c,
+        "SELECT id FROM conversations WHERE updated_at < ? LIMIT ?",
+        (cutoff, MAINTENANCE_BATCH),
+    ))
+    # Historiales creados sin conversación (session_id temporal "temp_<ts>" de MedicalChain);
+    # el rango ['temp_', 'temp`') equivale al prefijo y usa el índice (session_id, timestamp)
+    removed += _batched(conn, lambda c: delete_sessions(
+        c,
+        """
+        SELECT DISTINCT session_id FROM messages
+        WHERE session_id >= 'temp_' AND session_id < 'temp`' AND timestamp < ?
+        LIMIT ?
+        """,
+        (cutoff, MAINTENANCE_BATCH),
+    ))
+    return removed
+
+
+def purge_expired_user_sessions(conn: sqlite3.Connection, now: int) -> int:
+    """Tokens de login expirados (usa idx_user_sessions_expires)"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        deleted = conn.execute("DELETE FROM user_sessions WHERE expires_at < ?", (now,)).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return deleted
+
+
+def prune_minute_rollups(conn: sqlite3.Connection, now: int) -> int:
+    """Los rollups por minuto solo se conservan ROLLUP_MINUTE_RETENTION_DAYS (los horarios se mantienen)"""
+    cutoff = now - ROLLUP_MINUTE_RETENTION_DAYS * 86400
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        deleted = conn.execute(
+            "DELETE FROM metrics_rollup WHERE granularity = 'minute' AND bucket_start < ?", (cutoff,)
+        ).rowcount
+        conn.execute("DELETE FROM metrics_rollup_hist WHERE granularity = 'minute' AND bucket_start < ?", (cutoff,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return deleted
+
+
+def archive_cold_messages(conn: sqlite3.Connection, now: int) -> Dict[str, int]:
+    """Mover a message_archive (JSON comprimido con zlib) los mensajes antiguos de cada sesión
+
+    Se conservan en caliente los últimos ARCHIVE_KEEP_RECENT mensajes de cada sesión,
+    que son los que usan el historial y la paginación habitual; las páginas anteriores se leen
+    del archivo (MemoryManager.get_conversation_history). Cada sesión archivada incrementa su
+    version (cambia el ETag del historial) sin tocar updated_at.
+    """
+    cutoff = now - ARCHIVE_AFTER_DAYS * 86400
+    stats = {"sessions": 0, "messages": 0, "raw_bytes": 0, "compressed_bytes": 0}
+    # Candidatas: conversaciones sin actividad reciente (recorrido por cursor sobre la PK)
+    last_id = ""
+    while True:
+        session_ids = [r[0] for r in conn.execute(
+            "SELECT id FROM conversations WHERE id > ? AND updated_at < ? ORDER BY id LIMIT ?",
+            (last_id, cutoff, MAINTENANCE_BATCH),
+        )]
+        if not session_ids:
+            return stats
+        last_id = session_ids[-1]
+        for session_id in session_ids:
+            # Límite: id del mensaje más antiguo que debe quedarse en caliente
+            boundary = conn.execute(
+                "SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (session_id, max(0, ARCHIVE_KEEP_RECENT - 1)),
+            ).fetchone()
+            if not boundary:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    """
+                    SELECT id, role, content, timestamp, metadata, message_uid
+                    FROM messages
+                    WHERE session_id = ? AND id < ? AND timestamp < ?
+                    ORDER BY id
+                    """,
+                    (session_id, boundary[0], cutoff),
+                ).fetchall()
+                if not rows:
+                    conn.rollback()
+                    continue
+                raw = json.dumps(
+                    [dict(zip(("id", "role", "content", "timestamp", "metadata", "message_uid"), r)) for r in rows],
+                    ensure_ascii=False,
+                ).encode("utf-8")
+                payload = zlib.compress(raw, 6)
+                conn.execute(
+                    """
+                    INSERT INTO message_archive (session_id, first_id, last_id, message_count, archived_at, payload)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (session_id, rows[0][0], rows[-1][0], len(rows), now, payload),
+                )
+                conn.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND id BETWEEN ? AND ? AND timestamp < ?",
+                    (session_id, rows[0][0], rows[-1][0], cutoff),
+                )
+                conn.execute("UPDATE conversations SET version = version + 1 WHERE id = ?", (session_id,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            stats["sessions"] += 1
+            stats["messages"] += len(rows)
+            stats["raw_bytes"] += len(raw)
+            stats["compressed_bytes"] += len(payload)
+
+
+def decode_archive(payload: bytes) -> List[Dict[str, Any]]:
+    """Mensajes de un bloque de message_archive (orden cronológico)"""
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def read_archived_messages(conn: sqlite3.Connection, session_id: str) -> List[Dict[str, Any]]:
+    """Recuperar los mensajes archivados de una sesión en orden cronológico"""
+    messages: List[Dict[str, Any]] = []
+    for (payload,) in conn.execute(
+        "SELECT payload FROM message_archive WHERE session_id = ? ORDER BY first_id", (session_id,)
+    ):
+        messages.extend(decode_archive(payload))
+    return messages
+
+
+def compact_storage(conn: sqlite3.Connection) -> Dict[str, int]:
+    """VACUUM incremental (si la BD usa auto_vacuum=INCREMENTAL), estadísticas y checkpoint del WAL"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if auto_vacuum == 2 and free_before:
+        conn.execute(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})").fetchall()
+    free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # ANALYZE solo de las tablas que lo necesitan
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("PRAGMA optimize")
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    return {
+        "auto_vacuum": auto_vacuum,
+        "freelist_pages": free_after,
+        "reclaimed_bytes": (free_before - free_after) * page_size,
+        "reclaimable_bytes": free_after * page_size,
+    }
+
+
+def run_maintenance(conn: sqlite3.Connection, now: Optional[int] = None) -> Dict[str, Any]:
+    """Ejecutar una pasada completa de mantenimiento y devolver el reporte"""
+    now = now or int(time.time())
+    start = time.time()
+    report: Dict[str, Any] = {"started_at": now}
+    removed: List[str] = []
+
+    if TEMP_SESSION_TTL_HOURS > 0:
+        temp = expire_temporary_sessions(conn, now)
+        report["temporary_sessions_deleted"] = len(temp)
+        removed += temp
+    if ABANDONED_SESSION_DAYS > 0:
+        abandoned = expire_abandoned_sessions(conn, now)
+        report["abandoned_sessions_deleted"] = len(abandoned)
+        removed += abandoned
+    report["user_sessions_purged"] = purge_expired_user_sessions(conn, now)
+    if ROLLUP_MINUTE_RETENTION_DAYS > 0:
+        report["minute_rollups_pruned"] = prune_minute_rollups(conn, now)
+    if ARCHIVE_AFTER_DAYS > 0:
+        report["archive"] = archive_cold_messages(conn, now)
+    report["storage"] = compact_storage(conn)
+    report["duration_ms"] = int((time.time() - start) * 1000)
+    report["deleted_session_ids"] = removed
+    return report
+
+
+class MaintenanceScheduler:
+    """Ejecuta run_maintenance periódicamente en el executor del pool
+
+    Con varios workers de uvicorn solo uno ejecuta cada pasada (flock sobre <db>.maintenance.lock).
+    Con la base particionada (db_router) la pasada recorre cada archivo.
+    """
+
+    def __init__(self, memory_manager, interval_minutes: int = MAINTENANCE_INTERVAL_MIN):
+        self.memory_manager = memory_manager
+        self.pool = memory_manager.pool
+        self.router = memory_manager.router
+        self.interval = max(1, interval_minutes) * 60
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None and MAINTENANCE_INTERVAL_MIN > 0:
+            self._task = asyncio.create_task(self._loop())
+            logger.info(f"✅ Mantenimiento programado cada {self.interval // 60} min")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                report = await self.pool.run(self.run_once)
+                if report is not None:
+                    self.last_report = report
+            except Exception as e:
+                logger.error(f"❌ Error en mantenimiento de base de datos: {e}")
+
+    def run_once(self) -> Optional[Dict[str, Any]]:
+        """Una pasada si se obtiene el lock entre procesos (None si otro worker la está ejecutando)"""
+        lock_file = open(f"{self.router.db_path}.maintenance.lock", "a")
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+            # Escrituras pendientes primero: no recrear filas de sesiones que se van a borrar
+            self.memory_manager.flush_writes()
+            reports: Dict[str, Dict[str, Any]] = {}
+            removed: List[str] = []
+            for pool in self.router.all_pools():
+                with pool.connection() as conn:
+                    file_report = run_maintenance(conn)
+                removed += file_report.pop("deleted_session_ids")
+                reports[pool.db_path] = file_report
+            self.memory_manager._forget_sessions(removed)
+            report = reports.popitem()[1] if len(reports) == 1 else {"files": reports}
+            logger.info(f"🧹 Mantenimiento completado: {json.dumps(report)}")
+            return report
+        finally:
+            lock_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retención, archivado y compactación de chatbot.db")
+    parser.add_argument("--db", default="chatbot.db", help="Ruta de la base de datos SQLite")
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="Activar auto_vacuum=INCREMENTAL (ejecuta un VACUUM completo, bloquea la BD)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from migrations import apply_migrations_conn
+
+    conn = sqlite3.connect(args.db, timeout=30.0, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        apply_migrations_conn(conn)
+        if args.enable_incremental_vacuum:
+            print("🗜️ Activando auto_vacuum=INCREMENTAL (VACUUM completo)...")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        report = run_maintenance(conn)
+        report.pop("deleted_session_ids")
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
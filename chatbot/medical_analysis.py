@@ -13,6 +13,8 @@ import json
 from PIL import Image
 import io
 
+from token_counter import get_token_counter
+
 logger = logging.getLogger(__name__)
 
 # Configuración para Ollama (imágenes)
@@ -99,9 +101,8 @@ def validate_image_size(image_data: str) -> tuple[bool, Optional[str]]:
         if size_mb > MAX_IMAGE_SIZE_MB:
             return False, f"Imagen muy grande ({size_mb:.2f}MB). Máximo permitido: {MAX_IMAGE_SIZE_MB}MB"
         
-        # Estimar tokens (base64 es ~33% más grande que bytes originales)
-        # Aproximación: 4 caracteres base64 = 1 token
-        estimated_tokens = len(image_data) // 4
+        # Tokens de la imagen: fijos por imagen con el tokenizer local; sin él, 4 caracteres base64 = 1 token
+        estimated_tokens = get_token_counter().count_image(image_data)
         
         if estimated_tokens > MAX_IMAGE_TOKENS:
             return False, f"Imagen excede límite de tokens estimados ({estimated_tokens}). Máximo: {MAX_IMAGE_TOKENS} tokens"
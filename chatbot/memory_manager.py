@@ -3,15 +3,33 @@ Sistema de Memoria Conversacional para Chatbot IMSS
 Basado en el sistema de AImas con adaptaciones para IMSS
 """
 
+import html
 import json
+import re
 import sqlite3
+import threading
 import time
 import logging
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime
 
+from db_router import get_router
+from maintenance import decode_archive, delete_sessions
+from metrics_rollup import query_rollups, update_rollups
+from write_queue import get_write_queue
+from session_cache import (
+    append_history_entry,
+    get_session_cache,
+    history_cache_key,
+    memory_cache_key,
+)
+from token_counter import get_token_counter
+
 logger = logging.getLogger(__name__)
 
+# Tokens por mensaje en el resumen de contexto de get_conversation_context
+CONTEXT_SNIPPET_TOKENS = 50
+
 
 class ConversationMemory:
     """Clase base para memoria conversacional"""
@@ -57,234 +75,287 @@ class BufferWindowMemory(ConversationMemory):
             self.messages = self.messages[-self.window_size:]
 
 
+def message_uid(request_id: Optional[str], role: str) -> Optional[str]:
+    """Id estable de un mensaje derivado del request_id (None si no hay request_id)"""
+    return f"{request_id}:{role}" if request_id else None
+
+
 class MemoryManager:
     """Gestor de memoria conversacional con persistencia en SQLite"""
     
     def __init__(self, db_path: str = "chatbot.db"):
         self.db_path = db_path
-        self.memories = {}  # {session_id: ConversationMemory}
+        # Enrutador de archivos SQLite (dominios y shards de chat; un solo archivo por defecto)
+        self.router = get_router(db_path)
+        # Pool compartido (WAL + sentencias preparadas) en lugar de una conexión por llamada;
+        # los métodos *_async usan el executor del shard de cada operación (este, el del primer shard,
+        # queda para el mantenimiento)
+        self.pool = self.router.chat_pools[0]
+        # Memorias activas en el cache acotado (LRU + TTL) compartido con el historial de MedicalChain
+        self.cache = get_session_cache()
+        # Los métodos *_async se ejecutan en hilos del pool: proteger la mutación de memorias
+        self._memories_lock = threading.RLock()
+        # Escrituras de mensajes/memorias/métricas agrupadas en lotes (write-behind), una cola por archivo
+        self.write_queue = get_write_queue(self.pool)
+        self.metrics_queue = get_write_queue(self.router.metrics_pool)
         self._init_database()
     
     def _init_database(self):
-        """Inicializar base de datos SQLite"""
+        """Inicializar base de datos SQLite (aplica migraciones pendientes en todos los archivos)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Tabla para memorias de conversación
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS conversation_memory (
-                    session_id TEXT PRIMARY KEY,
-                    agent_id TEXT NOT NULL,
-                    memory_type TEXT NOT NULL,
-                    memory_data TEXT NOT NULL,
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL
-                )
-            """)
-            
-            # Tabla para mensajes
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp INTEGER NOT NULL,
-                    metadata TEXT
-                )
-            """)
-            
-            # Tabla para conversaciones
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id TEXT PRIMARY KEY,
-                    user_id TEXT,
-                    title TEXT,
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL,
-                    is_temporary INTEGER DEFAULT 0
-                )
-            """)
-            
-            conn.commit()
-            
-            # Tabla de métricas de ejecución
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS metrics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    input_chars INTEGER,
-                    output_chars INTEGER,
-                    input_tokens INTEGER,
-                    output_tokens INTEGER,
-                    total_tokens INTEGER,
-                    started_at INTEGER,
-                    ended_at INTEGER,
-                    duration_ms INTEGER,
-                    model TEXT,
-                    provider TEXT,
-                    stream INTEGER,
-                    is_image INTEGER,
-                    success INTEGER,
-                    error_message TEXT
-                )
-            """)
-            conn.commit()
-            conn.close()
-            logger.info("✅ Base de datos inicializada correctamente")
+            applied = self.router.apply_migrations()
+            logger.info(f"✅ Base de datos inicializada correctamente ({len(applied)} migraciones aplicadas)")
         except Exception as e:
             logger.error(f"❌ Error inicializando base de datos: {e}")
     
+    def _pool(self, session_id: str):
+        """Pool del shard de chat donde vive la sesión"""
+        return self.router.pool_for_session(session_id)
+    
+    def _queue(self, session_id: str):
+        """Cola de escritura del shard de chat de la sesión"""
+        return get_write_queue(self._pool(session_id))
+    
+    def _write_queues(self):
+        """Colas de escritura de todos los archivos (sin repetir)"""
+        return [get_write_queue(pool) for pool in self.router.all_pools()]
+    
+    def flush_writes(self):
+        """Esperar a que todas las escrituras encoladas estén en disco"""
+        for wq in self._write_queues():
+            wq.flush()
+    
+    def write_queue_stats(self) -> Dict[str, int]:
+        """Contadores agregados de las colas de escritura"""
+        totals: Dict[str, int] = {}
+        for wq in self._write_queues():
+            for name, value in wq.stats.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+    
     def get_memory(self, session_id: str, agent_id: str = "medico", memory_type: str = "buffer") -> ConversationMemory:
-        """Obtener memoria para una sesión"""
-        memory_key = f"{session_id}_{agent_id}"
-        
-        if memory_key not in self.memories:
-            # Crear nueva memoria
-            if memory_type == "buffer":
-                self.memories[memory_key] = BufferWindowMemory(window_size=10)
-            else:
-                self.memories[memory_key] = ConversationMemory()
-            
-            # Cargar memoria persistida si existe
-            self._load_persisted_memory(session_id, agent_id, memory_type)
-        
-        return self.memories[memory_key]
+        """Obtener memoria para una sesión (cache acotado; se carga de SQLite en un miss)"""
+        return self.cache.get_or_load(
+            memory_cache_key(session_id, agent_id),
+            lambda: self._load_persisted_memory(session_id, agent_id, memory_type),
+        )
     
-    def _load_persisted_memory(self, session_id: str, agent_id: str, memory_type: str):
-        """Cargar memoria persistida desde la base de datos"""
+    def _load_persisted_memory(self, session_id: str, agent_id: str, memory_type: str) -> ConversationMemory:
+        """Crear la memoria y cargar su contenido persistido en la base de datos"""
+        if memory_type == "buffer":
+            memory = BufferWindowMemory(window_size=10)
+        else:
+            memory = ConversationMemory()
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
+            result = self._pool(session_id).fetchone("""
                 SELECT memory_data FROM conversation_memory 
                 WHERE session_id = ? AND agent_id = ? AND memory_type = ?
             """, (session_id, agent_id, memory_type))
             
-            result = cursor.fetchone()
-            
             if result:
                 memory_data = json.loads(result[0])
-                memory_key = f"{session_id}_{agent_id}"
-                
-                if memory_key in self.memories:
-                    memory = self.memories[memory_key]
-                    memory.messages = memory_data.get("messages", [])
-                    logger.info(f"✅ Memoria cargada para sesión: {session_id}")
-            
-            conn.close()
+                memory.messages = memory_data.get("messages", [])
+                logger.info(f"✅ Memoria cargada para sesión: {session_id}")
         except Exception as e:
             logger.error(f"❌ Error cargando memoria persistida: {e}")
+        return memory
     
-    def save_memory(self, session_id: str, agent_id: str, memory_type: str = "buffer"):
-        """Guardar memoria en la base de datos"""
-        try:
-            memory_key = f"{session_id}_{agent_id}"
-            if memory_key not in self.memories:
+    def _save_memory_op(self, session_id: str, agent_id: str, memory_type: str = "buffer", memory: Optional[ConversationMemory] = None):
+        """Operación de escritura que serializa la memoria en el momento del flush
+        
+        La operación conserva la referencia a la memoria: aunque el cache la desaloje
+        antes del flush, su contenido se persiste igualmente.
+        """
+        if memory is None:
+            memory = self.cache.get(memory_cache_key(session_id, agent_id))
+        
+        def op(conn):
+            if memory is None:
                 return
-            
-            memory = self.memories[memory_key]
-            
-            memory_data = {
-                "messages": memory.messages
-            }
-            
+            with self._memories_lock:
+                memory_data = {
+                    "messages": list(memory.messages)
+                }
             now = int(time.time())
-            
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
+            conn.execute("""
                 INSERT OR REPLACE INTO conversation_memory 
                 (session_id, agent_id, memory_type, memory_data, created_at, updated_at)
                 VALUES (?, ?, ?, ?, ?, ?)
             """, (session_id, agent_id, memory_type, json.dumps(memory_data), now, now))
-            
-            conn.commit()
-            conn.close()
+        
+        return op
+    
+    def save_memory(self, session_id: str, agent_id: str, memory_type: str = "buffer"):
+        """Guardar memoria en la base de datos"""
+        try:
+            with self._pool(session_id).transaction() as conn:
+                self._save_memory_op(session_id, agent_id, memory_type)(conn)
             
             logger.info(f"✅ Memoria guardada para sesión: {session_id}")
         except Exception as e:
             logger.error(f"❌ Error guardando memoria: {e}")
     
-    def add_message_to_conversation(self, session_id: str, role: str, content: str, metadata: Dict[str, Any] = None):
-        """Agregar mensaje a la conversación y persistir"""
+    @staticmethod
+    def _insert_message_op(session_id: str, role: str, content: str, metadata: Dict[str, Any] = None, message_id: Optional[str] = None):
+        """Operación de escritura: mensaje + updated_at de la conversación (idempotente si hay message_id)"""
+        now = int(time.time())
+        metadata_json = json.dumps(metadata or {})
+        
+        def op(conn):
+            inserted = conn.execute("""
+                INSERT OR IGNORE INTO messages (session_id, role, content, timestamp, metadata, message_uid)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (session_id, role, content, now, metadata_json, message_id)).rowcount
+            if not inserted:
+                return
+            
+            # Actualizar updated_at y versión (ETag) de la conversación si existe
+            conn.execute(
+                "UPDATE conversations SET updated_at = ?, version = version + 1 WHERE id = ?",
+                (now, session_id),
+            )
+        
+        return op
+    
+    def add_message_to_conversation(self, session_id: str, role: str, content: str, metadata: Dict[str, Any] = None, message_id: Optional[str] = None):
+        """Agregar mensaje a la conversación y persistir
+        
+        Si se indica message_id, la escritura es idempotente: un mensaje con el mismo id
+        ya persistido (p. ej. por SQLiteChatMessageHistory) no se duplica.
+        """
         try:
             # Guardar en memoria activa
             memory = self.get_memory(session_id)
-            memory.add_message(role, content, metadata)
-            
-            # Guardar en base de datos
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO messages (session_id, role, content, timestamp, metadata)
-                VALUES (?, ?, ?, ?, ?)
-            """, (session_id, role, content, int(time.time()), json.dumps(metadata or {})))
-            
-            conn.commit()
-            
-            # Actualizar updated_at de la conversación si existe
-            try:
-                cursor.execute(
-                    "UPDATE conversations SET updated_at = ? WHERE id = ?",
-                    (int(time.time()), session_id),
-                )
-                conn.commit()
-            except Exception as _e:
-                logger.warning(f"⚠️ No se pudo actualizar updated_at: {_e}")
-            finally:
-                conn.close()
+            with self._memories_lock:
+                # Vía update() para que el cache recalcule el tamaño de la entrada
+                if not self.cache.update(memory_cache_key(session_id, "medico"), lambda m: m.add_message(role, content, metadata)):
+                    memory.add_message(role, content, metadata)
+            
+            # Write-through a la cola del historial cacheada por MedicalChain (si está en cache); la versión
+            # no cambia hasta que la cola escribe la fila, y entonces la siguiente carga relee SQLite
+            self.cache.update(
+                history_cache_key(session_id),
+                lambda history: append_history_entry(history.messages, (message_id, role, content)),
+            )
             
-            # Guardar memoria actualizada
-            self.save_memory(session_id, "medico")
+            # Encolar mensaje y memoria; la reescritura de la memoria se colapsa por sesión dentro del lote
+            write_queue = self._queue(session_id)
+            write_queue.submit(self._insert_message_op(session_id, role, content, metadata, message_id))
+            write_queue.submit(self._save_memory_op(session_id, "medico", memory=memory), key=f"memory:{session_id}_medico")
         except Exception as e:
             logger.error(f"❌ Error agregando mensaje: {e}")
     
-    def get_conversation_history(self, session_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-        """Obtener historial de conversación desde la base de datos"""
+    def get_conversation_history(
+        self,
+        session_id: str,
+        limit: int = 50,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Obtener historial de conversación desde la base de datos (paginación por cursor de id)
+        
+        - Sin cursores: los últimos `limit` mensajes
+        - before_id: página anterior (mensajes con id < before_id)
+        - after_id: delta, mensajes nuevos con id > after_id
+        Siempre en orden cronológico; usa idx_messages_session_msgid sin OFFSET.
+        Los mensajes movidos a message_archive (más antiguos que cualquiera en caliente)
+        completan la página cuando el cursor llega a ellos.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT role, content, timestamp, metadata
-                FROM messages
-                WHERE session_id = ?
-                ORDER BY timestamp ASC
-                LIMIT ?
-            """, (session_id, limit))
+            # Leer también los mensajes que aún estén en la cola de escritura
+            pool = self._pool(session_id)
+            get_write_queue(pool).flush()
+            if after_id is not None:
+                rows = pool.fetchall("""
+                    SELECT id, role, content, timestamp, metadata
+                    FROM messages
+                    WHERE session_id = ? AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                """, (session_id, after_id, limit))
+                if rows:
+                    # Archivados entre el cursor y el primer mensaje en caliente
+                    archived = self._archived_messages(pool, session_id, after_id=after_id, before_id=rows[0][0])
+                    rows = (archived + rows)[:limit]
+            else:
+                rows = pool.fetchall("""
+                    SELECT id, role, content, timestamp, metadata
+                    FROM messages
+                    WHERE session_id = ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """, (session_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+                rows.reverse()
+                if len(rows) < limit and (rows or before_id is not None):
+                    # La página llega al principio de lo que hay en caliente: seguir por el archivo
+                    archived = self._archived_messages(
+                        pool, session_id, before_id=rows[0][0] if rows else before_id
+                    )
+                    rows = archived[max(0, len(archived) - (limit - len(rows))):] + rows
             
             messages = []
-            for row in cursor.fetchall():
+            for row in rows:
                 messages.append({
-                    "role": row[0],
-                    "content": row[1],
-                    "timestamp": row[2],
-                    "metadata": json.loads(row[3]) if row[3] else {}
+                    "id": row[0],
+                    "role": row[1],
+                    "content": row[2],
+                    "timestamp": row[3],
+                    "metadata": json.loads(row[4]) if row[4] else {}
                 })
             
-            conn.close()
             return messages
         except Exception as e:
             logger.error(f"❌ Error obteniendo historial: {e}")
             return []
 
+    def _archived_messages(
+        self,
+        pool,
+        session_id: str,
+        before_id: int,
+        after_id: Optional[int] = None,
+    ) -> List[tuple]:
+        """Filas archivadas de la sesión con after_id < id < before_id, en orden cronológico"""
+        params: List[Any] = [session_id, before_id]
+        where = "session_id = ? AND first_id < ?"
+        if after_id is not None:
+            where += " AND last_id > ?"
+            params.append(after_id)
+        rows: List[tuple] = []
+        for (payload,) in pool.fetchall(
+            f"SELECT payload FROM message_archive WHERE {where} ORDER BY first_id", tuple(params)
+        ):
+            for m in decode_archive(payload):
+                if m["id"] < before_id and (after_id is None or m["id"] > after_id):
+                    rows.append((m["id"], m["role"], m["content"], m["timestamp"], m["metadata"]))
+        return rows
+
+    def get_session_version(self, session_id: str) -> Optional[int]:
+        """Versión de la sesión (se incrementa con cada mensaje o cambio); base del ETag
+        
+        None si la sesión no tiene fila en conversations (no hay contador que consultar).
+        """
+        try:
+            pool = self._pool(session_id)
+            get_write_queue(pool).flush()
+            row = pool.fetchone("SELECT version FROM conversations WHERE id = ?", (session_id,))
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"❌ Error obteniendo versión de sesión: {e}")
+            return None
+
     def query_metrics(self, session_id: Optional[str] = None, limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
         """Consultar métricas registradas en SQLite"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
             params: List[Any] = []
             where = ""
             if session_id:
                 where = "WHERE session_id = ?"
                 params.append(session_id)
             params.extend([limit, offset])
-            cursor.execute(f"""
+            # Con metrics en su propio archivo ninguna otra lectura vacía su cola
+            self.metrics_queue.flush()
+            return self.router.metrics_pool.fetchall_dict(f"""
                 SELECT id, session_id, input_chars, output_chars, input_tokens, output_tokens, total_tokens,
                        started_at, ended_at, duration_ms, model, provider, stream, is_image, success, error_message
                 FROM metrics
@@ -292,14 +363,17 @@ class MemoryManager:
                 ORDER BY id DESC
                 LIMIT ? OFFSET ?
             """, params)
-            rows = cursor.fetchall()
-            cols = [c[0] for c in cursor.description]
-            conn.close()
-            return [dict(zip(cols, r)) for r in rows]
         except Exception as e:
             logger.error(f"❌ Error consultando métricas: {e}")
             return []
     
+    def query_metrics_summary(self, **kwargs) -> List[Dict[str, Any]]:
+        """Métricas agregadas desde los rollups (conteos, tasa de error, tokens, p50/p95/p99)"""
+        # Incluir las métricas que aún estén en la cola de escritura
+        self.metrics_queue.flush()
+        with self.router.metrics_pool.connection() as conn:
+            return query_rollups(conn, **kwargs)
+    
     def create_conversation(self, user_id: str, title: str = "Nueva conversación") -> str:
         """Crear nueva conversación"""
         try:
@@ -307,40 +381,57 @@ class MemoryManager:
             session_id = str(uuid.uuid4())
             now = int(time.time())
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute("""
+            self.router.assign_session(session_id, user_id).execute("""
                 INSERT INTO conversations (id, user_id, title, created_at, updated_at)
                 VALUES (?, ?, ?, ?, ?)
             """, (session_id, user_id, title, now, now))
             
-            conn.commit()
-            conn.close()
-            
             logger.info(f"✅ Conversación creada: {session_id}")
             return session_id
         except Exception as e:
             logger.error(f"❌ Error creando conversación: {e}")
             return ""
 
-    def list_conversations(self, user_id: str, limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
-        """Listar conversaciones de un usuario"""
+    def list_conversations(
+        self,
+        user_id: str,
+        limit: int = 100,
+        offset: int = 0,
+        cursor: Optional[Tuple[int, str]] = None,
+        updated_after: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Listar conversaciones de un usuario (más recientes primero)
+        
+        - cursor=(updated_at, id) del último elemento recibido: página siguiente sin OFFSET
+        - updated_after: solo conversaciones modificadas después de ese timestamp (refresco incremental)
+        Con varios shards se consulta cada uno (una conversación antigua puede seguir en el shard
+        de un reparto anterior) y se mezclan los resultados con el mismo orden.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, user_id, title, created_at, updated_at, is_temporary
+            where = "WHERE user_id = ?"
+            params: List[Any] = [user_id]
+            if cursor is not None:
+                where += " AND (updated_at, id) < (?, ?)"
+                params.extend(cursor)
+                offset = 0
+            if updated_after is not None:
+                where += " AND updated_at > ?"
+                params.append(updated_after)
+            sql = f"""
+                SELECT id, user_id, title, created_at, updated_at, is_temporary, version
                 FROM conversations
-                WHERE user_id = ?
-                ORDER BY updated_at DESC
+                {where}
+                ORDER BY updated_at DESC, id DESC
                 LIMIT ? OFFSET ?
-                """,
-                (user_id, limit, offset),
-            )
-            rows = cursor.fetchall()
-            conn.close()
+                """
+            pools = self.router.chat_pools
+            if len(pools) == 1:
+                rows = pools[0].fetchall(sql, params + [limit, offset])
+            else:
+                # Cada shard aporta sus primeras offset + limit filas; el OFFSET se aplica tras mezclar
+                rows = [r for pool in pools for r in pool.fetchall(sql, params + [limit + offset, 0])]
+                rows.sort(key=lambda r: (r[4], r[0]), reverse=True)
+                rows = rows[offset:offset + limit]
             return [
                 {
                     "id": r[0],
@@ -349,6 +440,7 @@ class MemoryManager:
                     "created_at": r[3],
                     "updated_at": r[4],
                     "is_temporary": r[5],
+                    "version": r[6],
                 }
                 for r in rows
             ]
@@ -359,22 +451,22 @@ class MemoryManager:
     def get_last_conversation(self, user_id: str) -> Optional[str]:
         """Obtener el session_id de la última conversación de un usuario"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id
-                FROM conversations
-                WHERE user_id = ?
-                ORDER BY updated_at DESC
-                LIMIT 1
-                """,
-                (user_id,),
-            )
-            row = cursor.fetchone()
-            conn.close()
-            if row:
-                return row[0]
+            rows = [
+                row
+                for pool in self.router.chat_pools
+                for row in pool.fetchall(
+                    """
+                    SELECT id, updated_at
+                    FROM conversations
+                    WHERE user_id = ?
+                    ORDER BY updated_at DESC
+                    LIMIT 1
+                    """,
+                    (user_id,),
+                )
+            ]
+            if rows:
+                return max(rows, key=lambda r: r[1])[0]
             return None
         except Exception as e:
             logger.error(f"❌ Error obteniendo última conversación: {e}")
@@ -383,37 +475,15 @@ class MemoryManager:
     def delete_all_conversations(self, user_id: str) -> int:
         """Eliminar todas las conversaciones y mensajes de un usuario"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            # Obtener sesiones del usuario
-            cursor.execute("SELECT id FROM conversations WHERE user_id = ?", (user_id,))
-            session_ids = [r[0] for r in cursor.fetchall()]
-            deleted = 0
-            if session_ids:
-                # Borrar mensajes de esas sesiones
-                cursor.execute(
-                    f"DELETE FROM messages WHERE session_id IN ({','.join(['?']*len(session_ids))})",
-                    session_ids,
-                )
-                # Borrar memorias
-                cursor.execute(
-                    f"DELETE FROM conversation_memory WHERE session_id IN ({','.join(['?']*len(session_ids))})",
-                    session_ids,
-                )
-                # Borrar métricas
-                cursor.execute(
-                    f"DELETE FROM metrics WHERE session_id IN ({','.join(['?']*len(session_ids))})",
-                    session_ids,
-                )
-                # Borrar conversaciones
-                cursor.execute(
-                    "DELETE FROM conversations WHERE user_id = ?",
-                    (user_id,),
-                )
-                deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
-            return deleted
+            # Evitar que escrituras pendientes reaparezcan tras el borrado
+            self.flush_writes()
+            session_ids: List[str] = []
+            for pool in self.router.chat_pools:
+                with pool.transaction() as conn:
+                    # Borrado por conjuntos: un DELETE por tabla con subconsulta, sin listas IN de tamaño variable
+                    session_ids += delete_sessions(conn, "SELECT id FROM conversations WHERE user_id = ?", (user_id,))
+            self._forget_sessions(session_ids)
+            return len(session_ids)
         except Exception as e:
             logger.error(f"❌ Error eliminando conversaciones: {e}")
             return 0
@@ -421,73 +491,153 @@ class MemoryManager:
     def delete_conversation(self, session_id: str, user_id: str) -> bool:
         """Eliminar una conversación individual y sus mensajes asociados"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Verificar que la conversación pertenece al usuario
-            cursor.execute(
-                "SELECT id FROM conversations WHERE id = ? AND user_id = ?",
-                (session_id, user_id)
-            )
-            if not cursor.fetchone():
-                conn.close()
-                return False
-            
-            # Borrar mensajes de la sesión
-            cursor.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
-            
-            # Borrar memorias de la sesión
-            cursor.execute("DELETE FROM conversation_memory WHERE session_id = ?", (session_id,))
-            
-            # Borrar métricas de la sesión
-            cursor.execute("DELETE FROM metrics WHERE session_id = ?", (session_id,))
-            
-            # Borrar la conversación
-            cursor.execute("DELETE FROM conversations WHERE id = ?", (session_id,))
-            
-            conn.commit()
-            conn.close()
+            # Evitar que escrituras pendientes reaparezcan tras el borrado
+            self.flush_writes()
+            with self._pool(session_id).transaction() as conn:
+                cursor = conn.cursor()
+                
+                # Verificar que la conversación pertenece al usuario
+                cursor.execute(
+                    "SELECT id FROM conversations WHERE id = ? AND user_id = ?",
+                    (session_id, user_id)
+                )
+                if not cursor.fetchone():
+                    return False
+                
+                # Borrar mensajes de la sesión
+                cursor.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                
+                # Borrar memorias de la sesión
+                cursor.execute("DELETE FROM conversation_memory WHERE session_id = ?", (session_id,))
+                
+                # Borrar métricas de la sesión
+                cursor.execute("DELETE FROM metrics WHERE session_id = ?", (session_id,))
+                
+                # Borrar la conversación
+                cursor.execute("DELETE FROM conversations WHERE id = ?", (session_id,))
+            self._forget_sessions([session_id])
             return True
         except Exception as e:
             logger.error(f"❌ Error eliminando conversación {session_id}: {e}")
             return False
 
+    def _forget_memories(self, session_ids: List[str]):
+        """Descartar memorias e historial cacheados de sesiones eliminadas"""
+        deleted = set(session_ids)
+        self.cache.invalidate_where(lambda key: key[1] in deleted)
+
+    def _forget_sessions(self, session_ids: List[str]):
+        """Limpiar lo que queda de sesiones eliminadas fuera de su shard de chat"""
+        if not session_ids:
+            return
+        # Con metrics en su propio archivo, delete_sessions no alcanza sus filas
+        if self.router.metrics_pool not in self.router.chat_pools:
+            self.router.metrics_pool.executemany("DELETE FROM metrics WHERE session_id = ?", [(s,) for s in session_ids])
+        self.router.forget_sessions(session_ids)
+        self._forget_memories(session_ids)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Contadores del cache de estado de sesión (hits, misses, evictions)"""
+        return self.cache.stats()
+
     def ensure_conversation(self, user_id: str, session_id: str, title: str = "Nueva conversación"):
         """Asegurar que la conversación exista y pertenezca al usuario."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id FROM conversations WHERE id = ?",
-                (session_id,),
+            now = int(time.time())
+            # INSERT OR IGNORE evita la lectura previa y la carrera entre dos peticiones simultáneas
+            self.router.assign_session(session_id, user_id).execute(
+                """
+                INSERT OR IGNORE INTO conversations (id, user_id, title, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (session_id, user_id, title, now, now),
             )
-            row = cursor.fetchone()
-            if not row:
-                now = int(time.time())
-                cursor.execute(
-                    """
-                    INSERT INTO conversations (id, user_id, title, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                    """,
-                    (session_id, user_id, title, now, now),
-                )
-                conn.commit()
-            conn.close()
         except Exception as e:
             logger.error(f"❌ Error asegurando conversación: {e}")
 
+    @staticmethod
+    def _fts_query(text: str) -> str:
+        """Convertir texto libre en una consulta FTS5 segura (términos entre comillas, AND implícito)"""
+        terms = re.findall(r"\w+", text or "")
+        if not terms:
+            return ""
+        # Prefijo en el último término para búsqueda mientras se escribe
+        return " ".join(f'"{t}"' for t in terms[:-1]) + (" " if len(terms) > 1 else "") + f'"{terms[-1]}"*'
+
+    def search_conversations(self, user_id: str, query: str, limit: int = 20, session_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Buscar mensajes de un usuario por contenido (FTS5, ranking bm25 y snippet resaltado)
+
+        Con varios shards se busca en cada uno y se mezclan por bm25 (sin session_id) o solo
+        en el shard de la sesión indicada.
+        """
+        fts_query = self._fts_query(query)
+        if not fts_query:
+            return []
+        pools = [self._pool(session_id)] if session_id else self.router.chat_pools
+        rows: List[tuple] = []
+        for pool in pools:
+            get_write_queue(pool).flush()
+            rows += self._search_shard(pool, user_id, query, fts_query, limit, session_id)
+        if len(pools) > 1:
+            rows.sort(key=lambda r: r[6])
+            rows = rows[:limit]
+        return [
+            {
+                "message_id": r[0],
+                "session_id": r[1],
+                "title": r[2],
+                "role": r[3],
+                "timestamp": r[4],
+                "snippet": html.escape(r[5] or "").replace("\x02", "<mark>").replace("\x03", "</mark>"),
+                "score": round(-r[6], 4),
+            }
+            for r in rows
+        ]
+
+    @staticmethod
+    def _search_shard(pool, user_id: str, query: str, fts_query: str, limit: int, session_id: Optional[str]) -> List[tuple]:
+        """Búsqueda en un archivo de chat: filas (id, session_id, title, role, timestamp, snippet, bm25)"""
+        try:
+            where = "messages_fts MATCH ? AND c.user_id = ?"
+            params: List[Any] = [fts_query, user_id]
+            if session_id:
+                where += " AND m.session_id = ?"
+                params.append(session_id)
+            params.append(limit)
+            # Marcadores de control para el resaltado: se escapa el HTML y luego se reemplazan por <mark>
+            return pool.fetchall(f"""
+                SELECT m.id, m.session_id, c.title, m.role, m.timestamp,
+                       snippet(messages_fts, 0, char(2), char(3), '…', 16),
+                       bm25(messages_fts)
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                JOIN conversations c ON c.id = m.session_id
+                WHERE {where}
+                ORDER BY bm25(messages_fts)
+                LIMIT ?
+            """, params)
+        except sqlite3.OperationalError as e:
+            if "no such table" not in str(e):
+                raise
+            # Sin FTS5: búsqueda lineal con LIKE (sin ranking)
+            logger.warning("⚠️ messages_fts no existe, usando LIKE")
+            like = f"%{query}%"
+            sql_params: List[Any] = [user_id, like] + ([session_id] if session_id else []) + [limit]
+            return pool.fetchall(f"""
+                SELECT m.id, m.session_id, c.title, m.role, m.timestamp, substr(m.content, 1, 200), 0
+                FROM messages m JOIN conversations c ON c.id = m.session_id
+                WHERE c.user_id = ? AND m.content LIKE ? {"AND m.session_id = ?" if session_id else ""}
+                ORDER BY m.id DESC
+                LIMIT ?
+            """, sql_params)
+
     def conversation_belongs_to_user(self, session_id: str, user_id: str) -> bool:
         """Validar pertenencia de una sesión a un usuario"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
+            return self._pool(session_id).fetchone(
                 "SELECT 1 FROM conversations WHERE id = ? AND user_id = ?",
                 (session_id, user_id),
-            )
-            ok = cursor.fetchone() is not None
-            conn.close()
-            return ok
+            ) is not None
         except Exception as e:
             logger.error(f"❌ Error validando pertenencia: {e}")
             return False
@@ -495,18 +645,13 @@ class MemoryManager:
     def rename_conversation(self, session_id: str, user_id: str, new_title: str) -> bool:
         """Renombrar una conversación si pertenece al usuario"""
         try:
-            if not self.conversation_belongs_to_user(session_id, user_id):
-                return False
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
             now = int(time.time())
-            cursor.execute(
-                "UPDATE conversations SET title = ?, updated_at = ? WHERE id = ? AND user_id = ?",
+            # El filtro por user_id valida la pertenencia en la misma sentencia
+            updated = self._pool(session_id).execute(
+                "UPDATE conversations SET title = ?, updated_at = ?, version = version + 1 WHERE id = ? AND user_id = ?",
                 (new_title, now, session_id, user_id),
             )
-            conn.commit()
-            conn.close()
-            return True
+            return updated > 0
         except Exception as e:
             logger.error(f"❌ Error renombrando conversación: {e}")
             return False
@@ -527,10 +672,14 @@ class MemoryManager:
             
             # Agregar mensajes recientes
             if recent_messages:
+                counter = get_token_counter()
                 context_parts.append("## Mensajes recientes:")
                 for msg in recent_messages[-3:]:  # Solo los últimos 3 mensajes
                     role = "Usuario" if msg["role"] == "user" else "Asistente"
-                    content = msg["content"][:200] + "..." if len(msg["content"]) > 200 else msg["content"]
+                    # Recorte en frontera de token (≈200 caracteres)
+                    content = counter.truncate_text(msg["content"], CONTEXT_SNIPPET_TOKENS)
+                    if content != msg["content"]:
+                        content += "..."
                     context_parts.append(f"{role}: {content}")
             
             return "\n\n".join(context_parts) if context_parts else ""
@@ -558,37 +707,129 @@ class MemoryManager:
         success: bool = True,
         error_message: Optional[str] = None,
     ):
-        """Registrar métricas de una interacción en SQLite"""
+        """Registrar métricas de una interacción en SQLite (vía cola de escritura)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
+            self.metrics_queue.submit(self._metrics_op(
+                session_id=session_id, input_chars=input_chars, output_chars=output_chars,
+                input_tokens=input_tokens, output_tokens=output_tokens, total_tokens=total_tokens,
+                started_at=started_at, ended_at=ended_at, duration_ms=duration_ms, model=model,
+                provider=provider, stream=stream, is_image=is_image, success=success,
+                error_message=error_message,
+            ))
+        except Exception as e:
+            logger.error(f"❌ Error registrando métricas: {e}")
+
+    @staticmethod
+    def _metrics_op(**m):
+        """Operación de escritura: fila de métricas"""
+        def as_int(value):
+            return int(value) if value is not None else None
+
+        params = (
+            m["session_id"],
+            as_int(m["input_chars"]),
+            as_int(m["output_chars"]),
+            as_int(m.get("input_tokens")),
+            as_int(m.get("output_tokens")),
+            as_int(m.get("total_tokens")),
+            as_int(m.get("started_at")),
+            as_int(m.get("ended_at")),
+            as_int(m.get("duration_ms")),
+            m.get("model"),
+            m.get("provider"),
+            1 if m.get("stream") else 0,
+            1 if m.get("is_image") else 0,
+            1 if m.get("success", True) else 0,
+            m.get("error_message"),
+        )
+        # started_at/ended_at se registran en ms; los rollups usan segundos
+        ts_ms = params[7] or params[6]
+        rollup_ts = ts_ms // 1000 if ts_ms else int(time.time())
+
+        def op(conn):
+            conn.execute(
                 """
                 INSERT INTO metrics (
                     session_id, input_chars, output_chars, input_tokens, output_tokens, total_tokens,
                     started_at, ended_at, duration_ms, model, provider, stream, is_image, success, error_message
                 ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (
-                    session_id,
-                    int(input_chars) if input_chars is not None else None,
-                    int(output_chars) if output_chars is not None else None,
-                    int(input_tokens) if input_tokens is not None else None,
-                    int(output_tokens) if output_tokens is not None else None,
-                    int(total_tokens) if total_tokens is not None else None,
-                    int(started_at) if started_at is not None else None,
-                    int(ended_at) if ended_at is not None else None,
-                    int(duration_ms) if duration_ms is not None else None,
-                    model,
-                    provider,
-                    1 if stream else 0,
-                    1 if is_image else 0,
-                    1 if success else 0,
-                    error_message,
-                ),
+                params,
             )
-            conn.commit()
-            conn.close()
+            # Rollups por minuto/hora en la misma transacción (solo UPSERTs)
+            update_rollups(
+                conn,
+                ts=rollup_ts,
+                model=params[9],
+                provider=params[10],
+                stream=params[11],
+                is_image=params[12],
+                success=params[13],
+                input_tokens=params[3],
+                output_tokens=params[4],
+                total_tokens=params[5],
+                duration_ms=params[8],
+            )
+
+        return op
+
+    # --- API asíncrona: misma lógica ejecutada en el executor del shard que toca la operación ---
+
+    async def _run_for_session(self, session_id: str, fn, *args):
+        """Ejecutar en el executor del shard de la sesión (el directorio se consulta fuera del event loop)"""
+        pool = self.router.cached_pool_for_session(session_id)
+        if pool is None:
+            pool = await self.router.auth_pool.run(self.router.pool_for_session, session_id)
+        return await pool.run(fn, *args)
+
+    async def _run_for_user(self, user_id: Optional[str], fn, *args):
+        """Ejecutar en el executor del shard del usuario (las consultas de varios shards parten de ahí)"""
+        return await self.router.pool_for_user(user_id).run(fn, *args)
+
+    async def add_message_to_conversation_async(self, session_id: str, role: str, content: str, metadata: Dict[str, Any] = None, message_id: Optional[str] = None):
+        return await self._run_for_session(session_id, self.add_message_to_conversation, session_id, role, content, metadata, message_id)
+
+    async def get_conversation_history_async(self, session_id: str, limit: int = 50, before_id: Optional[int] = None, after_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        return await self._run_for_session(session_id, self.get_conversation_history, session_id, limit, before_id, after_id)
+
+    async def get_session_version_async(self, session_id: str) -> Optional[int]:
+        return await self._run_for_session(session_id, self.get_session_version, session_id)
+
+    async def query_metrics_async(self, session_id: Optional[str] = None, limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
+        return await self.router.metrics_pool.run(self.query_metrics, session_id, limit, offset)
+
+    async def query_metrics_summary_async(self, **kwargs) -> List[Dict[str, Any]]:
+        return await self.router.metrics_pool.run(self.query_metrics_summary, **kwargs)
+
+    async def create_conversation_async(self, user_id: str, title: str = "Nueva conversación") -> str:
+        return await self._run_for_user(user_id, self.create_conversation, user_id, title)
+
+    async def list_conversations_async(self, user_id: str, limit: int = 100, offset: int = 0, cursor: Optional[Tuple[int, str]] = None, updated_after: Optional[int] = None) -> List[Dict[str, Any]]:
+        return await self._run_for_user(user_id, self.list_conversations, user_id, limit, offset, cursor, updated_after)
+
+    async def delete_all_conversations_async(self, user_id: str) -> int:
+        return await self._run_for_user(user_id, self.delete_all_conversations, user_id)
+
+    async def delete_conversation_async(self, session_id: str, user_id: str) -> bool:
+        return await self._run_for_session(session_id, self.delete_conversation, session_id, user_id)
+
+    async def ensure_conversation_async(self, user_id: str, session_id: str, title: str = "Nueva conversación"):
+        # Aún sin registrar en el directorio: la conversación irá al shard del usuario
+        return await self._run_for_user(user_id, self.ensure_conversation, user_id, session_id, title)
+
+    async def search_conversations_async(self, user_id: str, query: str, limit: int = 20, session_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await self._run_for_user(user_id, self.search_conversations, user_id, query, limit, session_id)
+
+    async def conversation_belongs_to_user_async(self, session_id: str, user_id: str) -> bool:
+        return await self._run_for_session(session_id, self.conversation_belongs_to_user, session_id, user_id)
+
+    async def rename_conversation_async(self, session_id: str, user_id: str, new_title: str) -> bool:
+        return await self._run_for_session(session_id, self.rename_conversation, session_id, user_id, new_title)
+
+    async def log_chat_metrics_async(self, **kwargs):
+        # Solo encola: no necesita pasar por el executor salvo en modo 'sync'/'commit'
+        try:
+            await self.metrics_queue.submit_async(self._metrics_op(**kwargs))
         except Exception as e:
             logger.error(f"❌ Error registrando métricas: {e}")
 
@@ -602,4 +843,3 @@ def get_memory_manager(db_path: str = "chatbot.db") -> MemoryManager:
     if _memory_manager is None:
         _memory_manager = MemoryManager(db_path)
     return _memory_manager
-
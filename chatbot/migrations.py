@@ -0,0 +1,368 @@
+"""
+Migraciones versionadas del esquema de chatbot.db
+Cada migración se aplica una sola vez y queda registrada en schema_migrations
+
+Uso:
+    python migrations.py                  # aplicar migraciones pendientes a chatbot.db
+    python migrations.py --db otra.db     # aplicar a otro archivo
+    python migrations.py --status         # mostrar versión actual y pendientes
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+from typing import Callable, List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, name: str):
+    """Registrar una migración numerada (las versiones deben ser crecientes)"""
+    def decorator(fn: Callable[[sqlite3.Connection], None]):
+        if MIGRATIONS and MIGRATIONS[-1].version >= version:
+            raise ValueError(f"Migración {version} fuera de orden")
+        MIGRATIONS.append(Migration(version, name, fn))
+        return fn
+    return decorator
+
+
+# --- Migraciones ---
+# Solo cambios aditivos (IF NOT EXISTS, columnas nuevas con DEFAULT) para poder
+# aplicarlas sobre bases de datos en producción sin detener el servicio.
+
+@migration(1, "esquema_base")
+def _m001_esquema_base(conn: sqlite3.Connection):
+    """Tablas originales de MemoryManager y AuthManager (no-op en bases existentes)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_memory (
+            session_id TEXT PRIMARY KEY,
+            agent_id TEXT NOT NULL,
+            memory_type TEXT NOT NULL,
+            memory_data TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            metadata TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            title TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            is_temporary INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            input_chars INTEGER,
+            output_chars INTEGER,
+            input_tokens INTEGER,
+            output_tokens INTEGER,
+            total_tokens INTEGER,
+            started_at INTEGER,
+            ended_at INTEGER,
+            duration_ms INTEGER,
+            model TEXT,
+            provider TEXT,
+            stream INTEGER,
+            is_image INTEGER,
+            success INTEGER,
+            error_message TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            name TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            is_active INTEGER DEFAULT 1
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            token TEXT UNIQUE NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+
+@migration(2, "indices_consultas")
+def _m002_indices_consultas(conn: sqlite3.Connection):
+    """Índices para las consultas calientes (evitan full table scans)"""
+    # Historial: WHERE session_id = ? ORDER BY timestamp
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_ts ON messages(session_id, timestamp)")
+    # Listado y última conversación: WHERE user_id = ? ORDER BY updated_at DESC
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations(user_id, updated_at)")
+    # Métricas por sesión: WHERE session_id = ? ORDER BY id DESC
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_session_id ON metrics(session_id, id)")
+    # user_sessions.token y users.email ya tienen índice UNIQUE; faltan sesiones por usuario y por expiración
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user ON user_sessions(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_expires ON user_sessions(expires_at)")
+    # Actualizar estadísticas del planificador (muestreo acotado para no bloquear en tablas grandes)
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("ANALYZE")
+
+
+@migration(3, "message_uid")
+def _m003_message_uid(conn: sqlite3.Connection):
+    """Identificador estable por mensaje para persistencia idempotente (INSERT OR IGNORE)"""
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(messages)")}
+    if "message_uid" not in columns:
+        conn.execute("ALTER TABLE messages ADD COLUMN message_uid TEXT")
+    # Índice único parcial: las filas antiguas sin uid (NULL) no entran en conflicto
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_uid ON messages(message_uid) WHERE message_uid IS NOT NULL"
+    )
+
+
+@migration(4, "paginacion_keyset")
+def _m004_paginacion_keyset(conn: sqlite3.Connection):
+    """Contador de versión por sesión (ETag) e índices para paginación por cursor"""
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(conversations)")}
+    if "version" not in columns:
+        conn.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    # Historial por cursor de id: WHERE session_id = ? AND id < ? ORDER BY id DESC
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_msgid ON messages(session_id, id)")
+    # Listado por cursor (updated_at, id) con desempate estable
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_updated_id ON conversations(user_id, updated_at, id)")
+    conn.execute("DROP INDEX IF EXISTS idx_conversations_user_updated")
+
+
+@migration(5, "archivo_mensajes")
+def _m005_archivo_mensajes(conn: sqlite3.Connection):
+    """Archivo comprimido del historial frío (ver maintenance.py)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL,
+            payload BLOB NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_message_archive_session ON message_archive(session_id, first_id)")
+    # Expiración de sesiones temporales/abandonadas por updated_at
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at)")
+
+
+@migration(6, "rollups_metricas")
+def _m006_rollups_metricas(conn: sqlite3.Connection):
+    """Agregados por minuto/hora de metrics con histograma de duración (ver metrics_rollup.py)"""
+    from metrics_rollup import rebuild_rollups
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metrics_rollup (
+            granularity TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            stream INTEGER NOT NULL,
+            is_image INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            input_tokens INTEGER NOT NULL DEFAULT 0,
+            output_tokens INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            duration_count INTEGER NOT NULL DEFAULT 0,
+            duration_sum INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket_start, model, provider, stream, is_image)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metrics_rollup_hist (
+            granularity TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            stream INTEGER NOT NULL,
+            is_image INTEGER NOT NULL,
+            bin INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket_start, model, provider, stream, is_image, bin)
+        ) WITHOUT ROWID
+    """)
+    # Backfill con las métricas ya registradas
+    rebuild_rollups(conn)
+
+
+@migration(7, "busqueda_fts5")
+def _m007_busqueda_fts5(conn: sqlite3.Connection):
+    """Índice FTS5 de contenido externo sobre messages, sincronizado por triggers"""
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content,
+                content='messages',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite compilado sin FTS5: la búsqueda usa LIKE como respaldo
+        logger.warning(f"⚠️ FTS5 no disponible, búsqueda sin índice: {e}")
+        return
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """)
+    # Indexar los mensajes existentes
+    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+@migration(8, "directorio_sesiones")
+def _m008_directorio_sesiones(conn: sqlite3.Connection):
+    """Mapa session_id -> shard de chat (solo se usa con CHATBOT_DB_CHAT_SHARDS > 1)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS session_directory (
+            session_id TEXT PRIMARY KEY,
+            shard INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+@migration(9, "preferencia_cache_respuestas")
+def _m009_preferencia_cache_respuestas(conn: sqlite3.Connection):
+    """Opt-out por usuario del cache de respuestas del LLM"""
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+    if "response_cache" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN response_cache INTEGER NOT NULL DEFAULT 1")
+
+
+@migration(10, "modelo_latencia")
+def _m010_modelo_latencia(conn: sqlite3.Connection):
+    """Ventanas de latencia por endpoint y modelo (timeouts aprendidos que sobreviven reinicios)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS latency_model (
+            endpoint TEXT NOT NULL,
+            model TEXT NOT NULL,
+            samples TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (endpoint, model)
+        ) WITHOUT ROWID
+    """)
+
+
+# --- Runner ---
+
+def _ensure_migrations_table(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at INTEGER NOT NULL
+        )
+    """)
+    conn.commit()
+
+
+def get_applied_versions(conn: sqlite3.Connection) -> List[int]:
+    """Versiones ya aplicadas en esta base de datos"""
+    _ensure_migrations_table(conn)
+    return [r[0] for r in conn.execute("SELECT version FROM schema_migrations ORDER BY version")]
+
+
+def apply_migrations_conn(conn: sqlite3.Connection) -> List[int]:
+    """Aplicar migraciones pendientes sobre una conexión; devuelve las versiones aplicadas"""
+    applied_now: List[int] = []
+    applied = set(get_applied_versions(conn))
+    for m in MIGRATIONS:
+        if m.version in applied:
+            continue
+        # BEGIN IMMEDIATE toma el lock de escritura: si varios workers de uvicorn arrancan
+        # a la vez, solo uno aplica cada migración y los demás esperan (busy_timeout)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            already = conn.execute(
+                "SELECT 1 FROM schema_migrations WHERE version = ?", (m.version,)
+            ).fetchone()
+            if already:
+                conn.rollback()
+                continue
+            m.apply(conn)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (m.version, m.name, int(time.time())),
+            )
+            conn.commit()
+            applied_now.append(m.version)
+            logger.info(f"✅ Migración {m.version:03d} aplicada: {m.name}")
+        except Exception:
+            conn.rollback()
+            logger.error(f"❌ Error aplicando migración {m.version:03d} ({m.name})")
+            raise
+    return applied_now
+
+
+def apply_migrations(pool) -> List[int]:
+    """Aplicar migraciones pendientes usando una conexión del pool"""
+    with pool.connection() as conn:
+        return apply_migrations_conn(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migraciones de esquema para chatbot.db")
+    parser.add_argument("--db", default="chatbot.db", help="Ruta de la base de datos SQLite")
+    parser.add_argument("--status", action="store_true", help="Solo mostrar estado, sin aplicar")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(args.db, timeout=30.0)
+    try:
+        applied = get_applied_versions(conn)
+        pending = [m for m in MIGRATIONS if m.version not in applied]
+        print(f"📦 {args.db}: versión actual {max(applied) if applied else 0}, {len(pending)} pendientes")
+        for m in pending:
+            print(f"  - {m.version:03d} {m.name}")
+        if not args.status and pending:
+            done = apply_migrations_conn(conn)
+            print(f"✅ Aplicadas: {', '.join(str(v) for v in done) or 'ninguna'}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+"""
+Disposición de prompts para aprovechar el prefix caching de vLLM en el Chatbot IMSS
+vLLM solo reutiliza el KV cache de una secuencia inicial de tokens idéntica, así que el prompt
+se ordena de lo más estable a lo más volátil:
+
+1. System prompt versionado: el mismo texto para process_chat, stream_chat y el análisis de imágenes
+2. Few-shot (opcional, estables)
+3. Historial anclado: el primer mensaje enviado se mantiene entre turnos y el historial solo crece
+   por el final; al llenarse se re-ancla dejando hueco para los turnos siguientes
+4. Mensaje actual y, detrás, el contexto volátil (nombre del usuario, entidades)
+
+Cada petición calcula localmente cuántos tokens iniciales comparte con la anterior de la misma
+sesión (o con el system de cualquier otra), redondeado a bloques de KV cache.
+
+Benchmark (reproduce las conversaciones guardadas y compara con la disposición anterior):
+    python prompt_layout.py --benchmark --db chatbot.db --limit 200
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from context_assembler import ChatTurn, get_context_assembler
+from token_counter import get_token_counter
+
+logger = logging.getLogger(__name__)
+
+# Cambiar al modificar el orden de los segmentos (invalida el prefijo de todas las peticiones)
+PROMPT_LAYOUT_VERSION = 1
+PREFIX_BLOCK_TOKENS = int(os.getenv("CHATBOT_PREFIX_BLOCK_TOKENS", "16"))  # --block-size de vLLM
+PREFIX_TRACKER_SESSIONS = int(os.getenv("CHATBOT_PREFIX_TRACKER_SESSIONS", "10000"))
+# Fracción del presupuesto de historial que se ocupa al re-anclar (el resto queda para crecer)
+PREFIX_REANCHOR_FILL = float(os.getenv("CHATBOT_PREFIX_REANCHOR_FILL", "0.5"))
+
+DEFAULT_PROMPT_PATH = os.path.join(os.path.dirname(__file__), "prompts", "medico.md")
+FALLBACK_SYSTEM_PROMPT = """Eres un asistente médico especializado del IMSS que proporciona información médica general,
+interpretación de síntomas y guías de salud preventiva.
+
+IMPORTANTE: Siempre recomiendas consultar con profesionales de la salud del IMSS para diagnósticos específicos
+y tratamientos médicos. Responde en español."""
+
+
+def load_system_prompt(path: str = DEFAULT_PROMPT_PATH) -> str:
+    """System prompt principal de prompts/medico.md (sección "## System Prompt Principal")"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        if "## System Prompt Principal" in content:
+            start = content.find("## System Prompt Principal") + len("## System Prompt Principal")
+            end = content.find("##", start)
+            if end > start:
+                return content[start:end].strip()
+        return content
+    except Exception as e:
+        logger.warning(f"⚠️ Error cargando prompt médico: {e}")
+    return FALLBACK_SYSTEM_PROMPT
+
+
+def _chain_hash(previous: bytes, role: str, content: str) -> bytes:
+    """Hash acumulado: identifica un mensaje junto con todo lo que va antes"""
+    h = hashlib.blake2b(previous, digest_size=16)
+    h.update(role.encode("utf-8"))
+    h.update(b"\x00")
+    h.update(content.encode("utf-8", errors="replace"))
+    return h.digest()
+
+
+def _message_hash(role: str, content: str) -> bytes:
+    return _chain_hash(b"", role, content)
+
+
+class PrefixTracker:
+    """Mide el prefijo compartido de cada prompt con el anterior de su sesión (aproximación local)"""
+
+    def __init__(self, block_tokens: int = PREFIX_BLOCK_TOKENS, max_sessions: int = PREFIX_TRACKER_SESSIONS):
+        self.block_tokens = max(1, block_tokens)
+        self.max_sessions = max(1, max_sessions)
+        # session_id -> (hashes acumulados, tokens acumulados, contenido del último mensaje)
+        self._sessions: "OrderedDict[str, Tuple[List[bytes], List[int], str]]" = OrderedDict()
+        # Hashes del system (compartido entre sesiones) -> tokens
+        self._shared: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.shared_tokens = 0
+
+    def observe(self, session_id: str, messages: Sequence[ChatTurn]) -> int:
+        """Registrar un prompt y devolver los tokens iniciales que vLLM puede reutilizar"""
+        counter = get_token_counter()
+        hashes: List[bytes] = []
+        cumulative: List[int] = []
+        digest, tokens = b"", counter.bos_tokens
+        for role, content in messages:
+            digest = _chain_hash(digest, role, content)
+            tokens += counter.count_text(content) + counter.turn_overhead
+            hashes.append(digest)
+            cumulative.append(tokens)
+        if not hashes:
+            return 0
+
+        with self._lock:
+            shared = 0
+            previous = self._sessions.get(session_id) if session_id else None
+            if previous is not None:
+                prev_hashes, _, prev_last = previous
+                common = 0
+                while common < min(len(hashes), len(prev_hashes)) and hashes[common] == prev_hashes[common]:
+                    common += 1
+                shared = cumulative[common - 1] if common else counter.bos_tokens
+                # El último mensaje anterior (mensaje + contexto volátil) comparte su inicio con el del historial
+                if common == len(prev_hashes) - 1 and common < len(messages):
+                    text = os.path.commonprefix([prev_last, messages[common][1]])
+                    shared += counter.count_text(text)
+            if hashes[0] in self._shared:
+                shared = max(shared, self._shared[hashes[0]])
+                self._shared.move_to_end(hashes[0])
+            else:
+                self._shared[hashes[0]] = cumulative[0]
+                if len(self._shared) > 256:
+                    self._shared.popitem(last=False)
+            if session_id:
+                self._sessions[session_id] = (hashes, cumulative, messages[-1][1])
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+
+            total = cumulative[-1] + counter.generation_prompt_tokens
+            # vLLM reutiliza bloques completos
+            shared = min(shared, total) // self.block_tokens * self.block_tokens
+            self.requests += 1
+            self.prompt_tokens += total
+            self.shared_tokens += shared
+        return shared
+
+    def forget(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "shared_prefix_tokens": self.shared_tokens,
+                "hit_rate": round(self.shared_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+                "sessions": len(self._sessions),
+                "block_tokens": self.block_tokens,
+            }
+
+
+class LaidOutPrompt(NamedTuple):
+    messages: List[ChatTurn]
+    breakdown: Dict[str, Any]
+
+
+class PromptLayout:
+    """Construye los prompts de chat con el prefijo estable primero (ver docstring del módulo)"""
+
+    def __init__(self, system_prompt: str, few_shots: Sequence[Dict[str, str]] = (), name: str = "chat"):
+        self.system_prompt = (system_prompt or "").strip()
+        self.few_shots = [dict(e) for e in few_shots if e.get("user") and e.get("assistant")]
+        digest = hashlib.sha256(
+            json.dumps([PROMPT_LAYOUT_VERSION, self.system_prompt, self.few_shots], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:12]
+        # Versión del prefijo estable: cambia si cambia el system, los few-shot o la disposición
+        self.version = f"{name}-{PROMPT_LAYOUT_VERSION}-{digest}"
+        # session_id -> hash del primer mensaje de historial enviado
+        self._anchors: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def volatile_context(user_name: Optional[str] = None, entity_context: str = "") -> str:
+        """Contexto que cambia entre peticiones; va detrás del mensaje actual"""
+        parts = []
+        if user_name and user_name.strip():
+            parts.append(f"El usuario es Dr./Dra. {user_name.strip().split()[0]}.")
+        if entity_context and entity_context.strip():
+            counter = get_token_counter()
+            parts.append(counter.truncate_text(entity_context.strip(), get_context_assembler().entity_tokens))
+        return "\n\n## Contexto\n" + "\n".join(parts) if parts else ""
+
+    def _anchored_history(self, session_id: str, history: Sequence[ChatTurn], budget: int) -> List[ChatTurn]:
+        """Historial a enviar: desde el ancla de la sesión si aún cabe; si no, re-anclar"""
+        history = list(history)
+        if not history:
+            return history
+        counter = get_token_counter()
+        costs = [counter.count_text(content) + counter.turn_overhead for _, content in history]
+        hashes = [_message_hash(role, content) for role, content in history]
+        with self._lock:
+            anchor = self._anchors.get(session_id)
+        if anchor is not None and anchor in hashes:
+            start = hashes.index(anchor)
+            if sum(costs[start:]) <= budget:
+                return history[start:]
+
+        # Re-anclar: sufijo de mensajes completos que ocupe como máximo PREFIX_REANCHOR_FILL del presupuesto
+        target = budget * PREFIX_REANCHOR_FILL
+        start, used = len(history), 0
+        for i in range(len(history) - 1, -1, -1):
+            if used + costs[i] > target:
+                break
+            used += costs[i]
+            start = i
+        while start < len(history) and history[start][0] != "user":
+            start += 1
+        if start < len(history):
+            with self._lock:
+                self._anchors[session_id] = hashes[start]
+                self._anchors.move_to_end(session_id)
+                while len(self._anchors) > PREFIX_TRACKER_SESSIONS:
+                    self._anchors.popitem(last=False)
+        return history[start:]
+
+    def build(
+        self,
+        user_message: str,
+        history: Sequence[ChatTurn] = (),
+        session_id: str = "",
+        user_name: Optional[str] = None,
+        entity_context: str = "",
+        max_tokens: int = 2048,
+        reserved_tokens: int = 0,
+        tracker: Optional["PrefixTracker"] = None,
+        measure: bool = True,
+    ) -> LaidOutPrompt:
+        """Mensajes [system, few-shot..., historial anclado..., user + contexto volátil]
+
+        measure=False no registra el prompt en el medidor (p. ej. para estimar usage).
+        """
+        assembler = get_context_assembler()
+        if session_id:
+            history = self._anchored_history(session_id, history, assembler.history_tokens)
+        assembled = assembler.assemble(
+            self.system_prompt,
+            user_message + self.volatile_context(user_name, entity_context),
+            history=history,
+            few_shots=self.few_shots,
+            max_tokens=max_tokens,
+            reserved_tokens=reserved_tokens,
+            truncate_history=False,
+        )
+        breakdown = dict(assembled.breakdown)
+        breakdown["prefix_version"] = self.version
+        if measure:
+            tracker = tracker or get_prefix_tracker()
+            breakdown["shared_prefix_tokens"] = tracker.observe(session_id, assembled.messages)
+        return LaidOutPrompt(assembled.messages, breakdown)
+
+    def forget(self, session_id: str):
+        with self._lock:
+            self._anchors.pop(session_id, None)
+
+
+# Instancia global
+_prefix_tracker: Optional[PrefixTracker] = None
+_prefix_tracker_lock = threading.Lock()
+
+
+def get_prefix_tracker() -> PrefixTracker:
+    """Obtener el medidor de prefijo compartido del proceso"""
+    global _prefix_tracker
+    if _prefix_tracker is None:
+        with _prefix_tracker_lock:
+            if _prefix_tracker is None:
+                _prefix_tracker = PrefixTracker()
+    return _prefix_tracker
+
+
+# --- Benchmark ---
+
+# System corto que usaba stream_chat antes de compartir el de medico.md (con el nombre dentro)
+LEGACY_STREAM_SYSTEM_PROMPT = "Eres un asistente médico del IMSS. Responde en español de manera clara y profesional."
+
+
+class _ReplayTurn(NamedTuple):
+    timestamp: int
+    session_id: str
+    index: int  # posición del mensaje en la conversación
+    stream: bool  # stream_chat (True) o process_chat
+
+
+def _legacy_stream_system(user_name: Optional[str]) -> str:
+    if user_name and user_name.strip():
+        return f"{LEGACY_STREAM_SYSTEM_PROMPT} El usuario es Dr./Dra. {user_name.strip().split()[0]}."
+    return LEGACY_STREAM_SYSTEM_PROMPT
+
+
+def _load_conversations(db_path: str, limit: int) -> Tuple[Dict[str, List[ChatTurn]], Dict[str, Optional[str]], List[_ReplayTurn]]:
+    """Conversaciones guardadas (más recientes primero): mensajes en orden, nombre del usuario de cada
+    sesión y los turnos del usuario de todas ellas en orden cronológico (como llegaron al proceso)"""
+    from db_router import get_router
+
+    router = get_router(db_path)
+    conversations: Dict[str, List[ChatTurn]] = {}
+    owners: Dict[str, Optional[str]] = {}
+    replay: List[_ReplayTurn] = []
+    for pool in router.chat_pools:
+        ids = pool.fetchall("SELECT id, user_id FROM conversations ORDER BY updated_at DESC LIMIT ?", (limit,))
+        for session_id, user_id in ids:
+            if len(conversations) >= limit:
+                break
+            rows = pool.fetchall(
+                "SELECT role, content, timestamp, metadata FROM messages WHERE session_id = ? ORDER BY timestamp, id",
+                (session_id,),
+            )
+            turns: List[ChatTurn] = []
+            for role, content, timestamp, metadata in rows:
+                if role not in ("user", "assistant"):
+                    continue
+                try:
+                    meta = json.loads(metadata or "{}")
+                except ValueError:
+                    meta = {}
+                # Las imágenes usan su propio prompt: entran en el historial pero no se reproducen
+                if role == "user" and not meta.get("has_image"):
+                    replay.append(_ReplayTurn(timestamp, session_id, len(turns), bool(meta.get("stream"))))
+                turns.append((role, content or ""))
+            if turns:
+                conversations[session_id] = turns
+                owners[session_id] = user_id
+    names: Dict[str, Optional[str]] = {}
+    user_ids = {u for u in owners.values() if u}
+    if user_ids:
+        marks = ",".join("?" * len(user_ids))
+        names = dict(router.auth_pool.fetchall(f"SELECT id, name FROM users WHERE id IN ({marks})", tuple(user_ids)))
+    replay = [turn for turn in replay if turn.session_id in conversations]
+    replay.sort(key=lambda t: (t.timestamp, t.session_id, t.index))
+    return conversations, {sid: names.get(uid) for sid, uid in owners.items()}, replay
+
+
+def benchmark(db_path: str, limit: int = 200, history_tail: int = 20) -> Dict[str, Dict[str, Any]]:
+    """Reutilización de prefijo esperada: disposición anterior frente a la disposición estable
+
+    Los turnos se reproducen en orden cronológico con el mismo contexto que cada camino recibe:
+    - process_chat: antes, system de medico.md + entidades dentro del system; ahora, entidades
+      detrás del mensaje actual
+    - stream_chat: antes, system corto propio con el nombre del usuario dentro; ahora, el system
+      compartido y el nombre detrás del mensaje actual
+    - antes el historial se recortaba por el más antiguo; ahora se ancla (ver _anchored_history)
+    Las entidades salen de una EntityMemory alimentada con los mensajes reproducidos, como la del
+    proceso (compartida entre sesiones), así que cambian entre peticiones igual que en producción.
+    """
+    from langchain_system import EntityMemory
+
+    system_prompt = load_system_prompt()
+    assembler = get_context_assembler()
+    layout = PromptLayout(system_prompt)
+    memory = EntityMemory()
+    trackers = {"legacy": PrefixTracker(), "stable": PrefixTracker()}
+    followups = {name: [0, 0] for name in trackers}  # [tokens compartidos, tokens de prompt] desde el 2.º turno
+    conversations, user_names, replay = _load_conversations(db_path, limit)
+    seen: Dict[str, int] = {}
+
+    for turn in replay:
+        turns = conversations[turn.session_id]
+        content = turns[turn.index][1]
+        history = turns[max(0, turn.index - history_tail):turn.index]
+        user_name = user_names.get(turn.session_id)
+        entity_context = "" if turn.stream else memory.get_entity_context()
+        for name, tracker in trackers.items():
+            before_shared, before_total = tracker.shared_tokens, tracker.prompt_tokens
+            if name == "legacy":
+                if turn.stream:
+                    messages = assembler.assemble(_legacy_stream_system(user_name), content, history=history).messages
+                else:
+                    messages = assembler.assemble(
+                        system_prompt, content, history=history, entity_context=entity_context
+                    ).messages
+                tracker.observe(turn.session_id, messages)
+            elif turn.stream:
+                layout.build(content, history, session_id=turn.session_id, user_name=user_name, tracker=tracker)
+            else:
+                layout.build(content, history, session_id=turn.session_id, entity_context=entity_context, tracker=tracker)
+            if seen.get(turn.session_id):
+                followups[name][0] += tracker.shared_tokens - before_shared
+                followups[name][1] += tracker.prompt_tokens - before_total
+        seen[turn.session_id] = seen.get(turn.session_id, 0) + 1
+        # Como process_chat/stream_chat: las entidades se extraen al terminar la respuesta
+        memory.add_message("user", content)
+        if turn.index + 1 < len(turns) and turns[turn.index + 1][0] == "assistant":
+            memory.add_message("assistant", turns[turn.index + 1][1])
+
+    report = {}
+    for name, tracker in trackers.items():
+        stats = tracker.stats()
+        shared, total = followups[name]
+        stats["followup_hit_rate"] = round(shared / total, 4) if total else 0.0
+        report[name] = stats
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Disposición de prompts y reutilización del prefix cache")
+    parser.add_argument("--benchmark", action="store_true", help="Reproducir conversaciones guardadas y medir el prefijo compartido")
+    parser.add_argument("--db", default="chatbot.db", help="Ruta base de las bases de datos")
+    parser.add_argument("--limit", type=int, default=200, help="Número máximo de conversaciones")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if not args.benchmark:
+        layout = PromptLayout(load_system_prompt())
+        print(f"📐 Prefijo estable {layout.version}: {get_token_counter().count_text(layout.system_prompt)} tokens de system")
+        return
+    report = benchmark(args.db, args.limit)
+    print(f"{'disposición':<12} {'peticiones':>10} {'tokens prompt':>14} {'compartidos':>12} {'reuso':>7} {'reuso 2.º turno+':>17}")
+    for name, stats in report.items():
+        print(
+            f"{name:<12} {stats['requests']:>10} {stats['prompt_tokens']:>14} {stats['shared_prefix_tokens']:>12} "
+            f"{stats['hit_rate']:>7.1%} {stats['followup_hit_rate']:>17.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Cache de respuestas del LLM para el Chatbot IMSS
+Dos niveles delante de FallbackLLM.stream:
+
+- Exacto: hash de (versión del system prompt, cola del historial, mensaje normalizado, parámetros de muestreo)
+- Semántico (opcional): similitud coseno entre embeddings del mensaje, solo dentro del mismo contexto
+  (mismo system prompt, historial y parámetros). Requiere sentence-transformers y
+  CHATBOT_RESPONSE_CACHE_EMBED_MODEL (ruta local o nombre del modelo, p. ej. paraphrase-multilingual-MiniLM-L12-v2)
+
+Las respuestas se guardan como la lista de deltas del stream original, de modo que un hit
+se reproduce con el mismo troceado SSE que una generación real.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, Optional, Sequence, Tuple
+
+from session_cache import SessionStateCache
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv("CHATBOT_RESPONSE_CACHE", "1") not in ("0", "false", "no")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("CHATBOT_RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("CHATBOT_RESPONSE_CACHE_MAX_MB", "32")) * 1024 * 1024
+RESPONSE_CACHE_TTL = int(os.getenv("CHATBOT_RESPONSE_CACHE_TTL", "86400"))  # edad máxima de una respuesta (segundos)
+RESPONSE_CACHE_EMBED_MODEL = os.getenv("CHATBOT_RESPONSE_CACHE_EMBED_MODEL", "")
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("CHATBOT_RESPONSE_CACHE_SIMILARITY", "0.92"))
+RESPONSE_CACHE_HISTORY_TAIL = int(os.getenv("CHATBOT_RESPONSE_CACHE_HISTORY_TAIL", "2"))  # mensajes de historial en la clave
+
+# Cambiar si cambia el formato de la clave o del valor cacheado
+_KEY_VERSION = 1
+_ENTRY_OVERHEAD = 200  # bytes aproximados por entrada además del texto
+
+# Respuesta cacheada: (creada_en, deltas del stream)
+CachedResponse = Tuple[float, Tuple[str, ...]]
+
+
+def normalize_text(text: str) -> str:
+    """Normalizar para la clave: sin acentos, minúsculas, espacios colapsados, sin signos al inicio/fin"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"\s+", " ", text.lower()).strip()
+    return text.strip("¿?¡!.,;: ")
+
+
+def _digest(payload: Any) -> str:
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def _sizeof(value: CachedResponse) -> int:
+    return _ENTRY_OVERHEAD + sum(len(d) for d in value[1])
+
+
+class ResponseCache:
+    """Cache de respuestas con nivel exacto (LRU + TTL + techo de memoria) y nivel semántico opcional"""
+
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl_seconds: int = RESPONSE_CACHE_TTL,
+        embed_model: str = RESPONSE_CACHE_EMBED_MODEL,
+        similarity: float = RESPONSE_CACHE_SIMILARITY,
+    ):
+        self.enabled = enabled
+        self.ttl = ttl_seconds
+        self.similarity = similarity
+        self.embed_model = embed_model
+        # TTL de inactividad del cache base igual a la edad máxima; la edad se comprueba en lookup
+        self._exact = SessionStateCache(max_entries=max_entries, ttl_seconds=ttl_seconds, max_bytes=max_bytes, sizeof=_sizeof)
+        # Índice semántico: clave exacta -> (contexto, embedding normalizado), acotado igual que el cache exacto
+        self._vectors: "OrderedDict[str, Tuple[str, Any]]" = OrderedDict()
+        self._max_vectors = max(1, max_entries)
+        self._vectors_lock = threading.Lock()
+        self._encoder = None
+        self._encoder_loaded = False
+        self._encoder_lock = threading.Lock()
+        self.semantic_hits = 0
+
+    # --- Claves ---
+
+    @staticmethod
+    def context_key(system_prompt: str, history: Sequence[Tuple[str, str]], params: Dict[str, Any]) -> str:
+        """Todo lo que condiciona la respuesta salvo el mensaje del usuario"""
+        tail = list(history)[-RESPONSE_CACHE_HISTORY_TAIL:] if RESPONSE_CACHE_HISTORY_TAIL > 0 else []
+        return _digest([
+            _KEY_VERSION,
+            _digest(system_prompt or ""),
+            [(role, normalize_text(content)) for role, content in tail],
+            sorted(params.items()),
+        ])
+
+    @staticmethod
+    def exact_key(context_key: str, user_message: str) -> str:
+        return _digest([context_key, normalize_text(user_message)])
+
+    # --- Nivel semántico ---
+
+    def _get_encoder(self):
+        """Cargar el modelo de embeddings una sola vez (None si no está configurado o no se puede cargar)"""
+        if self._encoder_loaded:
+            return self._encoder
+        with self._encoder_lock:
+            if self._encoder_loaded:
+                return self._encoder
+            if self.embed_model:
+                try:
+                    from sentence_transformers import SentenceTransformer
+
+                    self._encoder = SentenceTransformer(self.embed_model, device="cpu")
+                    logger.info(f"✅ Cache semántico de respuestas activo: {self.embed_model} (umbral {self.similarity})")
+                except Exception as e:
+                    logger.warning(f"⚠️ Cache semántico desactivado, no se pudo cargar {self.embed_model}: {e}")
+            self._encoder_loaded = True
+        return self._encoder
+
+    def _embed(self, text: str):
+        encoder = self._get_encoder()
+        if encoder is None:
+            return None
+        return encoder.encode(normalize_text(text), normalize_embeddings=True)
+
+    def _semantic_lookup(self, context_key: str, user_message: str) -> Optional[str]:
+        """Clave exacta de la respuesta más parecida del mismo contexto (si supera el umbral)"""
+        vector = self._embed(user_message)
+        if vector is None:
+            return None
+        with self._vectors_lock:
+            candidates = [(key, vec) for key, (ctx, vec) in self._vectors.items() if ctx == context_key]
+        best_key, best_score = None, self.similarity
+        for key, vec in candidates:
+            score = float(vector @ vec)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _index(self, context_key: str, exact_key: str, user_message: str):
+        vector = self._embed(user_message)
+        if vector is None:
+            return
+        with self._vectors_lock:
+            self._vectors[exact_key] = (context_key, vector)
+            self._vectors.move_to_end(exact_key)
+            while len(self._vectors) > self._max_vectors:
+                self._vectors.popitem(last=False)
+
+    # --- API ---
+
+    def lookup(self, context_key: str, user_message: str) -> Optional[Tuple[str, ...]]:
+        """Deltas cacheados para el mensaje (nivel exacto y, si no hay, semántico)"""
+        if not self.enabled:
+            return None
+        key = self.exact_key(context_key, user_message)
+        entry = self._get_fresh(key)
+        if entry is None:
+            similar = self._semantic_lookup(context_key, user_message)
+            if similar is not None:
+                entry = self._get_fresh(similar)
+                if entry is not None:
+                    self.semantic_hits += 1
+        return entry[1] if entry is not None else None
+
+    def _get_fresh(self, key: str) -> Optional[CachedResponse]:
+        entry = self._exact.get(key)
+        if entry is not None and self.ttl and time.time() - entry[0] > self.ttl:
+            self._exact.invalidate(key)
+            return None
+        return entry
+
+    def store(self, context_key: str, user_message: str, deltas: Sequence[str]):
+        """Guardar una respuesta completa (lista de deltas del stream)"""
+        if not self.enabled or not deltas:
+            return
+        key = self.exact_key(context_key, user_message)
+        self._exact.put(key, (time.time(), tuple(deltas)))
+        self._index(context_key, key, user_message)
+
+    async def lookup_async(self, context_key: str, user_message: str) -> Optional[Tuple[str, ...]]:
+        # El embedding es CPU: fuera del event loop solo si el nivel semántico está configurado
+        if not self.embed_model:
+            return self.lookup(context_key, user_message)
+        return await asyncio.get_running_loop().run_in_executor(None, self.lookup, context_key, user_message)
+
+    async def store_async(self, context_key: str, user_message: str, deltas: Sequence[str]):
+        if not self.embed_model:
+            return self.store(context_key, user_message, deltas)
+        await asyncio.get_running_loop().run_in_executor(None, self.store, context_key, user_message, list(deltas))
+
+    @staticmethod
+    async def replay(deltas: Sequence[str]) -> AsyncGenerator[str, None]:
+        """Reproducir una respuesta cacheada con los mismos deltas que el stream original"""
+        for delta in deltas:
+            yield delta
+
+    def clear(self):
+        self._exact.invalidate_where(lambda key: True)
+        with self._vectors_lock:
+            self._vectors.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self._exact.stats()
+        stats.update({
+            "enabled": self.enabled,
+            "semantic": self._encoder is not None,
+            "semantic_hits": self.semantic_hits,
+            "max_age_seconds": self.ttl,
+        })
+        return stats
+
+
+# Instancia global
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Obtener el cache de respuestas compartido del proceso"""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache()
+                logger.info(
+                    f"✅ Cache de respuestas {'activo' if _response_cache.enabled else 'desactivado'} "
+                    f"({RESPONSE_CACHE_MAX_ENTRIES} entradas, {RESPONSE_CACHE_TTL}s)"
+                )
+    return _response_cache
@@ -31,6 +31,9 @@ echo ""
 if [ "$1" == "dev" ]; then
     uvicorn main:app --host 0.0.0.0 --port 5001 --reload
 # Modo producción (con workers)
+# Los streams reanudables (stream_resume.py) viven en la memoria de cada worker: detrás de un
+# balanceador, GET /api/chat/stream/{id} necesita sticky sessions para volver al mismo worker
+# (sin ellas la reconexión recibe 404 y el cliente recarga la respuesta desde /api/history/since)
 else
     uvicorn main:app \
         --host 0.0.0.0 \
@@ -0,0 +1,226 @@
+"""
+Cache acotado de estado por sesión para el Chatbot IMSS
+LRU + TTL + techo de memoria, compartido por MemoryManager (memorias de sesión)
+y MedicalChain (cola del historial de chat).
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("CHATBOT_SESSION_CACHE_MAX_ENTRIES", "2000"))
+SESSION_CACHE_TTL = int(os.getenv("CHATBOT_SESSION_CACHE_TTL", "1800"))  # segundos sin acceso
+SESSION_CACHE_MAX_BYTES = int(os.getenv("CHATBOT_SESSION_CACHE_MAX_MB", "64")) * 1024 * 1024
+# Mensajes del historial que se cargan por sesión (solo se usan los últimos)
+HISTORY_TAIL = int(os.getenv("CHATBOT_HISTORY_TAIL", "20"))
+
+# Entrada de historial en cache: (message_uid, role, content)
+HistoryEntry = Tuple[Optional[str], str, str]
+
+_MESSAGE_OVERHEAD = 120  # bytes aproximados por mensaje además del contenido
+
+
+def estimate_size(value: Any) -> int:
+    """Tamaño aproximado en bytes de un valor cacheado (listas de mensajes o memorias)"""
+    messages = getattr(value, "messages", value)
+    if not isinstance(messages, (list, tuple)):
+        return _MESSAGE_OVERHEAD
+    size = _MESSAGE_OVERHEAD
+    for msg in messages:
+        if isinstance(msg, dict):
+            size += len(msg.get("content") or "") + _MESSAGE_OVERHEAD
+        elif isinstance(msg, (list, tuple)):
+            size += sum(len(part) for part in msg if isinstance(part, str)) + _MESSAGE_OVERHEAD
+        else:
+            size += _MESSAGE_OVERHEAD
+    return size
+
+
+class SessionStateCache:
+    """Cache LRU con expiración por inactividad y límite de memoria aproximado
+
+    - get/put/get_or_load para lecturas; update() para escritura write-through
+      (solo modifica entradas ya cacheadas; si no están, la próxima carga lee SQLite)
+    - Contadores de hits, misses y evictions expuestos en stats()
+    - Thread-safe: se usa desde el event loop y desde los hilos del pool SQLite
+    """
+
+    def __init__(
+        self,
+        max_entries: int = SESSION_CACHE_MAX_ENTRIES,
+        ttl_seconds: int = SESSION_CACHE_TTL,
+        max_bytes: int = SESSION_CACHE_MAX_BYTES,
+        sizeof: Callable[[Any], int] = estimate_size,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data: "OrderedDict[Hashable, List[Any]]" = OrderedDict()  # key -> [value, size, last_access]
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Obtener un valor (None si no está o expiró)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            now = time.monotonic()
+            if self.ttl and now - entry[2] > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            entry[2] = now
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        """Insertar o reemplazar un valor y aplicar los límites"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            size = self.sizeof(value)
+            self._data[key] = [value, size, time.monotonic()]
+            self._bytes += size
+            self._enforce_limits()
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Obtener del cache o cargar (fuera del lock) y cachear"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = loader()
+        with self._lock:
+            # Otro hilo pudo cargarlo mientras tanto: conservar el existente (puede tener escrituras nuevas)
+            entry = self._data.get(key)
+            if entry is not None:
+                return entry[0]
+            self.put(key, value)
+        return value
+
+    def update(self, key: Hashable, fn: Callable[[Any], None]) -> bool:
+        """Aplicar una modificación in-place a una entrada cacheada (write-through)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False
+            fn(entry[0])
+            new_size = self.sizeof(entry[0])
+            self._bytes += new_size - entry[1]
+            entry[1] = new_size
+            self._enforce_limits()
+            return True
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]):
+        """Eliminar todas las entradas cuya clave cumpla el predicado"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._remove(key)
+
+    def _remove(self, key: Hashable):
+        entry = self._data.pop(key)
+        self._bytes -= entry[1]
+
+    def _enforce_limits(self):
+        # Expirar primero las entradas inactivas más antiguas (orden LRU)
+        if self.ttl:
+            now = time.monotonic()
+            while self._data:
+                key, entry = next(iter(self._data.items()))
+                if now - entry[2] <= self.ttl:
+                    break
+                self._remove(key)
+                self.expirations += 1
+        # Luego desalojar por número de entradas y por memoria (siempre conservar la más reciente)
+        while len(self._data) > 1 and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class CachedHistory:
+    """Cola del historial de una sesión y la conversations.version con la que se leyó
+
+    Con varios workers otro proceso puede escribir en la sesión: una entrada solo vale mientras
+    la versión en SQLite siga siendo la misma (version None: obsoleta, se recarga).
+    """
+
+    __slots__ = ("messages", "version")
+
+    def __init__(self, messages: List[HistoryEntry], version: Optional[int]):
+        self.messages = messages
+        self.version = version
+
+
+def append_history_entry(entries: List[HistoryEntry], entry: HistoryEntry, tail: int = HISTORY_TAIL):
+    """Agregar un mensaje a la cola cacheada del historial (ignora ids ya presentes)"""
+    uid = entry[0]
+    if uid is not None and any(e[0] == uid for e in entries):
+        return
+    entries.append(entry)
+    if len(entries) > tail:
+        del entries[:-tail]
+
+
+def history_cache_key(session_id: str) -> Tuple[str, str]:
+    return ("history", session_id)
+
+
+def memory_cache_key(session_id: str, agent_id: str) -> Tuple[str, str, str]:
+    return ("memory", session_id, agent_id)
+
+
+# Instancia global compartida
+_session_cache: Optional[SessionStateCache] = None
+_session_cache_lock = threading.Lock()
+
+
+def get_session_cache() -> SessionStateCache:
+    """Obtener el cache de estado de sesión compartido"""
+    global _session_cache
+    if _session_cache is None:
+        with _session_cache_lock:
+            if _session_cache is None:
+                _session_cache = SessionStateCache()
+                logger.info(
+                    f"✅ Cache de sesión inicializado ({SESSION_CACHE_MAX_ENTRIES} entradas, "
+                    f"TTL {SESSION_CACHE_TTL}s, {SESSION_CACHE_MAX_BYTES // (1024 * 1024)}MB)"
+                )
+    return _session_cache
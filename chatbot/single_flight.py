@@ -0,0 +1,137 @@
+"""
+Single-flight para streams del LLM en el Chatbot IMSS
+Peticiones idénticas en curso (recarga de página, doble clic) comparten una sola generación:
+el primer llamador arranca el stream upstream y los siguientes se suscriben a su buffer
+(reciben lo ya generado y luego siguen en vivo).
+
+La cancelación se cuenta por referencias: el stream upstream solo se aborta cuando se va
+el último suscriptor.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_ENABLED = os.getenv("CHATBOT_SINGLE_FLIGHT", "1") not in ("0", "false", "no")
+
+# Fábrica del stream upstream: recibe el diccionario de usage que debe rellenar
+StreamFactory = Callable[[Dict[str, Any]], AsyncGenerator[str, None]]
+
+
+def request_key(endpoint: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+    """Hash canónico de una petición (endpoint, mensajes y parámetros de muestreo)"""
+    payload = json.dumps(
+        [endpoint, [(m.get("role"), m.get("content")) for m in messages], sorted(params.items())],
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """Una generación upstream en curso y su buffer de chunks"""
+
+    __slots__ = ("chunks", "usage", "done", "error", "subscribers", "task", "_changed")
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.usage: Dict[str, Any] = {}
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        # Un evento por cambio: quien espera el anterior despierta, los nuevos esperan el siguiente
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class SingleFlight:
+    """Coalescencia de streams idénticos en curso (un solo event loop)"""
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self._flights: Dict[str, _Flight] = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "upstream_cancelled": 0}
+
+    async def stream(self, key: str, factory: StreamFactory, usage: Optional[Dict[str, Any]] = None) -> AsyncGenerator[str, None]:
+        """Suscribirse al stream de `key` (arrancándolo con `factory` si no hay uno en curso)"""
+        if not self.enabled:
+            async for delta in factory(usage if usage is not None else {}):
+                yield delta
+            return
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._drive(key, flight, factory))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["coalesced"] += 1
+            logger.info(f"🔗 Petición idéntica en curso: suscrito al stream existente ({flight.subscribers} suscriptores)")
+        flight.subscribers += 1
+        try:
+            sent = 0
+            while True:
+                while sent < len(flight.chunks):
+                    yield flight.chunks[sent]
+                    sent += 1
+                if flight.done:
+                    break
+                await flight.wait()
+            if flight.error is not None:
+                raise flight.error
+            if usage is not None:
+                usage.update(flight.usage)
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Se fue el último suscriptor: abortar el stream upstream
+                self.stats["upstream_cancelled"] += 1
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    async def _drive(self, key: str, flight: _Flight, factory: StreamFactory):
+        """Consumir el stream upstream hacia el buffer compartido"""
+        try:
+            async for delta in factory(flight.usage):
+                flight.chunks.append(delta)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            # Las peticiones idénticas que lleguen después arrancan una generación nueva
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.notify()
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+
+# Instancia global
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    """Obtener el coordinador single-flight del proceso"""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
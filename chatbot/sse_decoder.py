@@ -0,0 +1,276 @@
+"""
+Decodificador SSE incremental sobre bytes para los streams OpenAI-compatibles de vLLM
+Sustituye aiter_lines() + json.loads por línea: las líneas se cortan sobre los bytes recibidos
+(sin decodificar el stream completo a str) y de cada evento solo se extraen delta.content y
+finish_reason, sin construir el objeto JSON.
+
+- Eventos de varias líneas `data:` (se unen con "\\n"), comentarios keep-alive (`: ping`),
+  campos event/id/retry (ignorados) y `[DONE]`
+- Camino rápido: localiza "content": y "finish_reason": en los bytes; el texto sin escapes se
+  decodifica directamente y con escapes usa el scanstring en C de json
+- Camino completo (json.loads) para el chunk de usage, eventos de error y cualquier forma inesperada
+
+Benchmark con streams grabados (p. ej. `curl -N ... > stream.sse`):
+    python sse_decoder.py --benchmark stream.sse [más.sse ...]
+Sin archivos se usa un stream sintético con el formato de vLLM.
+"""
+
+import argparse
+import codecs
+import json
+import random
+import time
+from json.decoder import scanstring
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+DONE = b"[DONE]"
+
+_CHOICES_KEY = b'"choices":'
+_CONTENT_KEY = b'"content":'
+_FINISH_KEY = b'"finish_reason":'
+_USAGE_KEY = b'"usage":'
+
+
+class StreamDelta(NamedTuple):
+    content: Optional[str] = None
+    finish_reason: Optional[str] = None
+    usage: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+
+class SSEDecoder:
+    """Corta el stream en eventos; feed() devuelve el payload `data` de cada evento completo
+
+    Las líneas terminan en "\\n" o "\\r\\n". Un evento termina con una línea vacía; solo se copia
+    una vez cada payload (el resto de la lectura no se duplica salvo una línea partida entre lecturas).
+    """
+
+    __slots__ = ("_tail", "_data")
+
+    def __init__(self):
+        self._tail = b""
+        self._data: Optional[bytes] = None
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        if self._tail:
+            chunk = self._tail + chunk
+            self._tail = b""
+        events: List[bytes] = []
+        start = 0
+        find = chunk.find
+        while True:
+            nl = find(b"\n", start)
+            if nl < 0:
+                break
+            end = nl - 1 if nl > start and chunk[nl - 1] == 13 else nl
+            if end == start:
+                # Línea vacía: fin del evento
+                if self._data is not None:
+                    events.append(self._data)
+                    self._data = None
+            elif chunk.startswith(b"data:", start):
+                value_start = start + 5
+                if value_start < end and chunk[value_start] == 32:
+                    value_start += 1
+                value = chunk[value_start:end]
+                self._data = value if self._data is None else self._data + b"\n" + value
+            # Comentarios (":") y otros campos no se usan
+            start = nl + 1
+        if start < len(chunk):
+            self._tail = chunk[start:]
+        return events
+
+    def close(self) -> List[bytes]:
+        """Evento pendiente al cerrarse el stream sin línea vacía final (lo toleramos, como aiter_lines)"""
+        events = self.feed(b"\n\n") if self._tail else []
+        if self._data is not None:
+            events.append(self._data)
+            self._data = None
+        return events
+
+
+def _value_at(data: bytes, pos: int) -> int:
+    """Posición del valor tras "clave": (tolera espacios, que vLLM no emite)"""
+    while pos < len(data) and data[pos] == 32:
+        pos += 1
+    return pos
+
+
+def _string_at(data: bytes, pos: int) -> Optional[str]:
+    """Cadena JSON que empieza en data[pos] (None si es null u otra cosa)"""
+    if pos >= len(data) or data[pos] != 34:
+        return None
+    close = data.find(b'"', pos + 1)
+    if close < 0:
+        raise ValueError("cadena JSON sin cerrar")
+    if data.find(b"\\", pos + 1, close) < 0:
+        return data[pos + 1:close].decode("utf-8")
+    # Con escapes (\n, \", \uXXXX): el scanner de json, desde la comilla
+    return scanstring(data[pos:].decode("utf-8"), 1)[0]
+
+
+def parse_full(data: bytes) -> StreamDelta:
+    """Camino completo: json.loads del evento"""
+    obj = json.loads(data)
+    error = obj.get("error")
+    if error:
+        return StreamDelta(error=error.get("message", str(error)) if isinstance(error, dict) else str(error))
+    content = finish_reason = None
+    choices = obj.get("choices") or []
+    if choices:
+        content = (choices[0].get("delta") or {}).get("content")
+        finish_reason = choices[0].get("finish_reason")
+    return StreamDelta(content, finish_reason, obj.get("usage") or None)
+
+
+def parse_delta(data: bytes) -> StreamDelta:
+    """delta.content y finish_reason del primer choice, sin materializar el JSON si no hace falta
+
+    Una clave como "content": no puede aparecer dentro de un valor de cadena (sus comillas irían
+    escapadas), así que buscarla en los bytes encuentra siempre la clave real.
+    """
+    choices = data.find(_CHOICES_KEY)
+    usage = data.find(_USAGE_KEY)
+    if choices < 0 or (usage >= 0 and not data.startswith(b"null", _value_at(data, usage + 8))):
+        # Sin choices (error) o con usage: pocos eventos por stream, se parsean enteros
+        return parse_full(data)
+    content = finish_reason = None
+    pos = data.find(_CONTENT_KEY, choices)
+    if pos >= 0:
+        pos += 10
+        content = _string_at(data, pos if data[pos] == 34 else _value_at(data, pos))
+    pos = data.find(_FINISH_KEY, choices if pos < 0 else pos)
+    if pos >= 0:
+        pos += 16
+        if data[pos] != 110:  # null (lo habitual hasta el último chunk)
+            finish_reason = _string_at(data, _value_at(data, pos))
+    return StreamDelta(content, finish_reason)
+
+
+# --- Benchmark ---
+
+BENCHMARK_ROUNDS = 5
+SAMPLE_TEXT = (
+    "Con base en los hallazgos descritos, la radiografía de tórax muestra una opacidad en el "
+    "lóbulo inferior derecho compatible con un proceso neumónico.\n\n**Recomendaciones:**\n"
+    "1. Correlacionar con la biometría hemática y la \"proteína C reactiva\".\n"
+    "2. Valorar tratamiento antibiótico empírico según la guía del IMSS.\n"
+    "3. Control radiográfico en 4–6 semanas. ¿Hay antecedentes de tabaquismo? 🫁\n"
+)
+
+
+def synthetic_stream(repeat: int = 20, seed: int = 7) -> bytes:
+    """Stream con la serialización de vLLM (JSON compacto, chunk de rol, finish y usage)"""
+    rng = random.Random(seed)
+    text = SAMPLE_TEXT * repeat
+    head = {"id": "chatcmpl-0b1c2d3e4f", "object": "chat.completion.chunk", "created": 1760000000, "model": "google/medgemma-27b"}
+
+    def event(choices, usage=None) -> bytes:
+        payload = dict(head, choices=choices)
+        if usage is not None:
+            payload["usage"] = usage
+        return b"data: " + json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+    out = [event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "logprobs": None, "finish_reason": None}])]
+    pos = tokens = 0
+    while pos < len(text):
+        step = rng.randint(1, 6)
+        out.append(event([{"index": 0, "delta": {"content": text[pos:pos + step]}, "logprobs": None, "finish_reason": None}]))
+        pos += step
+        tokens += 1
+    out.append(event([{"index": 0, "delta": {"content": ""}, "logprobs": None, "finish_reason": "stop", "stop_reason": None}]))
+    out.append(event([], {"prompt_tokens": 812, "total_tokens": 812 + tokens, "completion_tokens": tokens}))
+    out.append(b"data: [DONE]\n\n")
+    return b"".join(out)
+
+
+def split_reads(raw: bytes, seed: int = 11) -> List[bytes]:
+    """Trocear como lecturas de red (límites arbitrarios, incluso a mitad de un carácter UTF-8)"""
+    rng = random.Random(seed)
+    reads, pos = [], 0
+    while pos < len(raw):
+        size = rng.choice((64, 180, 400, 1500))
+        reads.append(raw[pos:pos + size])
+        pos += size
+    return reads
+
+
+def _baseline(reads: Iterable[bytes]) -> List[Optional[str]]:
+    """Camino anterior: decodificar a str, cortar líneas (como aiter_lines) y json.loads por línea"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    contents: List[Optional[str]] = []
+    buffer = ""
+    for read in reads:
+        buffer += decoder.decode(read)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            if line.startswith("data: ") and line.strip() != "data: [DONE]":
+                data = json.loads(line[6:])
+                if "choices" in data and len(data["choices"]) > 0:
+                    contents.append(data["choices"][0].get("delta", {}).get("content", ""))
+    return contents
+
+
+def _decoded(reads: Iterable[bytes]) -> List[Optional[str]]:
+    decoder = SSEDecoder()
+    contents: List[Optional[str]] = []
+    for read in reads:
+        for event in decoder.feed(read):
+            if event == DONE:
+                continue
+            delta = parse_delta(event)
+            if delta.usage is None:
+                contents.append(delta.content)
+    return contents
+
+
+def run_benchmark(streams: List[bytes], repeat: int) -> Dict[str, Any]:
+    reads_per_stream = [split_reads(raw) for raw in streams]
+    events = sum(raw.count(b"\n\ndata:") + 1 for raw in streams)
+    baseline = [_baseline(reads) for reads in reads_per_stream]
+    decoded = [_decoded(reads) for reads in reads_per_stream]
+    if [[c or "" for c in s] for s in baseline] != [[c or "" for c in s] for s in decoded]:
+        raise AssertionError("El decodificador no reproduce el contenido del camino anterior")
+
+    results: Dict[str, Any] = {"streams": len(streams), "events": events, "repeat": repeat}
+    best = {name: float("inf") for name in ("aiter_lines+json.loads", "SSEDecoder+parse_delta")}
+    # Rondas alternadas y el mejor tiempo de cada camino: menos sensible al ruido de la máquina
+    for _ in range(BENCHMARK_ROUNDS):
+        for name, fn in (("aiter_lines+json.loads", _baseline), ("SSEDecoder+parse_delta", _decoded)):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                for reads in reads_per_stream:
+                    fn(reads)
+            best[name] = min(best[name], time.perf_counter() - started)
+    for name, elapsed in best.items():
+        results[name] = round(elapsed / (repeat * events) * 1e6, 3)  # µs por evento
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del decodificador SSE de streams de vLLM")
+    parser.add_argument("--benchmark", action="store_true", help="Comparar con aiter_lines + json.loads")
+    parser.add_argument("files", nargs="*", help="Streams grabados (cuerpo SSE crudo de /v1/chat/completions)")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        return
+    streams = []
+    for path in args.files:
+        with open(path, "rb") as f:
+            streams.append(f.read())
+    if not streams:
+        print("ℹ️ Sin streams grabados: usando un stream sintético con el formato de vLLM")
+        streams = [synthetic_stream()]
+    results = run_benchmark(streams, args.repeat)
+    print(f"📊 {results['streams']} stream(s), {results['events']} eventos, {results['repeat']} repeticiones")
+    for name in ("aiter_lines+json.loads", "SSEDecoder+parse_delta"):
+        print(f"   {name:<24} {results[name]:>8.3f} µs/evento")
+    speedup = results["aiter_lines+json.loads"] / results["SSEDecoder+parse_delta"]
+    print(f"   Aceleración: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Tramas SSE agrupadas para el stream de chat
+vLLM entrega un delta por token (30-60 por segundo y stream); enviar cada uno como su propio
+evento `data:` cuesta un html.escape, un json.dumps y una escritura al socket por token. El
+agrupador junta los deltas que llegan dentro de una ventana corta y los envía en una sola trama.
+
+- CHATBOT_SSE_FLUSH_MS: ventana de agrupado (25 ms; 0 = una trama por delta, como antes)
+- CHATBOT_SSE_FLUSH_CHARS: tamaño que fuerza el envío aunque la ventana no haya vencido
+- Adaptativo: el primer delta, y el primero tras una pausa más larga que la ventana, se envían
+  al momento; solo se agrupa cuando los deltas llegan más rápido que la ventana, así que la
+  latencia añadida es como mucho una ventana y el primer token no espera nunca
+"""
+
+import json
+import os
+import threading
+import time
+from json.encoder import encode_basestring
+from typing import Any, Dict, List, Optional
+
+SSE_FLUSH_MS = int(os.getenv("CHATBOT_SSE_FLUSH_MS", "25"))
+SSE_FLUSH_CHARS = int(os.getenv("CHATBOT_SSE_FLUSH_CHARS", "4096"))
+
+# Prefijo y sufijo fijos de la trama de contenido: mismo texto que
+# json.dumps({'content': ..., 'done': False}, ensure_ascii=False)
+_CONTENT_PREFIX = 'data: {"content": '
+_CONTENT_SUFFIX = ', "done": false}\n\n'
+
+
+def encode_content(text: str) -> str:
+    """Trama `data: {"content": ..., "done": false}` sin pasar por json.dumps (solo escapa la cadena)"""
+    return _CONTENT_PREFIX + encode_basestring(text) + _CONTENT_SUFFIX
+
+
+def encode_event(payload: Dict[str, Any]) -> str:
+    """Trama SSE de un evento arbitrario (done, error, cancelación)"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class ChunkBatcher:
+    """Agrupa los deltas de un stream por ventana de tiempo o tamaño (un batcher por stream)
+
+    add() devuelve True si hay que enviar ya; si no, el llamador espera al siguiente delta como
+    mucho hasta `deadline` y entonces envía lo acumulado con flush().
+    """
+
+    __slots__ = ("window", "max_chars", "_parts", "_chars", "_last_flush", "deadline", "chunks", "frames")
+
+    def __init__(self, window_ms: int = SSE_FLUSH_MS, max_chars: int = SSE_FLUSH_CHARS):
+        self.window = max(0, window_ms) / 1000
+        self.max_chars = max(1, max_chars)
+        self._parts: List[str] = []
+        self._chars = 0
+        self._last_flush: Optional[float] = None
+        self.deadline: Optional[float] = None  # time.monotonic() en que vence la ventana abierta
+        self.chunks = 0
+        self.frames = 0
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._parts)
+
+    def add(self, text: str) -> bool:
+        self._parts.append(text)
+        self._chars += len(text)
+        self.chunks += 1
+        if self.deadline is None:
+            now = time.monotonic()
+            # Primer delta o stream lento: agrupar solo añadiría latencia
+            if self._last_flush is None or now - self._last_flush >= self.window:
+                return True
+            self.deadline = self._last_flush + self.window
+        return self._chars >= self.max_chars
+
+    def due(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def flush(self) -> str:
+        text = self._parts[0] if len(self._parts) == 1 else "".join(self._parts)
+        self._parts.clear()
+        self._chars = 0
+        self._last_flush = time.monotonic()
+        self.deadline = None
+        self.frames += 1
+        return text
+
+    def close(self):
+        """Sumar los contadores del stream a las estadísticas globales"""
+        with _stats_lock:
+            _stats["streams"] += 1
+            _stats["chunks"] += self.chunks
+            _stats["frames"] += self.frames
+
+
+_stats = {"streams": 0, "chunks": 0, "frames": 0}
+_stats_lock = threading.Lock()
+
+
+def framing_stats() -> Dict[str, Any]:
+    """Deltas recibidos frente a tramas enviadas (chunks_per_frame > 1: el agrupado ahorra escrituras)"""
+    with _stats_lock:
+        stats: Dict[str, Any] = dict(_stats)
+    stats["window_ms"] = SSE_FLUSH_MS
+    stats["chunks_per_frame"] = round(stats["chunks"] / stats["frames"], 2) if stats["frames"] else None
+    return stats
@@ -0,0 +1,332 @@
+"""
+Streams de chat reanudables con Last-Event-ID
+La generación de un stream de chat ya no depende de la conexión HTTP que la pidió: corre en una
+tarea propia que escribe las tramas SSE en un buffer por stream, y las respuestas HTTP solo leen
+de ese buffer. Si la conexión de un móvil se corta a mitad de respuesta, el cliente se reconecta
+a /api/chat/stream/{stream_id} con `Last-Event-ID` y recibe las tramas perdidas y después el
+resto en vivo, sin volver a generar en la GPU.
+
+- Cada trama lleva `id: <n>` (secuencial por stream); el id del stream es el request_id
+- CHATBOT_RESUME_GRACE: segundos que la generación sigue sin ningún cliente conectado (30);
+  pasado ese tiempo se aborta como antes (cancelación en vLLM y respuesta parcial guardada)
+- CHATBOT_RESUME_TTL: segundos que se conserva un stream terminado para reanudarlo (120)
+- CHATBOT_RESUME_MEMORY_KB: tramas recientes en memoria por stream (256 KB); las anteriores
+  pasan a un archivo temporal (CHATBOT_RESUME_SPILL_DIR) que se borra al expirar el stream
+- El registro es por worker: con varios workers la reconexión necesita sticky sessions
+"""
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RESUME_GRACE = float(os.getenv("CHATBOT_RESUME_GRACE", "30"))
+RESUME_TTL = float(os.getenv("CHATBOT_RESUME_TTL", "120"))
+RESUME_MEMORY_BYTES = int(os.getenv("CHATBOT_RESUME_MEMORY_KB", "256")) * 1024
+RESUME_SPILL_DIR = os.getenv("CHATBOT_RESUME_SPILL_DIR", os.path.join(tempfile.gettempdir(), "chatbot-streams"))
+# Cada cuánto comprueba un lector si su cliente sigue conectado mientras espera tramas
+RESUME_POLL_SECONDS = int(os.getenv("CHATBOT_DISCONNECT_POLL_MS", "100")) / 1000
+
+
+class ResumableStream:
+    """Tramas SSE de una generación: las recientes en memoria, las antiguas en disco"""
+
+    __slots__ = (
+        "stream_id", "user_id", "session_id", "abort", "task", "done", "expires_at", "followers",
+        "_memory_limit", "_frames", "_first_in_memory", "_memory_bytes", "_spill", "_spill_offsets",
+        "_spill_dir", "_changed", "detach_timer", "_closed",
+    )
+
+    def __init__(
+        self,
+        stream_id: str,
+        user_id: str,
+        session_id: str,
+        abort: Optional[Callable[[], None]] = None,
+        memory_limit: int = RESUME_MEMORY_BYTES,
+        spill_dir: str = RESUME_SPILL_DIR,
+    ):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.session_id = session_id
+        self.abort = abort  # Aborta la generación (se llama si nadie se reconecta a tiempo)
+        self.task: Optional[asyncio.Task] = None
+        self.done = False
+        self.expires_at: Optional[float] = None
+        self.followers = 0
+        self._memory_limit = max(0, memory_limit)
+        self._frames: deque = deque()  # tramas con id _first_in_memory .. last_id
+        self._first_in_memory = 1
+        self._memory_bytes = 0
+        self._spill = None  # archivo temporal (sin nombre en disco) con las tramas 1 .. _first_in_memory-1
+        self._spill_offsets: List[int] = [0]  # inicio de cada trama en el archivo y final
+        self._spill_dir = spill_dir
+        self._changed = asyncio.Event()
+        self.detach_timer: Optional[asyncio.TimerHandle] = None  # aborto pendiente sin lectores
+        self._closed = False
+
+    @property
+    def last_id(self) -> int:
+        return self._first_in_memory + len(self._frames) - 1
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    @property
+    def spill_bytes(self) -> int:
+        return self._spill_offsets[-1]
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def changed(self) -> asyncio.Event:
+        """Evento del próximo cambio (capturarlo antes de esperar para no perder un notify)"""
+        return self._changed
+
+    def append(self, frame: str) -> int:
+        """Añadir una trama (texto SSE sin la línea id) y despertar a los lectores; devuelve su id"""
+        if self._closed:
+            return self.last_id
+        self._frames.append(frame)
+        self._memory_bytes += len(frame)
+        if self._memory_bytes > self._memory_limit:
+            self._spill_oldest()
+        self._notify()
+        return self.last_id
+
+    def _spill_oldest(self):
+        """Pasar a disco las tramas antiguas hasta dejar la memoria bajo el límite (la última se queda)"""
+        if self._spill is None:
+            os.makedirs(self._spill_dir, exist_ok=True)
+            # TemporaryFile no deja nombre en disco: nada que limpiar si el proceso muere
+            self._spill = tempfile.TemporaryFile(dir=self._spill_dir, prefix="stream-")
+            logger.debug(f"💾 Stream {self.stream_id}: tramas antiguas a disco ({self._memory_bytes} bytes en memoria)")
+        parts = []
+        end = self._spill_offsets[-1]
+        while self._memory_bytes > self._memory_limit and len(self._frames) > 1:
+            frame = self._frames.popleft()
+            self._memory_bytes -= len(frame)
+            data = frame.encode("utf-8")
+            parts.append(data)
+            end += len(data)
+            self._spill_offsets.append(end)
+            self._first_in_memory += 1
+        self._spill.seek(self._spill_offsets[-len(parts) - 1])
+        self._spill.write(b"".join(parts))
+
+    def frames_after(self, last_id: int) -> List[Tuple[int, str]]:
+        """Tramas con id > last_id, de disco y de memoria, en orden"""
+        frames: List[Tuple[int, str]] = []
+        next_id = max(0, last_id) + 1
+        if next_id < self._first_in_memory and self._spill is not None:
+            start = self._spill_offsets[next_id - 1]
+            self._spill.seek(start)
+            data = self._spill.read(self._spill_offsets[-1] - start)
+            for frame_id in range(next_id, self._first_in_memory):
+                begin = self._spill_offsets[frame_id - 1] - start
+                end = self._spill_offsets[frame_id] - start
+                frames.append((frame_id, data[begin:end].decode("utf-8")))
+            next_id = self._first_in_memory
+        skip = next_id - self._first_in_memory
+        for offset, frame in enumerate(self._frames):
+            if offset >= skip:
+                frames.append((self._first_in_memory + offset, frame))
+        return frames
+
+    def finish(self, ttl: float):
+        self.done = True
+        self.expires_at = time.monotonic() + ttl
+        self.cancel_detach_timer()
+        self._notify()
+
+    def _notify(self):
+        # Un evento por cambio: quien espera el anterior despierta, los nuevos esperan el siguiente
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def cancel_detach_timer(self):
+        if self.detach_timer is not None:
+            self.detach_timer.cancel()
+            self.detach_timer = None
+
+    def close(self):
+        """Liberar memoria y archivo temporal (el stream ya no se puede reanudar)"""
+        self._closed = True
+        self.cancel_detach_timer()
+        self._frames.clear()
+        self._memory_bytes = 0
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._notify()
+
+
+class StreamRegistry:
+    """Streams en curso y terminados recientemente (un registro por worker, en el event loop)"""
+
+    def __init__(
+        self,
+        grace: float = RESUME_GRACE,
+        ttl: float = RESUME_TTL,
+        memory_limit: int = RESUME_MEMORY_BYTES,
+        spill_dir: str = RESUME_SPILL_DIR,
+    ):
+        self.grace = max(0.0, grace)
+        self.ttl = max(0.0, ttl)
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self._streams: Dict[str, ResumableStream] = {}
+        self.counters = {"started": 0, "resumed": 0, "replayed_frames": 0, "abandoned": 0, "expired": 0}
+
+    def create(self, stream_id: str, user_id: str, session_id: str, abort: Optional[Callable[[], None]] = None) -> Optional[ResumableStream]:
+        """Registrar un stream nuevo (None si ya hay uno vivo con ese id)"""
+        self._prune()
+        if stream_id in self._streams:
+            return None
+        stream = ResumableStream(stream_id, user_id, session_id, abort, self.memory_limit, self.spill_dir)
+        self._streams[stream_id] = stream
+        self.counters["started"] += 1
+        return stream
+
+    def get(self, stream_id: str) -> Optional[ResumableStream]:
+        self._prune()
+        return self._streams.get(stream_id)
+
+    def start(self, stream: ResumableStream, frames: AsyncGenerator[str, None]):
+        """Generar en una tarea propia: la generación sigue aunque se caiga la conexión del cliente"""
+        stream.task = asyncio.create_task(self._drive(stream, frames))
+
+    async def _drive(self, stream: ResumableStream, frames: AsyncGenerator[str, None]):
+        try:
+            async for frame in frames:
+                stream.append(frame)
+        except asyncio.CancelledError:
+            logger.info(f"🛑 Stream {stream.stream_id} cancelado")
+        except Exception as e:
+            # process_text_stream ya convierte sus errores en tramas; esto solo cubre fallos inesperados
+            logger.error(f"❌ Error generando el stream {stream.stream_id}: {e}", exc_info=True)
+        finally:
+            await frames.aclose()
+            stream.finish(self.ttl)
+
+    async def follow(
+        self,
+        stream: ResumableStream,
+        last_event_id: int = 0,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> AsyncGenerator[str, None]:
+        """Tramas con id > last_event_id (`id: n` + trama) y después las nuevas hasta el final del stream
+
+        Al desconectarse el cliente solo se suelta el lector; si no queda ninguno, la generación
+        sigue `grace` segundos esperando una reconexión antes de abortarse.
+        """
+        self._attach(stream)
+        if last_event_id > 0:
+            self.counters["resumed"] += 1
+            logger.info(f"🔁 Stream {stream.stream_id} reanudado desde la trama {last_event_id} (última: {stream.last_id})")
+        sent = last_event_id
+        replaying = last_event_id > 0
+        next_check = time.monotonic() + RESUME_POLL_SECONDS
+        try:
+            while True:
+                frames = stream.frames_after(sent)
+                if replaying:
+                    self.counters["replayed_frames"] += len(frames)
+                    replaying = False
+                for frame_id, frame in frames:
+                    yield f"id: {frame_id}\n{frame}"
+                    sent = frame_id
+                if stream.closed:
+                    # close() borró las tramas (también las de disco): ya no queda nada que enviar
+                    return
+                if stream.done:
+                    if sent >= stream.last_id:
+                        return
+                    continue
+                changed = stream.changed
+                try:
+                    await asyncio.wait_for(changed.wait(), RESUME_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                if is_disconnected is None or time.monotonic() < next_check:
+                    continue
+                next_check = time.monotonic() + RESUME_POLL_SECONDS
+                if await is_disconnected():
+                    logger.info(f"📴 Cliente desconectado del stream {stream.stream_id} en la trama {sent}; la generación sigue")
+                    return
+        finally:
+            self._detach(stream)
+
+    def _attach(self, stream: ResumableStream):
+        stream.followers += 1
+        stream.cancel_detach_timer()
+
+    def _detach(self, stream: ResumableStream):
+        stream.followers -= 1
+        if stream.followers == 0 and not stream.done:
+            stream.detach_timer = asyncio.get_running_loop().call_later(self.grace, self._abandon, stream)
+
+    def _abandon(self, stream: ResumableStream):
+        """Nadie se reconectó durante la gracia: abortar la generación"""
+        stream.detach_timer = None
+        if stream.followers or stream.done:
+            return
+        self.counters["abandoned"] += 1
+        logger.info(f"🛑 Stream {stream.stream_id} sin clientes durante {self.grace:.0f}s: generación abortada")
+        if stream.abort is not None:
+            stream.abort()
+        elif stream.task is not None:
+            stream.task.cancel()
+
+    def _prune(self):
+        """Borrar los streams terminados cuyo TTL venció"""
+        now = time.monotonic()
+        expired = [
+            stream_id for stream_id, stream in self._streams.items()
+            if stream.done and not stream.followers and stream.expires_at <= now
+        ]
+        for stream_id in expired:
+            self._streams.pop(stream_id).close()
+        self.counters["expired"] += len(expired)
+
+    def close_all(self):
+        """Cancelar las generaciones en curso y borrar los buffers (apagado del servidor)"""
+        for stream in self._streams.values():
+            if stream.task is not None and not stream.task.done():
+                stream.task.cancel()
+            stream.close()
+        self._streams.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune()
+        streams = list(self._streams.values())
+        return {
+            "live": sum(1 for s in streams if not s.done),
+            "detached": sum(1 for s in streams if not s.done and not s.followers),
+            "retained": sum(1 for s in streams if s.done),
+            "memory_kb": round(sum(s.memory_bytes for s in streams) / 1024, 1),
+            "spill_kb": round(sum(s.spill_bytes for s in streams) / 1024, 1),
+            "grace_s": self.grace,
+            "ttl_s": self.ttl,
+            **self.counters,
+        }
+
+
+# Instancia global
+_registry: Optional[StreamRegistry] = None
+
+
+def get_stream_registry() -> StreamRegistry:
+    """Obtener el registro de streams reanudables del worker"""
+    global _registry
+    if _registry is None:
+        _registry = StreamRegistry()
+    return _registry
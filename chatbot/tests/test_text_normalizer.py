@@ -0,0 +1,74 @@
+import os
+import random
+import sqlite3
+import unittest
+
+import text_normalizer
+from text_normalizer import StreamNormalizer, normalize_text, reference_stream_final
+
+# Mensajes grabados (tabla messages); sin la base solo se verifican los casos límite
+CORPUS_DB = os.getenv("CHATBOT_NORMALIZER_CORPUS", os.path.join(os.path.dirname(__file__), "..", "chatbot.db"))
+
+
+def _has_messages(db_path: str) -> bool:
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT 1 FROM messages WHERE content != '' LIMIT 1").fetchone() is not None
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+
+def _stream(deltas, block=text_normalizer.STREAM_BLOCK_CHARS):
+    normalizer = StreamNormalizer(fix_passes=2, block=block)
+    for delta in deltas:
+        normalizer.feed(delta)
+    return normalizer.finish()
+
+
+class TestTextNormalizer(unittest.TestCase):
+
+    def test_edge_cases_match_reference(self):
+        result = text_normalizer.verify(text_normalizer.EDGE_CASES)
+        self.assertEqual(result["texts"], len(text_normalizer.EDGE_CASES))
+
+    @unittest.skipUnless(_has_messages(CORPUS_DB), f"sin mensajes grabados en {CORPUS_DB}")
+    def test_recorded_corpus_matches_reference(self):
+        texts = text_normalizer.load_corpus(CORPUS_DB, [])
+        text_normalizer.verify(texts)
+        # Variantes con fragmentos ("ola", "¿ué", "do rte"), signos y espacios insertados
+        rng = random.Random(11)
+        text_normalizer.verify([text_normalizer._mutate(rng.choice(texts), rng) for _ in range(500)], seed=12)
+
+    def test_split_delta_equivalence(self):
+        # Dos deltas cortados en cada posición posible dan lo mismo que el texto entero
+        for text in text_normalizer.EDGE_CASES:
+            expected = reference_stream_final(text)
+            self.assertEqual(normalize_text(text, fix_passes=2), expected)
+            for cut in range(len(text) + 1):
+                for block in (1, text_normalizer.STREAM_BLOCK_CHARS):
+                    self.assertEqual(
+                        _stream([text[:cut], text[cut:]], block), expected,
+                        f"corte en {cut} (bloque {block}) de {text!r}",
+                    )
+
+    def test_fragments_split_across_deltas(self):
+        cases = {
+            "¡ola, ¿ué tal?": ["¡", "o", "la, ¿", "u", "é tal?"],
+            "me do rte la cabeza": ["me do", " ", "rte la cabeza"],
+            "ola doctor": ["ol", "a doctor"],
+        }
+        for text, deltas in cases.items():
+            self.assertEqual("".join(deltas), text)
+            self.assertEqual(_stream(deltas, block=1), reference_stream_final(text))
+
+    def test_empty_stream(self):
+        self.assertEqual(_stream([]), reference_stream_final(""))
+        self.assertEqual(_stream(["", ""]), reference_stream_final(""))
+
+
+if __name__ == '__main__':
+    unittest.main()
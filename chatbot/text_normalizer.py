@@ -0,0 +1,445 @@
+"""
+Normalización del texto generado por el modelo (palabras fragmentadas y espacios)
+Sustituye las ~16 pasadas de re.sub de MedicalChain._fix_fragmented_words y _normalize_text
+(con `import re` y patrones construidos en cada llamada) por tres pasadas compiladas una vez,
+con el mismo resultado carácter a carácter:
+
+1. Palabras fragmentadas: una sola búsqueda con todas las reglas y una tabla de despacho por
+   regla. Las reglas secuenciales se componen en forma cerrada (p. ej. "ola " → "Hola " y la
+   regla siguiente vuelve a encontrar "ola " dentro de "Hola "), también para varias
+   aplicaciones seguidas (stream_chat corrige antes de normalizar, que vuelve a corregir)
+2. Espacios: colapsar espacios y separar minúscula→mayúscula con un reemplazo constante
+   (la separación "Soytu" → "Soy tu" y el segundo colapso de espacios no pueden cambiar nada
+   después de las anteriores y se omiten)
+3. Puntuación: solo se visitan las rachas de signos que pueden necesitar un espacio (". " y ", "
+   no); cada racha se resuelve con las tres reglas originales sobre la racha y sus vecinos
+
+StreamNormalizer aplica lo mismo a los chunks del stream: cada chunk se normaliza hasta el último
+paso de espacio a palabra (ninguna regla cruza ese límite) y solo se arrastra la palabra en curso.
+
+Verificación y benchmark (mensajes de chatbot.db y casos límite; o archivos de texto):
+    python text_normalizer.py --verify [--db chatbot.db] [archivos ...]
+    python text_normalizer.py --benchmark
+"""
+
+import argparse
+import random
+import re
+import sqlite3
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+# --- 1. Palabras fragmentadas ---
+
+_DELIMITERS = "¿¡"
+
+
+def _delimited(text: str, end: int) -> bool:
+    """Sigue [¿¡\\s] tras el fragmento (las reglas "ola" y "ué" solo corrigen entonces)"""
+    return end < len(text) and (text[end] in _DELIMITERS or text[end].isspace())
+
+
+def _ola(m: re.Match, n: int) -> str:
+    """Regla de "ola" seguido de ¿, ¡ o espacio -> "Hola" (si no, sin cambios)"""
+    return "H" * (n - 1) + "Hola" if _delimited(m.string, m.end()) else m.group()
+
+
+def _bang(m: re.Match, n: int) -> str:
+    """Regla de "¡ola" al inicio o tras espacio -> "¡Hola" (pegado a texto solo aplica la de "ola")"""
+    start = m.start()
+    delimited = _delimited(m.string, m.end())
+    if start and not m.string[start - 1].isspace():
+        return "¡" + "H" * (n - 1) + "Hola" if delimited else m.group()
+    return "¡" + "H" * n + "Hola" if delimited else "¡Hola"
+
+
+# Reemplazo de cada regla tras `passes` aplicaciones de _fix_fragmented_words: cada aplicación
+# antepone otra H/Q a los "ola"/"ué" seguidos de delimitador (la regla los encuentra de nuevo
+# dentro de "Hola"/"Qué"); el resto de reglas ya no se activa en las siguientes.
+_FIX_RULES: Dict[str, Callable[[re.Match, int], str]] = {
+    # "ola" al inicio del texto (sensible a mayúsculas, como text.startswith('ola')) -> "Hola"
+    "start": lambda m, n: "H" * n + "Hola" if _delimited(m.string, m.end()) else "Hola",
+    "bang": _bang,
+    "ola": _ola,
+    # "¿ué" -> "¿Qué"
+    "question": lambda m, n: "¿" + "Q" * n + "Qué" if _delimited(m.string, m.end()) else "¿Qué",
+    # "ué" seguido de ¿, ¡ o espacio -> "Qué"
+    "que": lambda m, n: "Q" * (n - 1) + "Qué" if _delimited(m.string, m.end()) else m.group(),
+    # "do rte" -> "duele"
+    "duele": lambda m, n: "duele",
+}
+# Todas las alternativas empiezan por la misma clase de caracteres (sre la busca sin probar cada
+# alternativa en cada posición); la letra consumida se comprueba con lookbehind y el contexto de
+# cada regla en su función. Las clases [oO]... equivalen a IGNORECASE para estas letras.
+_FIX = re.compile(
+    r"[¡¿oOuUdD](?:"
+    r"(?<=¡)(?P<bang>[oO][lL][aA])"
+    r"|(?<=¿)(?P<question>[uU][éÉ])"
+    r"|(?<=[oO])(?P<ola>[lL][aA])"
+    r"|(?<=[uU])(?P<que>[éÉ])"
+    r"|(?<=[dD])(?P<duele>[oO]\s+[rR][tT][eE]))"
+)
+
+
+def fix_fragmented_words(text: str, passes: int = 1, at_start: bool = True) -> str:
+    """Corregir palabras fragmentadas comunes en español (= `passes` llamadas a _fix_fragmented_words)"""
+    if not text:
+        return text
+
+    def replace(m: re.Match) -> str:
+        rule = m.lastgroup
+        if rule == "ola" and at_start and m.start() == 0 and m.group() == "ola":
+            rule = "start"
+        return _FIX_RULES[rule](m, passes)
+
+    return _FIX.sub(replace, text)
+
+
+# --- 2. Espacios ---
+
+_LOWER = "a-záéíóúñü"
+_UPPER = "A-ZÁÉÍÓÚÑÜ"
+# Espacios que no son ya un " " suelto, y el hueco entre minúscula y mayúscula ("holaSoy")
+_SPACING = re.compile(rf"\s{{2,}}|[^\S ]|(?<=[{_LOWER}])(?=[{_UPPER}])")
+
+# --- 3. Puntuación ---
+
+# Rachas máximas de signos que pueden recibir un espacio: dos o más signos, un signo pegado a
+# lo siguiente, o ¡/¿ pegado a lo anterior (". " o ", " sueltos no cambian y no se visitan).
+# La búsqueda de izquierda a derecha empieza siempre en el primer signo de la racha, y todas las
+# alternativas empiezan por la clase de signos (el lookbehind va después del signo consumido).
+_PUNCT_RUN = re.compile(
+    r"[.!?,:;¡¿]{2,}"
+    r"|[.!?,:;¡¿](?=[^\s.!?,:;¡¿])"
+    r"|[¡¿](?<=[^\s.!?,:;¡¿][¡¿])(?![.!?,:;¡¿])"
+)
+# Reglas originales, en su orden (la semántica sin solapamiento de re.sub importa dentro de una racha)
+_AFTER_PUNCT = re.compile(r"([.!?,:;])([^\s])")
+_BEFORE_OPENING = re.compile(r"([^\s])([¡¿])")
+_AFTER_CLOSING = re.compile(r"([!?])([^\s])")
+
+
+@lru_cache(maxsize=2048)
+def _space_snippet(before: str, run: str, after: str) -> str:
+    out = before + run + after
+    out = _AFTER_PUNCT.sub(r"\1 \2", out)
+    out = _BEFORE_OPENING.sub(r"\1 \2", out)
+    out = _AFTER_CLOSING.sub(r"\1 \2", out)
+    return out[len(before):len(out) - len(after)]
+
+
+def _space_punct_run(m: re.Match) -> str:
+    """Aplicar las tres reglas a la racha con su vecino de cada lado (no dependen de nada más lejos)"""
+    text, start, end = m.string, m.start(), m.end()
+    # Vecinos que no son espacio ni signo: su valor exacto no cambia el resultado
+    before = text[start - 1] if start else ""
+    after = text[end] if end < len(text) else ""
+    return _space_snippet(" " if before.isspace() else "x" if before else "",
+                          m.group(),
+                          " " if after.isspace() else "x" if after else "")
+
+
+def _normalize_body(text: str, fix_passes: int, at_start: bool) -> str:
+    """Las tres pasadas sin el strip final"""
+    if fix_passes:
+        text = fix_fragmented_words(text, fix_passes, at_start)
+    text = _SPACING.sub(" ", text)
+    return _PUNCT_RUN.sub(_space_punct_run, text)
+
+
+def normalize_text(text: str, fix_passes: int = 1) -> str:
+    """Normalizar espacios entre palabras (= _normalize_text tras `fix_passes - 1` correcciones previas)"""
+    if not text:
+        return text
+    return _normalize_body(text, fix_passes, True).strip()
+
+
+_CUT_WORD = re.compile(r"\S+\s*\Z")
+# Caracteres acumulados antes de normalizar un bloque del stream
+STREAM_BLOCK_CHARS = 512
+
+
+class StreamNormalizer:
+    """Normalización incremental de un stream: feed(chunk) por chunk y finish() al final
+
+    El resultado de finish() es normalize_text(texto completo, fix_passes). Cada chunk se procesa
+    hasta el último paso de espacio a palabra: ninguna regla cruza ese punto (salvo "do rte", que
+    se comprueba aparte), así que solo se arrastra la palabra incompleta.
+    """
+
+    __slots__ = ("fix_passes", "block", "_pending", "_pending_chars", "_tail", "_parts", "_at_start", "_pending_space")
+
+    def __init__(self, fix_passes: int = 1, block: int = STREAM_BLOCK_CHARS):
+        self.fix_passes = fix_passes
+        self.block = block
+        self._pending: List[str] = []
+        self._pending_chars = 0
+        self._tail = ""
+        self._parts: List[str] = []
+        self._at_start = True
+        self._pending_space = False  # el " " final solo se emite si sigue texto (strip)
+
+    def _cut(self, text: str) -> int:
+        """Inicio de la última palabra precedida de espacio (0 si aún no se puede cortar)"""
+        while True:
+            word = _CUT_WORD.search(text)
+            if not word or word.start() == 0:
+                return 0
+            cut = word.start()
+            spaces = cut - len(text[:cut].rstrip())
+            # "do" + espacios + "rte" se corrige a "duele": no cortar entre ellos
+            if text[max(0, cut - spaces - 2):cut - spaces].lower() != "do":
+                return cut
+            text = text[:cut - spaces - 2]
+
+    def _emit(self, text: str, last: bool) -> str:
+        out = _normalize_body(text, self.fix_passes, self._at_start)
+        if self._at_start:
+            out = out.lstrip()
+            self._at_start = not out and not text
+        if not out:
+            return ""
+        if self._pending_space:
+            out = " " + out
+            self._pending_space = False
+        if not last and out.endswith(" "):
+            out = out[:-1]
+            self._pending_space = True
+        elif last:
+            out = out.rstrip()
+        self._parts.append(out)
+        return out
+
+    def feed(self, chunk: str) -> str:
+        """Añadir un chunk; devuelve el texto normalizado que ya es definitivo
+
+        Los chunks se acumulan hasta `block` caracteres antes de normalizar: los deltas de vLLM
+        son de pocos caracteres y tres re.sub por delta costarían más que la pasada final.
+        """
+        if not chunk:
+            return ""
+        self._pending.append(chunk)
+        self._pending_chars += len(chunk)
+        if self._pending_chars < self.block:
+            return ""
+        text = self._tail + "".join(self._pending)
+        self._pending.clear()
+        self._pending_chars = 0
+        cut = self._cut(text)
+        if cut == 0:
+            self._tail = text
+            return ""
+        self._tail = text[cut:]
+        return self._emit(text[:cut], last=False)
+
+    def finish(self) -> str:
+        """Procesar lo que queda y devolver el texto normalizado completo"""
+        tail = self._tail + "".join(self._pending)
+        self._tail = ""
+        self._pending.clear()
+        self._pending_chars = 0
+        self._emit(tail, last=True)
+        self._pending_space = False
+        return "".join(self._parts)
+
+
+# --- Verificación y benchmark ---
+
+def reference_fix_fragmented_words(text: str) -> str:
+    """MedicalChain._fix_fragmented_words anterior (referencia para --verify)"""
+    if not text:
+        return text
+    text = re.sub(r'(^|\s)¡ola', r'\1¡Hola', text, flags=re.IGNORECASE)
+    if text.startswith('ola') or text.startswith('¡ola'):
+        if text.startswith('¡ola'):
+            text = '¡Hola' + text[4:]
+        elif text.startswith('ola'):
+            text = 'Hola' + text[3:]
+    text = re.sub(r'(^|\s)¿ué', r'\1¿Qué', text, flags=re.IGNORECASE)
+    text = re.sub(r'¿ué', '¿Qué', text, flags=re.IGNORECASE)
+    text = re.sub(r'do\s+rte', 'duele', text, flags=re.IGNORECASE)
+    text = re.sub(r'do\s+rte', 'duele', text, flags=re.IGNORECASE)
+    text = re.sub(r'ola([¿¡\s])', r'Hola\1', text, flags=re.IGNORECASE)
+    text = re.sub(r'ué([¿¡\s])', r'Qué\1', text, flags=re.IGNORECASE)
+    return text
+
+
+def reference_normalize_text(text: str) -> str:
+    """MedicalChain._normalize_text anterior (referencia para --verify)"""
+    if not text:
+        return text
+    text = reference_fix_fragmented_words(text)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'([a-záéíóúñü])([A-ZÁÉÍÓÚÑÜ])', r'\1 \2', text)
+    text = re.sub(r'([A-ZÁÉÍÓÚÑÜ][a-záéíóúñü]+)([A-ZÁÉÍÓÚÑÜ][a-záéíóúñü])', r'\1 \2', text)
+    text = re.sub(r'([.!?,:;])([^\s])', r'\1 \2', text)
+    text = re.sub(r'([^\s])([¡¿])', r'\1 \2', text)
+    text = re.sub(r'([!?])([^\s])', r'\1 \2', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+def reference_stream_final(text: str) -> str:
+    """Texto final de stream_chat: _normalize_text(_fix_fragmented_words(texto))"""
+    return reference_normalize_text(reference_fix_fragmented_words(text))
+
+
+EDGE_CASES = [
+    "", " ", "\n\t ", "ola", "ola amigo", "Ola amigo", "olA ", "¡ola! ¿ué tal?", " ¡ola ¡OLA\n", "x¡ola ",
+    "¿ué", "¿UÉ ", "¿ué¿ué ", "qué tal, ¿qué haces?", "me do   rte la cabeza", "DO\nRTE", "todo rte",
+    "hola mundo ola¡ola ola", "holaSoy tuAsistente", "ÁrbolÉl", "IMSS y ONU", "Soytu médico",
+    "Hola.Adiós,bien;mal:x", "...x", "a?!b", "a¿¿b", "a¿¿¿", ".¿¿", "..¿¿", "¡¡hola!!", "fin?!", "¿?¡!.,;:",
+    "3.5 mg/kg, 2,5 ml.", "**Recomendaciones:**\n1. Reposo.\n2.Hidratación", "https://imss.gob.mx/a?b=c",
+    "  espacios    raros aquí  ", "emoji 🫁¿ué? ola🫁 ", "do rte¡ola", "uéola ué¡ué",
+]
+
+
+def load_corpus(db_path: Optional[str], files: List[str]) -> List[str]:
+    texts = list(EDGE_CASES)
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            texts.append(f.read())
+    if db_path:
+        conn = sqlite3.connect(db_path)
+        try:
+            texts.extend(row[0] for row in conn.execute("SELECT content FROM messages WHERE content != ''"))
+        except sqlite3.Error as e:
+            print(f"⚠️ No se pudieron leer mensajes de {db_path}: {e}")
+        finally:
+            conn.close()
+    return texts
+
+
+def _chunked(text: str, rng: random.Random) -> List[str]:
+    """Trocear como deltas de vLLM (1-6 caracteres)"""
+    chunks, pos = [], 0
+    while pos < len(text):
+        step = rng.randint(1, 6)
+        chunks.append(text[pos:pos + step])
+        pos += step
+    return chunks
+
+
+def _stream(chunks: List[str], fix_passes: int, block: int = STREAM_BLOCK_CHARS) -> str:
+    normalizer = StreamNormalizer(fix_passes, block)
+    for chunk in chunks:
+        normalizer.feed(chunk)
+    return normalizer.finish()
+
+
+def verify(texts: List[str], seed: int = 3) -> Dict[str, Any]:
+    """Comparar con las funciones anteriores, de una vez y por chunks (AssertionError si difiere)"""
+    rng = random.Random(seed)
+    for text in texts:
+        checks = (
+            ("fix", reference_fix_fragmented_words(text), fix_fragmented_words(text)),
+            ("normalize", reference_normalize_text(text), normalize_text(text)),
+            ("stream", reference_stream_final(text), normalize_text(text, fix_passes=2)),
+            ("incremental", reference_stream_final(text), _stream(_chunked(text, rng), 2)),
+            # Bloque mínimo: se corta tras cada delta (todos los límites posibles)
+            ("incremental/1", reference_stream_final(text), _stream(_chunked(text, rng), 2, block=1)),
+        )
+        for name, expected, got in checks:
+            if expected != got:
+                raise AssertionError(f"{name} difiere para {text[:80]!r}:\n  esperado {expected[:120]!r}\n  obtenido {got[:120]!r}")
+    return {"texts": len(texts), "chars": sum(len(t) for t in texts)}
+
+
+def _mutate(text: str, rng: random.Random) -> str:
+    """Variante con fragmentos, signos y espacios insertados (para fuzzing)"""
+    pieces = ["ola", "¡ola", "¿ué", "ué", "do rte", "do\n rte", "¿", "¡", "!", "?", ".", ",", "...", "  ", "\n", "aB", "Ñ"]
+    chars = list(text)
+    for _ in range(max(1, len(chars) // 20)):
+        chars.insert(rng.randint(0, len(chars)), rng.choice(pieces))
+    return "".join(chars)
+
+
+BENCHMARK_ROUNDS = 5
+
+
+def benchmark(texts: List[str], repeat: int) -> Dict[str, Any]:
+    """Respuestas largas: coste total (ns por carácter) y coste tras el último delta (µs por respuesta)"""
+    rng = random.Random(5)
+    chunked = [_chunked(t, rng) for t in texts]
+
+    def fed() -> List[StreamNormalizer]:
+        normalizers = [StreamNormalizer(2) for _ in chunked]
+        for normalizer, chunks in zip(normalizers, chunked):
+            for chunk in chunks:
+                normalizer.feed(chunk)
+        return normalizers
+
+    names = ("anterior", "compilada", "incremental")
+    total = {name: float("inf") for name in names}
+    final = dict(total)
+    for _ in range(BENCHMARK_ROUNDS):
+        for name in names:
+            elapsed_total = elapsed_final = 0.0
+            for _ in range(repeat):
+                started = time.perf_counter()
+                if name == "anterior":
+                    [reference_stream_final(t) for t in texts]
+                elif name == "compilada":
+                    [normalize_text(t, fix_passes=2) for t in texts]
+                else:
+                    normalizers = fed()
+                    # Con el stream terminado solo queda el último bloque
+                    finishing = time.perf_counter()
+                    [n.finish() for n in normalizers]
+                    elapsed_final += time.perf_counter() - finishing
+                elapsed = time.perf_counter() - started
+                elapsed_total += elapsed
+                if name != "incremental":
+                    elapsed_final += elapsed
+            total[name] = min(total[name], elapsed_total)
+            final[name] = min(final[name], elapsed_final)
+    chars = sum(len(t) for t in texts) * repeat
+    responses = len(texts) * repeat
+    return {
+        name: {"ns_per_char": round(total[name] / chars * 1e9, 1), "final_us": round(final[name] / responses * 1e6, 1)}
+        for name in names
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verificación y benchmark de la normalización de texto")
+    parser.add_argument("--verify", action="store_true", help="Comparar con las funciones anteriores")
+    parser.add_argument("--benchmark", action="store_true", help="Medir con respuestas largas")
+    parser.add_argument("--db", default="chatbot.db", help="Mensajes grabados (tabla messages)")
+    parser.add_argument("--fuzz", type=int, default=2000, help="Variantes aleatorias a verificar")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("files", nargs="*", help="Textos adicionales (un archivo por texto)")
+    args = parser.parse_args()
+    if not (args.verify or args.benchmark):
+        parser.print_help()
+        return
+    texts = load_corpus(args.db, args.files)
+    if args.verify:
+        result = verify(texts)
+        print(f"✅ Idéntico a las funciones anteriores: {result['texts']} textos, {result['chars']} caracteres")
+        rng = random.Random(17)
+        pool = [t for t in texts if t] or EDGE_CASES[1:]
+        fuzzed = [_mutate(rng.choice(pool), rng) for _ in range(args.fuzz)]
+        result = verify(fuzzed, seed=29)
+        print(f"✅ Idéntico en {result['texts']} variantes aleatorias ({result['chars']} caracteres)")
+    if args.benchmark:
+        # Respuestas largas: mensajes concatenados en bloques de ~8000 caracteres
+        long_texts, block = [], ""
+        for text in texts:
+            block += text + "\n\n"
+            if len(block) >= 8000:
+                long_texts.append(block)
+                block = ""
+        long_texts = long_texts or [block * 20]
+        results = benchmark(long_texts, args.repeat)
+        print(f"📊 {len(long_texts)} respuestas largas, {args.repeat} repeticiones")
+        print(f"   {'':<12} {'ns/carácter':>12} {'µs tras el stream':>18}")
+        for name, value in results.items():
+            print(f"   {name:<12} {value['ns_per_char']:>12.1f} {value['final_us']:>18.1f}")
+        speedup = results["anterior"]["ns_per_char"] / results["compilada"]["ns_per_char"]
+        print(f"   Aceleración (compilada): {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
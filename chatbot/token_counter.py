@@ -0,0 +1,173 @@
+"""
+Conteo local de tokens para el Chatbot IMSS
+Carga una sola vez el tokenizer de MedGemma desde disco (sin red) y cuenta mensajes
+con el formato del chat template, sin pedirle al servidor de inferencia un prefill.
+
+- CHATBOT_TOKENIZER_PATH: directorio local del tokenizer (p. ej. el snapshot de google/medgemma-27b-it)
+- Sin tokenizer (ruta vacía o transformers no instalado) se usa la aproximación de 4 caracteres por token
+- Los conteos por contenido se cachean por hash (LRU), así que contar el historial repetido es O(1)
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_PATH = os.getenv("CHATBOT_TOKENIZER_PATH", "")
+TOKEN_CACHE_SIZE = int(os.getenv("CHATBOT_TOKEN_CACHE_SIZE", "20000"))
+# Gemma 3 / MedGemma codifican cada imagen como un número fijo de soft tokens
+IMAGE_TOKENS = int(os.getenv("CHATBOT_IMAGE_TOKENS", "256"))
+
+CHARS_PER_TOKEN = 4  # Aproximación usada sin tokenizer
+
+
+class TokenCounter:
+    """Contador de tokens con tokenizer local y cache por hash de contenido
+
+    - count_text: tokens de un texto (sin tokens especiales)
+    - count_messages: tokens del prompt completo con el chat template
+      (BOS + por turno: marcas de inicio/fin y rol + contenido; más el inicio del turno del modelo)
+    - Thread-safe: se usa desde el event loop y desde los hilos del pool SQLite
+    """
+
+    def __init__(self, tokenizer_path: str = TOKENIZER_PATH, cache_size: int = TOKEN_CACHE_SIZE):
+        self.tokenizer_path = tokenizer_path
+        self.cache_size = max(1, cache_size)
+        self._tokenizer = None
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Tokens que añade el chat template (se miden al cargar el tokenizer)
+        self.bos_tokens = 0
+        self.turn_overhead = 0
+        self.generation_prompt_tokens = 0
+        self.stats = {"hits": 0, "misses": 0}
+
+    # --- Carga del tokenizer ---
+
+    def load(self):
+        """Cargar el tokenizer (idempotente); llamar en el arranque para no pagarlo en la primera petición"""
+        if self._loaded:
+            return self._tokenizer
+        with self._load_lock:
+            if self._loaded:
+                return self._tokenizer
+            if self.tokenizer_path:
+                try:
+                    from transformers import AutoTokenizer
+
+                    tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path, local_files_only=True)
+                    self._measure_template(tokenizer)
+                    self._tokenizer = tokenizer
+                    logger.info(
+                        f"✅ Tokenizer local cargado: {self.tokenizer_path} "
+                        f"(BOS={self.bos_tokens}, por turno={self.turn_overhead}, prompt={self.generation_prompt_tokens})"
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ No se pudo cargar el tokenizer local ({e}); usando {CHARS_PER_TOKEN} caracteres por token")
+            else:
+                logger.info(f"ℹ️ CHATBOT_TOKENIZER_PATH no configurado; usando {CHARS_PER_TOKEN} caracteres por token")
+            self._loaded = True
+        return self._tokenizer
+
+    def _measure_template(self, tokenizer):
+        """Medir los tokens que el chat template añade alrededor del contenido"""
+        if not getattr(tokenizer, "chat_template", None):
+            return
+        content = len(tokenizer.encode("x", add_special_tokens=False))
+        one = [{"role": "user", "content": "x"}]
+        two = one + [{"role": "assistant", "content": "x"}]
+        one_len = len(tokenizer.apply_chat_template(one, tokenize=True))
+        two_len = len(tokenizer.apply_chat_template(two, tokenize=True))
+        prompt_len = len(tokenizer.apply_chat_template(one, tokenize=True, add_generation_prompt=True))
+        self.turn_overhead = two_len - one_len - content
+        self.bos_tokens = one_len - content - self.turn_overhead
+        self.generation_prompt_tokens = prompt_len - one_len
+
+    @property
+    def exact(self) -> bool:
+        """True si los conteos vienen del tokenizer real (no de la aproximación)"""
+        return self.load() is not None
+
+    # --- Conteo ---
+
+    def count_text(self, text: Optional[str]) -> int:
+        """Tokens de un texto, cacheados por hash del contenido"""
+        if not text:
+            return 0
+        tokenizer = self.load()
+        if tokenizer is None:
+            return len(text) // CHARS_PER_TOKEN
+        key = hashlib.blake2b(text.encode("utf-8", errors="replace"), digest_size=16).digest()
+        with self._cache_lock:
+            count = self._cache.get(key)
+            if count is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return count
+        count = len(tokenizer.encode(text, add_special_tokens=False))
+        with self._cache_lock:
+            self.stats["misses"] += 1
+            self._cache[key] = count
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return count
+
+    def truncate_text(self, text: Optional[str], max_tokens: int, keep: str = "head") -> str:
+        """Recortar un texto a `max_tokens` en frontera de token ("head" conserva el inicio, "tail" el final)"""
+        if not text or max_tokens <= 0:
+            return ""
+        if self.count_text(text) <= max_tokens:
+            return text
+        tokenizer = self.load()
+        if tokenizer is None:
+            chars = max_tokens * CHARS_PER_TOKEN
+            return text[:chars] if keep == "head" else text[-chars:]
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        ids = ids[:max_tokens] if keep == "head" else ids[-max_tokens:]
+        return tokenizer.decode(ids)
+
+    def count_messages(self, messages: List[Dict[str, Any]], add_generation_prompt: bool = True) -> int:
+        """Tokens del prompt de una lista de mensajes {"role", "content"} en formato de chat"""
+        total = sum(self.count_text(str(m.get("content") or "")) + self.turn_overhead for m in messages)
+        if messages:
+            total += self.bos_tokens
+            if add_generation_prompt:
+                total += self.generation_prompt_tokens
+        return total
+
+    def count_image(self, image_data: str) -> int:
+        """Tokens de una imagen: fijos por imagen con el tokenizer del modelo, aproximación sobre el base64 sin él"""
+        if self.exact:
+            return IMAGE_TOKENS
+        return len(image_data or "") // CHARS_PER_TOKEN
+
+    def usage(self, messages: List[Dict[str, Any]], completion: Optional[str] = None) -> Dict[str, Any]:
+        """Usage con el mismo formato que la API de OpenAI (prompt/completion/total)"""
+        prompt_tokens = self.count_messages(messages)
+        completion_tokens = self.count_text(completion) if completion is not None else 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+
+# Instancia global
+_token_counter: Optional[TokenCounter] = None
+_token_counter_lock = threading.Lock()
+
+
+def get_token_counter() -> TokenCounter:
+    """Obtener el contador de tokens compartido del proceso"""
+    global _token_counter
+    if _token_counter is None:
+        with _token_counter_lock:
+            if _token_counter is None:
+                _token_counter = TokenCounter()
+    return _token_counter
@@ -84,7 +84,33 @@ def transcribe_audio(
     try:
         # Decodificar audio de base64
         audio_bytes = base64.b64decode(audio_data)
-        
+    except Exception as e:
+        logger.error(f"❌ Error en transcripción: {e}")
+        return {
+            "success": False,
+            "text": "",
+            "error": str(e)
+        }
+    return transcribe_audio_bytes(audio_bytes, audio_format, language)
+
+
+def transcribe_audio_bytes(
+    audio_bytes: bytes,
+    audio_format: str = "webm",
+    language: Optional[str] = "es"
+) -> Dict[str, Any]:
+    """
+    Transcribir audio ya decodificado (tramas binarias del WebSocket, sin base64)
+    
+    Args:
+        audio_bytes: Audio en bytes
+        audio_format: Formato del audio (webm, wav, mp3, etc.)
+        language: Idioma del audio (opcional, Whisper lo detecta automáticamente)
+    
+    Returns:
+        Dict con success, text, y error (si hay)
+    """
+    try:
         # Guardar temporalmente en un archivo
         with tempfile.NamedTemporaryFile(delete=False, suffix=f".{audio_format}") as temp_file:
             temp_file.write(audio_bytes)
@@ -0,0 +1,258 @@
+"""
+Cola de escritura diferida (write-behind) para SQLite
+Agrupa escrituras de mensajes, memorias y métricas en una sola transacción
+cada N ms o M operaciones, en un hilo escritor dedicado.
+
+Modos de durabilidad (CHATBOT_DB_DURABILITY):
+- "async":  se encola y se retorna de inmediato (por defecto)
+- "commit": se encola y se espera al commit del lote (group commit)
+- "sync":   sin cola, cada escritura se ejecuta en su propia transacción
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WRITE_FLUSH_INTERVAL_MS = int(os.getenv("CHATBOT_DB_FLUSH_INTERVAL_MS", "50"))
+WRITE_BATCH_SIZE = int(os.getenv("CHATBOT_DB_BATCH_SIZE", "200"))
+WRITE_QUEUE_MAX = int(os.getenv("CHATBOT_DB_WRITE_QUEUE_MAX", "10000"))
+DB_DURABILITY = os.getenv("CHATBOT_DB_DURABILITY", "async").lower()
+
+DURABILITY_MODES = ("async", "commit", "sync")
+
+# Operación: función que recibe la conexión dentro de la transacción del lote
+WriteOp = Callable[[sqlite3.Connection], Any]
+
+
+class _Item:
+    __slots__ = ("op", "key", "future")
+
+    def __init__(self, op: Optional[WriteOp], key: Optional[str], future: Optional[Future]):
+        self.op = op
+        self.key = key
+        self.future = future
+
+
+class WriteBehindQueue:
+    """Cola acotada de escrituras que se vacía en lotes transaccionales
+
+    - Las operaciones con la misma `key` dentro de un lote se colapsan (solo se ejecuta la última),
+      útil para reescrituras completas como conversation_memory
+    - Si la cola está llena, el productor espera (backpressure) en lugar de perder escrituras
+    - Si un lote falla, sus operaciones se reintentan una por una para aislar la que falla
+    """
+
+    def __init__(
+        self,
+        pool,
+        flush_interval_ms: int = WRITE_FLUSH_INTERVAL_MS,
+        batch_size: int = WRITE_BATCH_SIZE,
+        max_size: int = WRITE_QUEUE_MAX,
+        durability: str = DB_DURABILITY,
+    ):
+        if durability not in DURABILITY_MODES:
+            logger.warning(f"⚠️ Modo de durabilidad desconocido '{durability}', usando 'async'")
+            durability = "async"
+        self.pool = pool
+        self.flush_interval = max(1, flush_interval_ms) / 1000.0
+        self.batch_size = max(1, batch_size)
+        self.durability = durability
+        self._queue: "queue.Queue[_Item]" = queue.Queue(maxsize=max(1, max_size))
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self.stats = {"enqueued": 0, "flushed": 0, "batches": 0, "coalesced": 0, "errors": 0}
+
+    # --- Productores ---
+
+    def submit(self, op: WriteOp, key: Optional[str] = None):
+        """Encolar una escritura (bloquea solo si la cola está llena o en modo 'commit')"""
+        if self.durability == "sync" or self._closed:
+            self._run_direct(op)
+            return
+        future = Future() if self.durability == "commit" else None
+        self._put(_Item(op, key, future))
+        if future is not None:
+            future.result()
+
+    async def submit_async(self, op: WriteOp, key: Optional[str] = None):
+        """Versión async de submit: nunca bloquea el event loop"""
+        if self.durability == "sync" or self._closed:
+            await self.pool.run(self._run_direct, op)
+            return
+        future = Future() if self.durability == "commit" else None
+        item = _Item(op, key, future)
+        try:
+            self._put(item, block=False)
+        except queue.Full:
+            logger.warning("⚠️ Cola de escritura llena, esperando espacio")
+            await self.pool.run(self._put, item)
+        if future is not None:
+            await asyncio.wrap_future(future)
+
+    def _put(self, item: _Item, block: bool = True):
+        self._ensure_writer()
+        self._queue.put(item, block=block)
+        self.stats["enqueued"] += 1
+
+    def flush(self, timeout: Optional[float] = None):
+        """Esperar a que todo lo encolado hasta ahora esté en disco"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        marker = _Item(None, None, Future())
+        self._queue.put(marker)
+        marker.future.result(timeout=timeout)
+
+    async def flush_async(self):
+        await self.pool.run(self.flush)
+
+    # --- Hilo escritor ---
+
+    def _ensure_writer(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._writer_loop, name="sqlite-write-behind", daemon=True)
+                self._thread.start()
+
+    def _writer_loop(self):
+        while True:
+            first = self._queue.get()
+            if first.op is None and first.key == "__stop__":
+                self._drain()
+                first.future.set_result(None)
+                return
+            batch = [first]
+            # En modo 'commit' hay productores esperando: el lote es lo acumulado mientras
+            # se escribía el anterior (group commit), sin esperar la ventana completa
+            window = 0 if self.durability == "commit" else self.flush_interval
+            deadline = time.monotonic() + window
+            stop = None
+            # Acumular hasta M operaciones o N ms desde la primera (un marcador de flush corta el lote)
+            while len(batch) < self.batch_size and first.op is not None:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item.op is None and item.key == "__stop__":
+                    stop = item
+                    break
+                batch.append(item)
+                if item.op is None:
+                    break
+            self._flush_batch(batch)
+            if stop is not None:
+                self._drain()
+                stop.future.set_result(None)
+                return
+
+    def _drain(self):
+        """Escribir lo que haya quedado en la cola al detenerse"""
+        rest: List[_Item] = []
+        while True:
+            try:
+                rest.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if rest:
+            self._flush_batch(rest)
+
+    def _flush_batch(self, batch: List[_Item]):
+        ops = [item for item in batch if item.op is not None]
+        # Colapsar operaciones con la misma clave conservando la última
+        last_by_key: Dict[str, int] = {}
+        for idx, item in enumerate(ops):
+            if item.key is not None:
+                last_by_key[item.key] = idx
+        to_run: List[Tuple[int, _Item]] = [
+            (idx, item) for idx, item in enumerate(ops)
+            if item.key is None or last_by_key[item.key] == idx
+        ]
+        self.stats["coalesced"] += len(ops) - len(to_run)
+
+        errors: Dict[int, BaseException] = {}
+        if to_run:
+            try:
+                with self.pool.transaction() as conn:
+                    for _, item in to_run:
+                        item.op(conn)
+                self.stats["batches"] += 1
+            except Exception as e:
+                logger.warning(f"⚠️ Lote de escritura falló ({len(to_run)} ops), reintentando individualmente: {e}")
+                for idx, item in to_run:
+                    try:
+                        self._run_direct(item.op)
+                    except Exception as op_err:
+                        errors[idx] = op_err
+                        self.stats["errors"] += 1
+                        logger.error(f"❌ Error en escritura diferida: {op_err}")
+            self.stats["flushed"] += len(to_run) - len(errors)
+
+        for idx, item in enumerate(ops):
+            if item.future is not None:
+                err = errors.get(idx)
+                if err is not None:
+                    item.future.set_exception(err)
+                else:
+                    item.future.set_result(None)
+        for item in batch:
+            if item.op is None and item.key != "__stop__" and not item.future.done():
+                item.future.set_result(None)
+
+    def _run_direct(self, op: WriteOp):
+        with self.pool.transaction() as conn:
+            op(conn)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Vaciar la cola y detener el hilo escritor (usar en el shutdown)"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is None or not self._thread.is_alive():
+            return
+        stop = _Item(None, "__stop__", Future())
+        self._queue.put(stop)
+        try:
+            stop.future.result(timeout=timeout)
+            logger.info(f"✅ Cola de escritura vaciada: {self.stats['flushed']} escrituras en {self.stats['batches']} lotes")
+        except Exception as e:
+            logger.error(f"❌ Timeout vaciando cola de escritura: {e}")
+
+
+# Colas globales por pool
+_queues: Dict[str, WriteBehindQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_write_queue(pool) -> WriteBehindQueue:
+    """Obtener la cola de escritura compartida para un pool"""
+    key = os.path.abspath(pool.db_path)
+    with _queues_lock:
+        wq = _queues.get(key)
+        if wq is None or wq._closed or wq.pool is not pool:
+            wq = WriteBehindQueue(pool)
+            _queues[key] = wq
+            logger.info(f"✅ Cola write-behind inicializada ({wq.durability}, {WRITE_FLUSH_INTERVAL_MS}ms / {WRITE_BATCH_SIZE} ops)")
+        return wq
+
+
+def close_all_write_queues():
+    """Vaciar todas las colas (antes de cerrar los pools)"""
+    with _queues_lock:
+        queues = list(_queues.values())
+        _queues.clear()
+    for wq in queues:
+        wq.close()
@@ -0,0 +1,377 @@
+"""
+Transporte WebSocket multiplexado para chat, imágenes y audio
+Una sola conexión autenticada (/api/ws) lleva varios streams lógicos a la vez: la conexión y la
+verificación del token se pagan una vez por sesión, y las imágenes y el audio viajan en tramas
+binarias en lugar de base64 dentro de JSON.
+
+Mensajes de texto (JSON); "stream" es un entero que elige el cliente, único dentro de la conexión:
+- Cliente → servidor: {"type": <tipo registrado>, "stream": n, ...} abre un stream (chat, image,
+  tts, transcribe, resume); {"type": "cancel", "stream": n}; {"type": "credit", "stream": n, "credits": k}
+- Servidor → cliente: {"stream": n, "type": ..., ...}; cada stream termina con
+  {"stream": n, "type": "end", "status": "ok" | "cancelled" | "error"}
+
+Tramas binarias en ambos sentidos: cabecera de 5 bytes (stream uint32 big-endian + flags) y payload
+- FLAG_FIN: último trozo del payload del stream (imagen o audio completos)
+- FLAG_SEGMENT: fin de un segmento de audio decodificable por sí solo (transcripción parcial)
+
+Control de flujo por stream: cada mensaje de datos del servidor (evento de chat, trozo de audio)
+gasta un crédito; cada stream empieza con CHATBOT_WS_WINDOW (32) y el cliente los repone con
+"credit". Un stream sin créditos espera sin frenar a los demás.
+
+- CHATBOT_WS_MAX_STREAMS: streams abiertos a la vez por conexión (8)
+- CHATBOT_WS_MAX_PAYLOAD_MB: tamaño máximo del payload binario de un stream (20 MB)
+- CHATBOT_WS_AUTH_TIMEOUT: segundos para enviar {"type": "auth", "token": ...} si la conexión
+  no trae cabecera Authorization (los navegadores no pueden ponerla en un WebSocket)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+WS_WINDOW = int(os.getenv("CHATBOT_WS_WINDOW", "32"))
+WS_MAX_STREAMS = int(os.getenv("CHATBOT_WS_MAX_STREAMS", "8"))
+WS_MAX_PAYLOAD = int(float(os.getenv("CHATBOT_WS_MAX_PAYLOAD_MB", "20")) * 1024 * 1024)
+WS_AUTH_TIMEOUT = float(os.getenv("CHATBOT_WS_AUTH_TIMEOUT", "10"))
+WS_BINARY_CHUNK = 64 * 1024  # trozo de las tramas binarias de salida (un crédito cada uno)
+
+_HEADER = struct.Struct(">IB")
+FLAG_FIN = 0x01
+FLAG_SEGMENT = 0x02
+
+# Cierre por token ausente o inválido (1008: violación de política)
+WS_POLICY_VIOLATION = 1008
+
+Handler = Callable[["MuxStream", Dict[str, Any]], Awaitable[None]]
+
+
+def pack_frame(stream_id: int, payload: bytes, flags: int = 0) -> bytes:
+    return _HEADER.pack(stream_id, flags) + payload
+
+
+def unpack_frame(frame: bytes):
+    """(stream, flags, payload) de una trama binaria (ValueError si no trae cabecera)"""
+    if len(frame) < _HEADER.size:
+        raise ValueError("trama binaria sin cabecera")
+    stream_id, flags = _HEADER.unpack_from(frame)
+    return stream_id, flags, memoryview(frame)[_HEADER.size:]
+
+
+class StreamCancelled(Exception):
+    """El cliente canceló el stream (o cerró la conexión)"""
+
+
+class MuxStream:
+    """Un stream lógico dentro de la conexión: créditos de salida y payload binario de entrada"""
+
+    __slots__ = (
+        "conn", "stream_id", "kind", "credits", "task", "on_cancel", "cancelled",
+        "_credit_event", "_segment", "_segments", "_payload_size", "_input_done",
+    )
+
+    def __init__(self, conn: "MuxConnection", stream_id: int, kind: str, credits: int):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.kind = kind
+        self.credits = credits
+        self.task: Optional[asyncio.Task] = None
+        # Cancelación propia del handler (p. ej. abortar la generación); sin ella se cancela la tarea
+        self.on_cancel: Optional[Callable[[], None]] = None
+        self.cancelled = False
+        self._credit_event = asyncio.Event()
+        self._segment: List[bytes] = []
+        self._segments: asyncio.Queue = asyncio.Queue()  # (segmento, último); None = FIN
+        self._payload_size = 0
+        self._input_done = False
+
+    # --- Salida ---
+
+    async def _take_credit(self):
+        while self.credits <= 0:
+            self._credit_event.clear()
+            _count("credit_waits")
+            await self._credit_event.wait()
+        self.credits -= 1
+
+    def grant(self, credits: int):
+        self.credits += credits
+        self._credit_event.set()
+
+    async def send(self, payload: Dict[str, Any]):
+        """Mensaje de datos (gasta un crédito)"""
+        await self._take_credit()
+        await self.conn.send_json({"stream": self.stream_id, **payload})
+
+    async def send_sse(self, frame: str):
+        """Reenviar una trama SSE ("id: n\\ndata: {...}\\n\\n") como {"type": "event", "id": n, "data": {...}}
+
+        El JSON de la trama se inserta tal cual, sin volver a parsearlo ni codificarlo.
+        """
+        event_id = None
+        if frame.startswith("id: "):
+            header, _, frame = frame.partition("\n")
+            event_id = int(header[4:])
+        data = frame[6:].rstrip("\n")  # quitar "data: " y la línea vacía final
+        id_part = f', "id": {event_id}' if event_id is not None else ""
+        await self._take_credit()
+        await self.conn.send_text(f'{{"stream": {self.stream_id}, "type": "event"{id_part}, "data": {data}}}')
+
+    async def send_binary(self, data: bytes):
+        """Payload binario en trozos de WS_BINARY_CHUNK (un crédito por trozo, FLAG_FIN en el último)"""
+        view = memoryview(data)
+        total = len(view)
+        offset = 0
+        while True:
+            end = min(total, offset + WS_BINARY_CHUNK)
+            await self._take_credit()
+            await self.conn.send_bytes(pack_frame(self.stream_id, view[offset:end].tobytes(), FLAG_FIN if end >= total else 0))
+            offset = end
+            if offset >= total:
+                return
+
+    # --- Entrada ---
+
+    def feed(self, flags: int, payload: memoryview):
+        """Trozo binario recibido del cliente para este stream"""
+        if self._input_done:
+            raise ValueError("payload ya completo")
+        self._payload_size += len(payload)
+        if self._payload_size > WS_MAX_PAYLOAD:
+            raise ValueError(f"payload mayor de {WS_MAX_PAYLOAD // (1024 * 1024)} MB")
+        if payload:
+            self._segment.append(bytes(payload))
+        if flags & (FLAG_SEGMENT | FLAG_FIN) and self._segment:
+            self._segments.put_nowait((b"".join(self._segment), bool(flags & FLAG_FIN)))
+            self._segment = []
+        if flags & FLAG_FIN:
+            self._input_done = True
+            self._segments.put_nowait(None)
+
+    async def segments(self) -> AsyncIterator[Tuple[bytes, bool]]:
+        """(segmento, lo cerró FLAG_FIN) según llegan (FLAG_SEGMENT o FLAG_FIN cierran cada uno)"""
+        while True:
+            item = await self._segments.get()
+            if item is None:
+                return
+            yield item
+
+    async def read_payload(self) -> bytes:
+        """Payload binario completo (hasta FLAG_FIN)"""
+        return b"".join([segment async for segment, _ in self.segments()])
+
+
+class MuxConnection:
+    """Bucle de recepción de una conexión y tareas de sus streams"""
+
+    def __init__(self, websocket: WebSocket, handlers: Dict[str, Handler], user: Dict[str, Any]):
+        self.websocket = websocket
+        self.handlers = handlers
+        self.user = user
+        self.streams: Dict[int, MuxStream] = {}
+        self._send_lock = asyncio.Lock()
+        self._closed = False
+
+    async def send_text(self, text: str):
+        if self._closed:
+            raise StreamCancelled()
+        async with self._send_lock:
+            try:
+                await self.websocket.send_text(text)
+            except (WebSocketDisconnect, RuntimeError):
+                self._closed = True
+                raise StreamCancelled()
+        _count("messages_out")
+
+    async def send_json(self, payload: Dict[str, Any]):
+        await self.send_text(json.dumps(payload, ensure_ascii=False))
+
+    async def send_bytes(self, data: bytes):
+        if self._closed:
+            raise StreamCancelled()
+        async with self._send_lock:
+            try:
+                await self.websocket.send_bytes(data)
+            except (WebSocketDisconnect, RuntimeError):
+                self._closed = True
+                raise StreamCancelled()
+        _count("bytes_out", len(data))
+
+    async def _error(self, stream_id: Optional[int], error: str, status: int = 400):
+        try:
+            await self.send_json({"stream": stream_id, "type": "error", "status": status, "error": error})
+        except StreamCancelled:
+            pass
+
+    async def run(self):
+        """Recibir mensajes hasta que el cliente cierre; al cerrar se cancelan sus streams"""
+        _count("connections")
+        _count("open")
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    await self._on_binary(message["bytes"])
+                elif message.get("text") is not None:
+                    await self._on_text(message["text"])
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self._closed = True
+            _count("open", -1)
+            tasks = [s.task for s in self.streams.values() if s.task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _on_binary(self, frame: bytes):
+        _count("bytes_in", len(frame))
+        try:
+            stream_id, flags, payload = unpack_frame(frame)
+        except ValueError as e:
+            await self._error(None, str(e))
+            return
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            await self._error(stream_id, "stream desconocido o terminado")
+            return
+        try:
+            stream.feed(flags, payload)
+        except ValueError as e:
+            await self._error(stream_id, str(e), 413)
+            self._cancel(stream)
+
+    async def _on_text(self, text: str):
+        _count("messages_in")
+        try:
+            message = json.loads(text)
+            if not isinstance(message, dict):
+                raise ValueError("se esperaba un objeto JSON")
+            kind = message["type"]
+            stream_id = message.get("stream")
+            if stream_id is not None and not (isinstance(stream_id, int) and 0 <= stream_id < 2 ** 32):
+                raise ValueError("stream debe ser un entero de 32 bits")
+            credits = max(0, int(message.get("credits", 0))) if kind == "credit" else 0
+        except (ValueError, KeyError, TypeError) as e:
+            await self._error(None, f"Mensaje inválido: {e}")
+            return
+
+        if kind == "auth":
+            return  # ya autenticada (token repetido al reconectar)
+        stream = self.streams.get(stream_id) if stream_id is not None else None
+        if kind == "credit":
+            if stream is not None:
+                stream.grant(credits)
+            return
+        if kind == "cancel":
+            if stream is not None:
+                self._cancel(stream)
+            return
+
+        handler = self.handlers.get(kind)
+        if handler is None:
+            await self._error(stream_id, f"Tipo de mensaje desconocido: {kind}")
+        elif stream_id is None:
+            await self._error(None, f"'{kind}' necesita un stream")
+        elif stream is not None:
+            await self._error(stream_id, "El stream ya está abierto", 409)
+        elif len(self.streams) >= WS_MAX_STREAMS:
+            await self._error(stream_id, f"Máximo {WS_MAX_STREAMS} streams abiertos por conexión", 429)
+        else:
+            stream = MuxStream(self, stream_id, kind, WS_WINDOW)
+            self.streams[stream_id] = stream
+            stream.task = asyncio.create_task(self._run_stream(stream, handler, message))
+            _count("streams")
+
+    def _cancel(self, stream: MuxStream):
+        if stream.cancelled:
+            return
+        stream.cancelled = True
+        _count("cancelled")
+        if stream.on_cancel is not None:
+            stream.on_cancel()
+        elif stream.task is not None:
+            stream.task.cancel()
+
+    async def _run_stream(self, stream: MuxStream, handler: Handler, message: Dict[str, Any]):
+        end: Dict[str, Any] = {"stream": stream.stream_id, "type": "end", "status": "ok"}
+        try:
+            await handler(stream, message)
+            if stream.cancelled:
+                end["status"] = "cancelled"
+        except (asyncio.CancelledError, StreamCancelled):
+            end["status"] = "cancelled"
+        except HTTPException as e:
+            end.update(status="error", code=e.status_code, error=e.detail)
+            if e.headers and "Retry-After" in e.headers:
+                end["retry_after"] = int(e.headers["Retry-After"])
+        except Exception as e:
+            logger.error(f"❌ Error en stream {stream.kind} {stream.stream_id} del WebSocket: {e}", exc_info=True)
+            end.update(status="error", code=500, error=str(e))
+        finally:
+            self.streams.pop(stream.stream_id, None)
+        if not self._closed:
+            try:
+                await self.send_json(end)
+            except StreamCancelled:
+                pass
+
+
+async def authenticate(websocket: WebSocket, verify_token: Callable[[str], Awaitable[Optional[Dict[str, Any]]]]) -> Optional[Dict[str, Any]]:
+    """Usuario de la conexión: cabecera Authorization o primer mensaje {"type": "auth", "token": ...}
+
+    Acepta la conexión; si no hay usuario válido la cierra (1008) y devuelve None.
+    """
+    await websocket.accept()
+    token = websocket.headers.get("authorization")
+    if not token:
+        try:
+            message = await asyncio.wait_for(websocket.receive_json(), WS_AUTH_TIMEOUT)
+            if isinstance(message, dict) and message.get("type") == "auth":
+                token = message.get("token")
+        # Trama binaria (KeyError en receive_json), JSON inválido o que no es un objeto: no autorizado
+        except (asyncio.TimeoutError, ValueError, KeyError, TypeError, AttributeError, WebSocketDisconnect):
+            token = None
+    user = None
+    if isinstance(token, str) and token:
+        if token.startswith("Bearer "):
+            token = token[7:]
+        try:
+            user = await verify_token(token)
+        except Exception as e:
+            logger.warning(f"Error verificando token (WebSocket): {e}")
+    if not user:
+        _count("auth_failed")
+        try:
+            await websocket.close(code=WS_POLICY_VIOLATION, reason="No autorizado")
+        except RuntimeError:
+            pass
+        return None
+    await websocket.send_json({"type": "ready", "window": WS_WINDOW, "max_streams": WS_MAX_STREAMS})
+    return user
+
+
+_stats = {
+    "connections": 0, "open": 0, "auth_failed": 0, "streams": 0, "cancelled": 0, "credit_waits": 0,
+    "messages_in": 0, "messages_out": 0, "bytes_in": 0, "bytes_out": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str, amount: int = 1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def mux_stats() -> Dict[str, Any]:
+    """Conexiones, streams y tráfico del transporte WebSocket"""
+    with _stats_lock:
+        return dict(_stats)